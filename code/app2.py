@@ -1,33 +1,38 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context, g
 import os
 from dotenv import load_dotenv
 from pathlib import Path
-import qdrant_client
-from qdrant_client.models import Distance
-from sentence_transformers import SentenceTransformer
-from google import genai
-from google.genai import types
 import json
 from typing import TypedDict, List, Dict, Any, Literal
 import io
 from datetime import datetime
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
 import time
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import itertools
+import math
+import functools
+import hmac
+import inspect
+import contextlib
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 import logging
+import re
+import sqlite3
+import uuid
+import numpy as np
+from local_index import LocalVectorStore, LexicalIndex, DEFAULT_ANN_THRESHOLD, reciprocal_rank_fusion
+from embedding_engine import create_engine
+from context_cache import CachedInstruction, GenaiCacheClient, InMemoryCacheClient
+from resilience import CircuitBreaker, TokenBucket, CLOSED, HALF_OPEN, OPEN
+from metrics import registry, trace_span, PROMETHEUS_CONTENT_TYPE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# LangGraph imports
-from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
-
 # Initialize Flask app
 app = Flask(__name__)
 
@@ -41,11 +46,886 @@ QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 # Google Gemini configuration
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GEMINI_MODEL = "gemini-2.0-flash-lite"
+# Gemini tokens (input + output, all calls) one request may spend; 0 = unlimited. Requests may lower it with "token_budget"
+TOKEN_BUDGET_PER_REQUEST = int(os.getenv("TOKEN_BUDGET_PER_REQUEST", "0"))
+# System instruction caching: "gemini" (explicit context cache), "memory" (local fake for tests) or "off" (always inline).
+# Off by default: Gemini only caches content above a model-specific minimum size, which the persona instruction may not reach
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "off").lower()
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+GEMINI_CONTEXT_CACHE_RENEW_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_RENEW_SECONDS", "300"))
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "600"))
+# Request deadlines: each query gets REQUEST_DEADLINE_SECONDS end to end (0 = none); a request may ask for a
+# different "deadline_seconds" up to REQUEST_DEADLINE_MAX_SECONDS. Gemini refinement and retries need at least
+# DEADLINE_ITERATION_RESERVE_SECONDS left, an LLM critique DEADLINE_CRITIQUE_RESERVE_SECONDS, any Gemini call GEMINI_MIN_CALL_SECONDS
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+REQUEST_DEADLINE_MAX_SECONDS = float(os.getenv("REQUEST_DEADLINE_MAX_SECONDS", "120"))
+DEADLINE_ITERATION_RESERVE_SECONDS = float(os.getenv("DEADLINE_ITERATION_RESERVE_SECONDS", "10"))
+DEADLINE_CRITIQUE_RESERVE_SECONDS = float(os.getenv("DEADLINE_CRITIQUE_RESERVE_SECONDS", "4"))
+GEMINI_MIN_CALL_SECONDS = float(os.getenv("GEMINI_MIN_CALL_SECONDS", "1"))
+# Process-wide Gemini admission control: a token bucket (0 = no rate limit) and a circuit breaker that
+# sends every call straight to the local fallbacks after consecutive failures
+GEMINI_RATE_LIMIT_PER_SECOND = float(os.getenv("GEMINI_RATE_LIMIT_PER_SECOND", "10"))
+GEMINI_RATE_LIMIT_BURST = float(os.getenv("GEMINI_RATE_LIMIT_BURST", "20"))
+GEMINI_RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("GEMINI_RATE_LIMIT_MAX_WAIT_SECONDS", "5"))
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("GEMINI_BREAKER_FAILURE_THRESHOLD", "5"))
+GEMINI_BREAKER_RECOVERY_SECONDS = float(os.getenv("GEMINI_BREAKER_RECOVERY_SECONDS", "30"))
+
+# Search fan-out configuration
+SEARCH_MAX_WORKERS = int(os.getenv("SEARCH_MAX_WORKERS", "8"))
+SEARCH_TIMEOUT_SECONDS = float(os.getenv("SEARCH_TIMEOUT_SECONDS", "10"))
+
+# Search backend configuration: "qdrant" (Qdrant Cloud) or "local" (in-process index, see local_index.py)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "qdrant").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", str(Path(__file__).resolve().parent / "local_index_data"))
+LOCAL_INDEX_ANN_THRESHOLD = int(os.getenv("LOCAL_INDEX_ANN_THRESHOLD", str(DEFAULT_ANN_THRESHOLD)))
+
+# Payload projection: Qdrant searches fetch only the chunk text and these metadata fields (what ranking, context
+# packing and the prompt read); the full payload is fetched by point id for the chunks a response shows
+PAYLOAD_PROJECTION_ENABLED = os.getenv("PAYLOAD_PROJECTION_ENABLED", "true").lower() == "true"
+SEARCH_PAYLOAD_FIELDS = [f.strip() for f in os.getenv("SEARCH_PAYLOAD_FIELDS", "author,book_title,publication_year,doc_type,source_file,chunk_id").split(",") if f.strip()]
+
+# Lexical (BM25) index configuration; built from the same chunk folders / exports as the local backend.
+# With Qdrant, only collections exported with `python local_index.py export` carry Qdrant's point ids (chunk
+# folders get ids of their own), so the fast path is off by default there and other collections are skipped
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR", LOCAL_INDEX_DIR)
+LEXICAL_FAST_PATH_ENABLED = os.getenv("LEXICAL_FAST_PATH_ENABLED", "true" if SEARCH_BACKEND == "local" else "false").lower() == "true"
+LEXICAL_FAST_PATH_MAX_WORDS = int(os.getenv("LEXICAL_FAST_PATH_MAX_WORDS", "12"))
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "false").lower() == "true"
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Query refinement: "hybrid" (local keyphrases, escalating to Gemini when unsure), "local" or "gemini"
+QUERY_REFINEMENT_MODE = os.getenv("QUERY_REFINEMENT_MODE", "hybrid").lower()
+LOCAL_REFINEMENT_MIN_CONFIDENCE = float(os.getenv("LOCAL_REFINEMENT_MIN_CONFIDENCE", "0.75"))
+LOCAL_REFINEMENT_MAX_PHRASES = int(os.getenv("LOCAL_REFINEMENT_MAX_PHRASES", "4"))
+
+# Critique: "hybrid" (local sufficiency estimate, LLM only in the uncertain band), "local" or "llm"
+CRITIQUE_MODE = os.getenv("CRITIQUE_MODE", "hybrid").lower()
+LOCAL_CRITIQUE_GOOD_THRESHOLD = float(os.getenv("LOCAL_CRITIQUE_GOOD_THRESHOLD", "0.6"))
+LOCAL_CRITIQUE_POOR_THRESHOLD = float(os.getenv("LOCAL_CRITIQUE_POOR_THRESHOLD", "0.35"))
+SENTENCE_SUPPORT_THRESHOLD = 0.5
+
+# Speculative search: search the raw query while Gemini refines it
+SPECULATIVE_SEARCH_ENABLED = os.getenv("SPECULATIVE_SEARCH_ENABLED", "true").lower() == "true"
+SPECULATIVE_SIMILARITY_THRESHOLD = float(os.getenv("SPECULATIVE_SIMILARITY_THRESHOLD", "0.9"))
+
+# Multi-query expansion: search the refined query, the original and key-entity subqueries together (one
+# embedding call, one batched search per collection) and fuse the rankings; the original query is then
+# searched anyway, so speculative search is off by default
+MULTI_QUERY_ENABLED = os.getenv("MULTI_QUERY_ENABLED", "false").lower() == "true"
+MULTI_QUERY_MAX_VARIANTS = int(os.getenv("MULTI_QUERY_MAX_VARIANTS", "4"))
+
+# Batch queries (/api/query/batch): queries answered at once across all batch requests, and the largest batch accepted
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "500"))
+
+# Context packing: strip chunk overlaps, merge neighbouring chunks of a document, drop near-duplicates,
+# and fill the generation prompt up to a token budget in score order
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+CONTEXT_MIN_OVERLAP_CHARS = 20
+CONTEXT_MAX_OVERLAP_CHARS = 300  # chunks were split with 100-character overlaps
+
+# Collection catalogue: how long the cached collection list is served before a background refresh
+COLLECTION_CATALOGUE_TTL_SECONDS = float(os.getenv("COLLECTION_CATALOGUE_TTL_SECONDS", "300"))
+VALIDATE_COLLECTIONS = os.getenv("VALIDATE_COLLECTIONS", "true").lower() == "true"
+
+# Embedding engine: "torch" (SentenceTransformer) or "onnx" (exported, int8-quantized; see embedding_engine.py)
+EMBEDDING_ENGINE = os.getenv("EMBEDDING_ENGINE", "torch").lower()
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", str(Path(__file__).resolve().parent / "onnx_minilm"))
+EMBEDDING_ONNX_QUANTIZED = os.getenv("EMBEDDING_ONNX_QUANTIZED", "true").lower() == "true"
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+
+# Embedding micro-batching: queries arriving within the window are encoded as one batch
+EMBEDDING_BATCHING_ENABLED = os.getenv("EMBEDDING_BATCHING_ENABLED", "true").lower() == "true"
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+
+# Query cache configuration
+REFINED_QUERY_CACHE_SIZE = int(os.getenv("REFINED_QUERY_CACHE_SIZE", "1024"))
+REFINED_QUERY_CACHE_TTL_SECONDS = float(os.getenv("REFINED_QUERY_CACHE_TTL_SECONDS", "86400"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+QUERY_EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+
+# Semantic answer cache configuration
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", str(Path(__file__).resolve().parent / "answer_cache.sqlite3"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+# Lookups compare against every answer stored for the same parameters, so each parameter set is capped too
+ANSWER_CACHE_MAX_ENTRIES_PER_PARAMS = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES_PER_PARAMS", "1000"))
+# Bearer token for POST /api/cache/invalidate; without one, only requests from this host may invalidate
+# (set it when serving behind a reverse proxy on the same host, where every request looks local)
+CACHE_ADMIN_TOKEN = os.getenv("CACHE_ADMIN_TOKEN", "")
+
+# Result store: every answered query is kept under a result_id for exports (/api/download) and follow-ups
+# (/api/chunks, /api/results). The RESULT_STORE_MAX_ENTRIES most recent results stay in memory; with a
+# RESULT_STORE_PATH, older ones spill to SQLite (up to RESULT_STORE_MAX_SPILLED) instead of being dropped
+RESULT_STORE_ENABLED = os.getenv("RESULT_STORE_ENABLED", "true").lower() == "true"
+RESULT_STORE_MAX_ENTRIES = int(os.getenv("RESULT_STORE_MAX_ENTRIES", "500"))
+RESULT_STORE_TTL_SECONDS = float(os.getenv("RESULT_STORE_TTL_SECONDS", str(24 * 3600)))
+RESULT_STORE_PATH = os.getenv("RESULT_STORE_PATH", "")
+RESULT_STORE_MAX_SPILLED = int(os.getenv("RESULT_STORE_MAX_SPILLED", "20000"))
+
+# Startup configuration
+FLASK_DEBUG = os.getenv("FLASK_DEBUG", "true").lower() == "true"
+FLASK_USE_RELOADER = os.getenv("FLASK_USE_RELOADER", str(FLASK_DEBUG)).lower() == "true"
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "true").lower() == "true"
+
+# --- Metrics ---
+STAGE_SECONDS = registry.histogram("psai_stage_duration_seconds", "Time spent in each pipeline stage", ["stage"])
+STAGE_ERRORS = registry.counter("psai_stage_errors_total", "Pipeline stages that ended with an error", ["stage"])
+SEARCH_SECONDS = registry.histogram("psai_search_duration_seconds", "Vector search latency per collection", ["collection"])
+SEARCH_FAILURES = registry.counter("psai_search_failures_total", "Collection searches that timed out or failed", ["collection", "reason"])
+GEMINI_SECONDS = registry.histogram("psai_gemini_attempt_duration_seconds", "Latency of each Gemini API attempt", ["call", "outcome"])
+GEMINI_RETRIES = registry.counter("psai_gemini_retries_total", "Gemini attempts that failed and were retried", ["call"])
+GEMINI_REJECTIONS = registry.counter("psai_gemini_rejections_total", "Gemini calls refused before reaching the API", ["call", "reason"])
+GEMINI_TOKENS = registry.counter("psai_gemini_tokens_total", "Gemini tokens reported in usage metadata", ["call", "kind"])
+EMBEDDING_BATCH_SIZE = registry.histogram("psai_embedding_batch_size", "Texts per embedding batch", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+EMBEDDING_QUEUE_SECONDS = registry.histogram("psai_embedding_queue_delay_seconds", "Time texts wait before their batch is encoded",
+                                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+EMBEDDING_ENCODE_SECONDS = registry.histogram("psai_embedding_encode_duration_seconds", "Embedding model time per batch")
+HTTP_SECONDS = registry.histogram("psai_http_request_duration_seconds", "HTTP request latency", ["route", "method", "status"])
+
+def instrumented_node(stage: str):
+    """Time a graph node into psai_stage_duration_seconds (with a trace span) and count error results; sync or async"""
+    def decorate(node):
+        if inspect.iscoroutinefunction(node):
+            @functools.wraps(node)
+            async def async_wrapper(state):
+                with trace_span(f"node.{stage}", iteration=state.get("iteration_count")), STAGE_SECONDS.time(stage=stage):
+                    update = await node(state)
+                if update.get("error_message"):
+                    STAGE_ERRORS.inc(stage=stage)
+                return update
+            return async_wrapper
+
+        @functools.wraps(node)
+        def wrapper(state):
+            with trace_span(f"node.{stage}", iteration=state.get("iteration_count")), STAGE_SECONDS.time(stage=stage):
+                update = node(state)
+            if update.get("error_message"):
+                STAGE_ERRORS.inc(stage=stage)
+            return update
+        return wrapper
+    return decorate
+
+@contextlib.contextmanager
+def observe_gemini_attempt(call: str):
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        with trace_span(f"gemini.{call}"):
+            yield
+        outcome = "ok"
+    finally:
+        GEMINI_SECONDS.observe(time.perf_counter() - start, call=call, outcome=outcome)
+
+def record_gemini_retry(retry_state: Any) -> None:
+    """tenacity before_sleep hook"""
+    GEMINI_RETRIES.inc(call=retry_state.fn.__name__)
+    logger.warning(f"Retrying {retry_state.fn.__name__} after attempt {retry_state.attempt_number}: {retry_state.outcome.exception()}")
+
+# --- Lazy Clients ---
+class LazyResource:
+    """Builds a heavy client on first use, once, so importing this module stays cheap
+    (torch alone takes seconds) and a worker can answer liveness probes immediately"""
+    def __init__(self, name: str, factory):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not None
+
+    def get(self) -> Any:
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    start = time.perf_counter()
+                    value = self._factory()
+                    self.load_seconds = time.perf_counter() - start
+                    logger.info(f"Initialized {self.name} in {self.load_seconds:.2f}s")
+                    self._value = value
+        return self._value
+
+def create_qdrant_client() -> Any:
+    import qdrant_client
+    return qdrant_client.QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+
+def create_embedding_model() -> Any:
+    return create_engine(
+        EMBEDDING_ENGINE,
+        "all-MiniLM-L6-v2",
+        onnx_dir=EMBEDDING_ONNX_DIR,
+        threads=EMBEDDING_THREADS,
+        quantized=EMBEDDING_ONNX_QUANTIZED
+    )
+
+def create_genai_client() -> Any:
+    from google import genai
+    return genai.Client(api_key=GOOGLE_API_KEY)
+
+qdrant_client_instance = LazyResource("qdrant_client", create_qdrant_client)
+embedding_model = LazyResource("embedding_model", create_embedding_model)
+genai_client_instance = LazyResource("genai_client", create_genai_client)
+
+# --- Search Backends ---
+def search_payload_selector(payload_fields: List[str] | None) -> List[str] | bool:
+    """Qdrant with_payload for searches: only payload_fields (and the text) when given, else everything"""
+    # Payloads are either {"text", "metadata": {...}} or flat, so select both forms of each field
+    return ["text"] + payload_fields + [f"metadata.{field}" for field in payload_fields] if payload_fields else True
+
+class QdrantSearchBackend:
+    """Search backend over a live Qdrant deployment"""
+    def __init__(self, client: LazyResource, payload_fields: List[str] | None = None):
+        self._client = client
+        self.projects_payload = bool(payload_fields)
+        self.with_payload = search_payload_selector(payload_fields)
+
+    @property
+    def client(self) -> Any:
+        return self._client.get()
+
+    def list_collections(self) -> List[str]:
+        return [c.name for c in self.client.get_collections().collections]
+
+    def describe_collections(self) -> Dict[str, Dict[str, Any]]:
+        names = self.list_collections()
+        infos = search_executor.map(self.client.get_collection, names)
+        return {name: describe_qdrant_collection(info) for name, info in zip(names, infos)}
+
+    def search(self, collection_name: str, query_vector: List[float], limit: int, score_threshold: float | None = None) -> List[Any]:
+        return self.client.search(
+            collection_name=collection_name,
+            query_vector=query_vector,
+            limit=limit,
+            with_payload=self.with_payload,
+            score_threshold=score_threshold,
+            timeout=max(1, int(SEARCH_TIMEOUT_SECONDS))
+        )
+
+    def search_batch(self, collection_name: str, query_vectors: List[List[float]], limit: int, score_threshold: float | None = None) -> List[List[Any]]:
+        """One round trip for many query vectors; returns one result list per vector"""
+        from qdrant_client import models
+        return self.client.search_batch(
+            collection_name=collection_name,
+            requests=[
+                models.SearchRequest(vector=query_vector, limit=limit, with_payload=self.with_payload, score_threshold=score_threshold)
+                for query_vector in query_vectors
+            ],
+            timeout=max(1, int(SEARCH_TIMEOUT_SECONDS))
+        )
+
+    def retrieve(self, collection_name: str, point_ids: List[str]) -> List[Any]:
+        """Points by id with their full payloads; unknown ids are skipped"""
+        return self.client.retrieve(
+            collection_name=collection_name,
+            ids=[qdrant_point_id(point_id) for point_id in point_ids],
+            with_payload=True,
+            with_vectors=False,
+            timeout=max(1, int(SEARCH_TIMEOUT_SECONDS))
+        )
+
+def qdrant_point_id(point_id: Any) -> int | str:
+    """Chunk ids are strings in responses; Qdrant wants integer ids back as integers"""
+    return int(point_id) if str(point_id).isdigit() else str(point_id)
+
+def describe_qdrant_collection(info: Any) -> Dict[str, Any]:
+    vectors = info.config.params.vectors
+    if isinstance(vectors, dict):
+        # Named vectors: report each one
+        return {
+            "points_count": info.points_count,
+            "vectors": {name: {"size": params.size, "distance": str(params.distance.value)} for name, params in vectors.items()}
+        }
+    return {"points_count": info.points_count, "vector_size": vectors.size, "distance": str(vectors.distance.value)}
+
+def create_search_backend(backend_name: str) -> Any:
+    if backend_name == "qdrant":
+        return QdrantSearchBackend(qdrant_client_instance, SEARCH_PAYLOAD_FIELDS if PAYLOAD_PROJECTION_ENABLED else None)
+    if backend_name == "local":
+        return LocalVectorStore(
+            LOCAL_INDEX_DIR,
+            encode_fn=lambda texts: embedding_model.get().encode(texts, batch_size=64),
+            ann_threshold=LOCAL_INDEX_ANN_THRESHOLD
+        )
+    raise ValueError(f"Unknown SEARCH_BACKEND '{backend_name}', expected 'qdrant' or 'local'")
+
+search_backend = create_search_backend(SEARCH_BACKEND)
+lexical_index = LexicalIndex(LEXICAL_INDEX_DIR)
+
+# Shared pool for per-collection searches so a multi-collection query costs one round trip, not one per collection
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="qdrant-search")
+# Speculative searches fan out on search_executor themselves, so they need their own pool to avoid starving it
+speculative_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="speculative-search")
+# Batch queries share one pool, so concurrent batch requests together never exceed BATCH_MAX_CONCURRENCY
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_CONCURRENCY, thread_name_prefix="batch-query")
+
+# --- Collection Catalogue ---
+class CollectionCatalogue:
+    """Collection names, point counts and vector config, cached so page loads and request validation
+    need no backend round trip. Once older than ttl_seconds the snapshot is still served while a
+    background thread refreshes it (stale-while-revalidate); a failed refresh keeps the old snapshot."""
+    def __init__(self, backend: Any, ttl_seconds: float):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._snapshot: Dict[str, Dict[str, Any]] | None = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._last_error: str | None = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> Dict[str, Dict[str, Any]]:
+        """Fetch the catalogue from the backend now; raises if the backend is unreachable"""
+        try:
+            snapshot = self.backend.describe_collections()
+        except Exception as e:
+            self._last_error = str(e)
+            raise
+        with self._lock:
+            self._snapshot = snapshot
+            self._fetched_at = time.monotonic()
+            self._last_error = None
+        return snapshot
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Collection catalogue refresh failed, serving stale catalogue: {e}")
+        finally:
+            self._refreshing = False
+
+    def get(self) -> Dict[str, Dict[str, Any]] | None:
+        """The catalogue, or None if it has never been fetched successfully"""
+        if self._snapshot is None:
+            try:
+                return self.refresh()
+            except Exception as e:
+                logger.error(f"Could not load collection catalogue: {e}")
+                return None
+        with self._lock:
+            stale = time.monotonic() - self._fetched_at > self.ttl_seconds
+            start_refresh = stale and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+        if start_refresh:
+            threading.Thread(target=self._refresh_in_background, name="catalogue-refresh", daemon=True).start()
+        return self._snapshot
+
+    def names(self) -> List[str]:
+        return list(self.get() or {})
+
+    def unknown(self, collection_names: List[str]) -> List[str]:
+        """Requested collections missing from the catalogue; empty when the catalogue is unavailable"""
+        snapshot = self.get()
+        if snapshot is None:
+            return []
+        return [name for name in collection_names if name not in snapshot]
+
+    def invalidate(self) -> None:
+        """Mark the snapshot stale so the next read triggers a refresh"""
+        with self._lock:
+            self._fetched_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self._snapshot is not None,
+            "age_seconds": round(time.monotonic() - self._fetched_at, 1) if self._snapshot is not None else None,
+            "ttl_seconds": self.ttl_seconds,
+            "refreshing": self._refreshing,
+            "last_error": self._last_error
+        }
+
+collection_catalogue = CollectionCatalogue(search_backend, COLLECTION_CATALOGUE_TTL_SECONDS)
+
+# --- Embedding Dispatcher ---
+class EmbeddingBatcher:
+    """Coalesces encode calls from concurrent requests into one batched model.encode. A single
+    worker thread owns the model: it takes the first queued text, keeps collecting for up to
+    max_wait_seconds or max_batch_size texts, encodes them together and resolves each caller's future."""
+    def __init__(self, encode_fn, max_batch_size: int, max_wait_seconds: float):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_seconds = max_wait_seconds
+        self._queue: queue.Queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._max_batch = 0
+        self._batch_size_counts: Dict[int, int] = {}
+        self._queue_delay_total = 0.0
+        self._queue_delay_max = 0.0
+        self._encode_seconds_total = 0.0
+
+    def submit(self, text: str) -> Future:
+        if self._worker is None:
+            with self._start_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._worker.start()
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        return self.submit(text).result()
+
+    def encode_many(self, texts: List[str]) -> np.ndarray:
+        """Encode several texts; they may share a batch with other requests' texts"""
+        futures = [self.submit(text) for text in texts]
+        return np.stack([future.result() for future in futures]) if futures else np.zeros((0, 0), dtype=np.float32)
+
+    def _collect_batch(self) -> List[tuple]:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            try:
+                vectors = self.encode_fn([text for text, _, _ in batch])
+                for (_, future, _), vector in zip(batch, vectors):
+                    future.set_result(np.asarray(vector, dtype=np.float32))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            self._record(batch, started, time.perf_counter() - started)
+
+    def _record(self, batch: List[tuple], started: float, encode_seconds: float) -> None:
+        delays = [started - enqueued_at for _, _, enqueued_at in batch]
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            self._batch_size_counts[len(batch)] = self._batch_size_counts.get(len(batch), 0) + 1
+            self._queue_delay_total += sum(delays)
+            self._queue_delay_max = max(self._queue_delay_max, max(delays))
+            self._encode_seconds_total += encode_seconds
+        EMBEDDING_BATCH_SIZE.observe(len(batch))
+        EMBEDDING_ENCODE_SECONDS.observe(encode_seconds)
+        for delay in delays:
+            EMBEDDING_QUEUE_SECONDS.observe(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "items": self._items,
+                "mean_batch_size": round(self._items / self._batches, 2) if self._batches else 0.0,
+                "max_batch_size": self._max_batch,
+                "batch_size_counts": dict(sorted(self._batch_size_counts.items())),
+                "mean_queue_delay_ms": round(1000 * self._queue_delay_total / self._items, 3) if self._items else 0.0,
+                "max_queue_delay_ms": round(1000 * self._queue_delay_max, 3),
+                "mean_encode_ms": round(1000 * self._encode_seconds_total / self._batches, 3) if self._batches else 0.0,
+                "queued": self._queue.qsize()
+            }
+
+embedding_batcher = EmbeddingBatcher(
+    lambda texts: embedding_model.get().encode(texts, batch_size=len(texts)),
+    EMBEDDING_BATCH_MAX_SIZE,
+    EMBEDDING_BATCH_MAX_WAIT_MS / 1000
+) if EMBEDDING_BATCHING_ENABLED else None
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Encode texts through the batcher when enabled, otherwise directly on the calling thread"""
+    if embedding_batcher is not None:
+        return embedding_batcher.encode_many(texts)
+    return np.asarray(embedding_model.get().encode(texts))
+
+# --- Query Caches ---
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl_seconds"""
+    def __init__(self, name: str, max_size: int, ttl_seconds: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+refined_query_cache = TTLCache("refined_query", REFINED_QUERY_CACHE_SIZE, REFINED_QUERY_CACHE_TTL_SECONDS)
+query_embedding_cache = TTLCache("query_embedding", QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL_SECONDS)
+# Retrieved chunks recur across retry iterations and popular questions, so their vectors are worth keeping too
+chunk_embedding_cache = TTLCache("chunk_embedding", QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL_SECONDS)
+
+def normalize_query_text(query_text: str) -> str:
+    return " ".join(query_text.lower().split())
+
+def embed_query_internal(query_text: str) -> List[float]:
+    """Encode a query with the embedding model, reusing cached vectors for repeated text"""
+    cache_key = query_text.strip()
+    query_vector = query_embedding_cache.get(cache_key)
+    if query_vector is None:
+        query_vector = encode_texts([cache_key])[0].tolist()
+        query_embedding_cache.set(cache_key, query_vector)
+    return query_vector
+
+def embed_queries_internal(query_texts: List[str]) -> List[List[float]]:
+    """embed_query_internal for many queries: every uncached text is encoded in one call"""
+    cache_keys = [query_text.strip() for query_text in query_texts]
+    query_vectors = {cache_key: query_embedding_cache.get(cache_key) for cache_key in dict.fromkeys(cache_keys)}
+    missing = [cache_key for cache_key, query_vector in query_vectors.items() if query_vector is None]
+    if missing:
+        for cache_key, query_vector in zip(missing, encode_texts(missing)):
+            query_vectors[cache_key] = query_vector.tolist()
+            query_embedding_cache.set(cache_key, query_vectors[cache_key])
+    return [query_vectors[cache_key] for cache_key in cache_keys]
+
+# --- Semantic Answer Cache ---
+class SemanticAnswerCache:
+    """SQLite-backed cache of final responses, looked up by query-embedding similarity.
+
+    An entry only matches requests with the same parameters (collections, temperature,
+    chunk limit, similarity threshold); among those, the nearest stored query embedding
+    is a hit when its cosine similarity reaches similarity_cutoff. The embeddings of each
+    parameter set are kept in memory as one normalised matrix, so a lookup is a single
+    matrix-vector product and reads only the matching response from SQLite.
+    """
+    def __init__(self, path: str, similarity_cutoff: float, ttl_seconds: float, max_entries: int,
+                 max_entries_per_params: int | None = None):
+        self.similarity_cutoff = similarity_cutoff
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_entries_per_params = max_entries_per_params or max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # params_key -> (ids, unit-length vectors, expires_at) of its rows, loaded on first lookup
+        self._indexes: Dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self.path = path
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """The database, opened (and created) on first use rather than at import; callers hold self._lock"""
+        if self._connection is not None:
+            return self._connection
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                params_key TEXT NOT NULL,
+                query TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS answers_params ON answers (params_key, expires_at);
+            CREATE TABLE IF NOT EXISTS answer_collections (
+                answer_id INTEGER NOT NULL REFERENCES answers (id) ON DELETE CASCADE,
+                collection TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS answer_collections_name ON answer_collections (collection);
+        """)
+        conn.execute("PRAGMA foreign_keys = ON")
+        self._connection = conn
+        return conn
+
+    @staticmethod
+    def params_key(collections: List[str], temperature: float, chunk_limit: int, similarity_threshold: float) -> str:
+        return json.dumps({
+            "collections": sorted(set(collections)),
+            "temperature": round(float(temperature), 3),
+            "chunk_limit": int(chunk_limit),
+            "similarity_threshold": round(float(similarity_threshold), 3)
+        }, sort_keys=True)
+
+    def _index(self, params_key: str, now: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        index = self._indexes.get(params_key)
+        if index is None:
+            rows = self._conn.execute(
+                "SELECT id, vector, expires_at FROM answers WHERE params_key = ? AND expires_at > ?",
+                (params_key, now)
+            ).fetchall()
+            vectors = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) if rows else np.empty((0, 0), dtype=np.float32)
+            vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+            index = (np.array([row[0] for row in rows], dtype=np.int64), vectors, np.array([row[2] for row in rows], dtype=np.float64))
+            self._indexes[params_key] = index
+        return index
+
+    def lookup(self, query_vector: List[float], params_key: str) -> tuple[Dict[str, Any], float] | None:
+        now = time.time()
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) + 1e-12)
+        with self._lock:
+            # A second pass only happens when the best row was evicted or invalidated since its index was loaded
+            for _ in range(2):
+                ids, vectors, expires_at = self._index(params_key, now)
+                if not len(ids):
+                    break
+                similarities = np.where(expires_at > now, vectors @ query, -np.inf)
+                best = int(np.argmax(similarities))
+                if similarities[best] < self.similarity_cutoff:
+                    break
+                row = self._conn.execute("SELECT response FROM answers WHERE id = ?", (int(ids[best]),)).fetchone()
+                if row is None:
+                    self._indexes.pop(params_key, None)
+                    continue
+                self._conn.execute("UPDATE answers SET last_accessed = ? WHERE id = ?", (now, int(ids[best])))
+                self._conn.commit()
+                self.hits += 1
+                return json.loads(row[0]), float(similarities[best])
+            self.misses += 1
+            return None
+
+    def store(self, query: str, query_vector: List[float], params_key: str, collections: List[str], response: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO answers (params_key, query, vector, response, created_at, expires_at, last_accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (params_key, query, np.asarray(query_vector, dtype=np.float32).tobytes(), json.dumps(response), now, now + self.ttl_seconds, now)
+            )
+            self._conn.executemany(
+                "INSERT INTO answer_collections (answer_id, collection) VALUES (?, ?)",
+                [(cursor.lastrowid, name) for name in set(collections)]
+            )
+            # Expired entries go first, then least recently used ones beyond the size bound
+            self._conn.execute("DELETE FROM answers WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers WHERE params_key = ? ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)",
+                (params_key, self.max_entries_per_params)
+            )
+            self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+            # Reloaded with the new row on the next lookup; rows of other parameters dropped here are
+            # noticed when they would have been a hit
+            self._indexes.pop(params_key, None)
+
+    def invalidate_collections(self, collections: List[str] | None = None) -> int:
+        """Drop answers built from any of the given collections (all answers when None)"""
+        with self._lock:
+            if collections is None:
+                cursor = self._conn.execute("DELETE FROM answers")
+            else:
+                placeholders = ",".join("?" * len(collections))
+                cursor = self._conn.execute(
+                    f"DELETE FROM answers WHERE id IN (SELECT answer_id FROM answer_collections WHERE collection IN ({placeholders}))",
+                    list(collections)
+                )
+            self._conn.commit()
+            self._indexes.clear()
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "max_size": self.max_entries,
+                "max_size_per_params": self.max_entries_per_params,
+                "ttl_seconds": self.ttl_seconds,
+                "similarity_cutoff": self.similarity_cutoff,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+answer_cache = SemanticAnswerCache(
+    ANSWER_CACHE_PATH, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_ENTRIES_PER_PARAMS
+) if ANSWER_CACHE_ENABLED else None
+
+# --- Result Store ---
+class ResultStore:
+    """Final responses kept under a result id, so clients can reference an answer instead of posting it back.
+
+    An LRU of max_entries results lives in memory, each with the exports rendered from it so far.
+    With a path, results evicted from memory spill to SQLite (without their exports) and move back
+    to memory when used again; otherwise they are dropped. Results expire ttl_seconds after creation.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float, path: str | None = None, max_spilled: int = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_spilled = max_spilled
+        self._entries = OrderedDict()  # result_id -> {"response", "created_at", "expires_at", "exports"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.export_hits = 0
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS results (
+                    id TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    spilled_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS results_spilled ON results (spilled_at);
+            """)
+
+    def put(self, response: Dict[str, Any]) -> str:
+        result_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._entries[result_id] = {"response": response, "created_at": now, "expires_at": now + self.ttl_seconds, "exports": {}}
+            while len(self._entries) > self.max_entries:
+                self._spill(*self._entries.popitem(last=False))
+        return result_id
+
+    def _spill(self, result_id: str, entry: Dict[str, Any]) -> None:
+        now = time.time()
+        if self._conn is None or entry["expires_at"] <= now:
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO results (id, response, created_at, expires_at, spilled_at) VALUES (?, ?, ?, ?, ?)",
+            (result_id, json.dumps(entry["response"]), entry["created_at"], entry["expires_at"], now)
+        )
+        self._conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM results WHERE id IN (SELECT id FROM results ORDER BY spilled_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_spilled,)
+        )
+        self._conn.commit()
+        self.spills += 1
+
+    def _entry(self, result_id: str) -> Dict[str, Any] | None:
+        """The live entry for result_id, moved to the most recently used end (called with the lock held)"""
+        now = time.time()
+        entry = self._entries.get(result_id)
+        if entry is not None and entry["expires_at"] > now:
+            self._entries.move_to_end(result_id)
+            self.hits += 1
+            return entry
+        if entry is not None:
+            del self._entries[result_id]
+        elif self._conn is not None:
+            row = self._conn.execute(
+                "SELECT response, created_at, expires_at FROM results WHERE id = ? AND expires_at > ?", (result_id, now)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("DELETE FROM results WHERE id = ?", (result_id,))
+                self._conn.commit()
+                entry = self._entries[result_id] = {"response": json.loads(row[0]), "created_at": row[1], "expires_at": row[2], "exports": {}}
+                while len(self._entries) > self.max_entries:
+                    self._spill(*self._entries.popitem(last=False))
+                self.spill_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def get(self, result_id: str) -> Dict[str, Any] | None:
+        with self._lock:
+            entry = self._entry(result_id)
+            return entry["response"] if entry is not None else None
+
+    def export(self, result_id: str, export_format: str, render) -> tuple[bytes, float] | None:
+        """(content, created_at) of the result rendered by render(response), rendering it only once per format"""
+        with self._lock:
+            entry = self._entry(result_id)
+            if entry is None:
+                return None
+            content = entry["exports"].get(export_format)
+            if content is not None:
+                self.export_hits += 1
+                return content, entry["created_at"]
+            response = entry["response"]
+        # Rendering (and hydrating chunks) happens outside the lock; a concurrent export may render it too
+        content = render(response)
+        with self._lock:
+            entry["exports"][export_format] = content
+        return content, entry["created_at"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.spill_hits + self.misses
+            spilled = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] if self._conn is not None else 0
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_entries,
+                "spilled": spilled,
+                "max_spilled": self.max_spilled if self._conn is not None else 0,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "spill_hits": self.spill_hits,
+                "misses": self.misses,
+                "spills": self.spills,
+                "export_hits": self.export_hits,
+                "hit_rate": (self.hits + self.spill_hits) / lookups if lookups else 0.0
+            }
 
-# Initialize clients
-qdrant_client_instance = qdrant_client.QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-genai_client_instance = genai.Client(api_key=GOOGLE_API_KEY)
+result_store = ResultStore(
+    RESULT_STORE_MAX_ENTRIES, RESULT_STORE_TTL_SECONDS, RESULT_STORE_PATH or None, RESULT_STORE_MAX_SPILLED
+) if RESULT_STORE_ENABLED else None
+
+def cache_stat_collector(field: str):
+    def collect() -> Dict[tuple, float]:
+        values = {(cache.name,): cache.stats()[field] for cache in (refined_query_cache, query_embedding_cache, chunk_embedding_cache)}
+        if answer_cache is not None:
+            values[("answer",)] = answer_cache.stats()[field]
+        if result_store is not None:
+            values[("result",)] = result_store.stats()[field]
+        return values
+    return collect
+
+registry.gauge("psai_cache_hits_total", "Cache hits", ["cache"], cache_stat_collector("hits"), type_name="counter")
+registry.gauge("psai_cache_misses_total", "Cache misses", ["cache"], cache_stat_collector("misses"), type_name="counter")
+registry.gauge("psai_embedding_queue_length", "Texts waiting for the embedding batcher", [],
+               lambda: {(): embedding_batcher.stats()["queued"] if embedding_batcher else 0})
 
 # --- LangGraph State Definition ---
 class GraphState(TypedDict):
@@ -61,10 +941,21 @@ class GraphState(TypedDict):
     temperature: float
     
     search_results: List[Dict[str, Any]] | None
+    candidate_results: List[Dict[str, Any]] | None
+    candidate_pool_size: int
+    speculative_results: List[Dict[str, Any]] | None
     formatted_context_for_generation: str | None
     
     generated_response_text: str | None
     token_info: Dict[str, int] | None
+    token_usage: Dict[str, Dict[str, int]] | None
+    token_budget: int
+    answer_source: str | None
+
+    deadline: float | None  # epoch seconds
+    time_limited: bool
+    speculative_search: bool  # off for batch queries, whose refined queries are searched together
+    response_mode: str  # one of RESPONSE_MODES
     
     critique_json: Dict[str, str] | None
     
@@ -77,8 +968,7 @@ class GraphState(TypedDict):
 
 # --- Existing Functions (adapted slightly if needed for graph) ---
 def get_available_collections_internal():
-    collections = [c.name for c in qdrant_client_instance.get_collections().collections]
-    return collections
+    return collection_catalogue.names()
 
 class APIError(Exception):
     """Custom exception for API-related errors"""
@@ -87,236 +977,988 @@ class APIError(Exception):
         self.status_code = status_code
         super().__init__(self.message)
 
-@retry(
-    stop=stop_after_attempt(3),
+class CachedContentError(Exception):
+    """Gemini rejected the cached_content handle (expired, deleted or not visible to this key); not retried"""
+
+def as_gemini_api_error(e: Exception) -> Exception:
+    """Map overload errors to a retryable APIError and cache-handle errors to CachedContentError;
+    anything else is returned unchanged"""
+    error_msg = str(e)
+    if "503" in error_msg or "overloaded" in error_msg.lower():
+        logger.warning(f"Gemini API overloaded, will retry: {error_msg}")
+        return APIError(f"Gemini API temporarily unavailable: {error_msg}", 503)
+    if re.search(r"cached.?content", error_msg, re.IGNORECASE):
+        return CachedContentError(error_msg)
+    logger.error(f"Unexpected error calling Gemini API: {error_msg}")
+    return e
+
+# --- Gemini Admission Control ---
+class GeminiUnavailableError(APIError):
+    """Gemini was not called: the circuit breaker is open or the rate limiter had no slot in time; never retried"""
+
+class RequestDeadlineError(APIError):
+    """The request's deadline left no time for a Gemini call, or ran out during one; never retried"""
+
+def remaining_seconds(deadline: float | None) -> float:
+    return float("inf") if deadline is None else deadline - time.time()
+
+def stop_before_deadline(retry_state: Any) -> bool:
+    """tenacity stop: give up rather than back off into the request deadline"""
+    deadline = retry_state.kwargs.get("deadline")
+    upcoming_sleep = getattr(retry_state, "upcoming_sleep", 0) or 0
+    return remaining_seconds(deadline) < upcoming_sleep + GEMINI_MIN_CALL_SECONDS
+
+def config_with_deadline(config: Any, deadline: float | None) -> Any:
+    """Shorten the call's HTTP timeout to the time left before the request deadline"""
+    if deadline is None:
+        return config
+    from google.genai import types
+    timeout_ms = max(int(remaining_seconds(deadline) * 1000), 1)
+    return config.model_copy(update={"http_options": types.HttpOptions(timeout=timeout_ms)})
+
+gemini_breaker = CircuitBreaker(GEMINI_BREAKER_FAILURE_THRESHOLD, GEMINI_BREAKER_RECOVERY_SECONDS, name="gemini")
+gemini_rate_limiter = TokenBucket(GEMINI_RATE_LIMIT_PER_SECOND, GEMINI_RATE_LIMIT_BURST) if GEMINI_RATE_LIMIT_PER_SECOND > 0 else None
+
+CIRCUIT_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+registry.gauge("psai_gemini_circuit_state", "Gemini circuit breaker state (0 closed, 1 half-open, 2 open)", [],
+               lambda: {(): CIRCUIT_STATE_VALUES[gemini_breaker.state]})
+registry.gauge("psai_gemini_circuit_transitions_total", "Gemini circuit breaker state changes", ["state"],
+               lambda: {(state,): count for state, count in gemini_breaker.transitions.items()}, type_name="counter")
+registry.gauge("psai_gemini_rate_limiter_tokens", "Gemini calls the rate limiter can admit without waiting", [],
+               lambda: {(): max(gemini_rate_limiter.available, 0.0)} if gemini_rate_limiter else {})
+
+def gemini_admission_delay(call: str, deadline: float | None = None) -> float:
+    """Admit one Gemini attempt: returns how long to wait for a rate-limiter slot, or raises
+    GeminiUnavailableError (or RequestDeadlineError when too little of the request's time is left)"""
+    time_left = remaining_seconds(deadline) - GEMINI_MIN_CALL_SECONDS
+    if time_left < 0:
+        GEMINI_REJECTIONS.inc(call=call, reason="deadline")
+        raise RequestDeadlineError("Request deadline leaves no time for a Gemini call; using the local fallback", 504)
+    if not gemini_breaker.allow():
+        GEMINI_REJECTIONS.inc(call=call, reason="circuit_open")
+        raise GeminiUnavailableError("Gemini circuit breaker is open; using the local fallback", 503)
+    delay = gemini_rate_limiter.reserve(min(GEMINI_RATE_LIMIT_MAX_WAIT_SECONDS, time_left)) if gemini_rate_limiter else 0.0
+    if delay is None:
+        gemini_breaker.release()
+        GEMINI_REJECTIONS.inc(call=call, reason="rate_limited")
+        raise GeminiUnavailableError("Gemini rate limit reached; using the local fallback", 429)
+    return delay
+
+def is_gemini_outage(error: Exception) -> bool:
+    """Errors that say Gemini itself is unhealthy, as opposed to a problem with one request"""
+    if isinstance(error, (GeminiUnavailableError, RequestDeadlineError, CachedContentError)):
+        return False
+    if isinstance(error, APIError):
+        return True
+    return bool(re.search(r"\b(429|500|502|504)\b|RESOURCE_EXHAUSTED|UNAVAILABLE|DEADLINE_EXCEEDED|timed? ?out|connection",
+                          str(error), re.IGNORECASE))
+
+def gemini_attempt_error(e: Exception, deadline: float | None) -> Exception:
+    """as_gemini_api_error, except that a failure at the request deadline (our own shortened timeout) is a RequestDeadlineError"""
+    if remaining_seconds(deadline) < GEMINI_MIN_CALL_SECONDS / 2:
+        return RequestDeadlineError(f"Request deadline reached during Gemini call: {e}", 504)
+    return as_gemini_api_error(e)
+
+def log_gemini_failure(message: str, error: Exception, level: int = logging.ERROR) -> None:
+    """Running out of request time is an expected outcome, so it is logged at INFO rather than level"""
+    logger.log(logging.INFO if isinstance(error, RequestDeadlineError) else level, f"{message}: {error}")
+
+def record_gemini_outcome(error: Exception | None) -> None:
+    if error is None:
+        gemini_breaker.record_success()
+    elif is_gemini_outage(error):
+        gemini_breaker.record_failure()
+    else:
+        gemini_breaker.release()
+
+def should_retry_gemini(error: BaseException) -> bool:
+    """tenacity predicate: retry overloads, but not once the breaker has opened (fail over at once instead of sleeping)"""
+    return (isinstance(error, APIError) and not isinstance(error, (GeminiUnavailableError, RequestDeadlineError))
+            and not gemini_breaker.is_open())
+
+# Retry policy for a Gemini call, shared by the sync and async (asgi_app.py) paths
+gemini_retry = retry(
+    stop=stop_after_attempt(3) | stop_before_deadline,
     wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type(APIError)
+    retry=retry_if_exception(should_retry_gemini),
+    before_sleep=record_gemini_retry,
+    reraise=True
 )
-def call_gemini_with_retry(model: str, prompt: str, config: Any) -> Any:
-    """Call Gemini API with retry logic"""
+
+@gemini_retry
+def call_gemini_with_retry(model: str, prompt: str, config: Any, deadline: float | None = None) -> Any:
+    """Call Gemini API with retry logic; attempts and backoff stop at the request deadline (epoch seconds)"""
+    time.sleep(gemini_admission_delay("call_gemini_with_retry", deadline))
+    config = config_with_deadline(config, deadline)
     try:
-        response = genai_client_instance.models.generate_content(
-            model=model,
-            contents=prompt,
-            config=config
-        )
-        
-        if not response or not response.text:
-            raise APIError("Empty response from Gemini API")
-        
-        return response
+        with observe_gemini_attempt("call_gemini_with_retry"):
+            response = genai_client_instance.get().models.generate_content(
+                model=model,
+                contents=prompt,
+                config=config
+            )
+
+            if not response or not response.text:
+                raise APIError("Empty response from Gemini API")
     except Exception as e:
-        error_msg = str(e)
-        if "503" in error_msg or "overloaded" in error_msg.lower():
-            logger.warning(f"Gemini API overloaded, will retry: {error_msg}")
-            raise APIError(f"Gemini API temporarily unavailable: {error_msg}", 503)
-        else:
-            logger.error(f"Unexpected error calling Gemini API: {error_msg}")
-            raise
+        error = gemini_attempt_error(e, deadline)
+        record_gemini_outcome(error)
+        raise error
+    record_gemini_outcome(None)
+    return response
+
+@gemini_retry
+def open_gemini_stream_with_retry(model: str, prompt: str, config: Any, deadline: float | None = None) -> tuple[Any, Any]:
+    """Start a streaming Gemini call, retrying until the first chunk arrives; returns (first_chunk, stream)"""
+    time.sleep(gemini_admission_delay("open_gemini_stream_with_retry", deadline))
+    config = config_with_deadline(config, deadline)
+    try:
+        # Measures time to first chunk
+        with observe_gemini_attempt("open_gemini_stream_with_retry"):
+            stream = genai_client_instance.get().models.generate_content_stream(
+                model=model,
+                contents=prompt,
+                config=config
+            )
+            first_chunk = next(stream, None)
+            if first_chunk is None:
+                raise APIError("Empty response from Gemini API")
+    except Exception as e:
+        error = gemini_attempt_error(e, deadline)
+        record_gemini_outcome(error)
+        raise error
+    record_gemini_outcome(None)
+    return first_chunk, stream
+
+# --- Token Accounting ---
+def gemini_token_usage(response: Any, prompt: str, text: str) -> Dict[str, int]:
+    """Token counts from a Gemini response's usage_metadata (for streams, the last chunk's);
+    estimated at ~4 characters per token when the metadata is missing"""
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens = getattr(usage, "prompt_token_count", None)
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    if input_tokens is None or output_tokens is None:
+        logger.warning("Gemini response has no usage metadata; estimating token counts")
+        input_tokens, output_tokens = len(prompt) // 4, len(text) // 4
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens,
+                "cached_tokens": 0, "estimated": 1}
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        # total_token_count also includes thinking tokens on models that use them
+        "total_tokens": getattr(usage, "total_token_count", None) or input_tokens + output_tokens,
+        "cached_tokens": getattr(usage, "cached_content_token_count", None) or 0,
+        "estimated": 0
+    }
 
-def refine_query_for_semantic_search_internal(query_text: str) -> str:
-    """Refine the query with fallback mechanisms"""
+def add_token_usage(token_usage: Dict[str, Dict[str, int]] | None, call: str, usage: Dict[str, int] | None) -> Dict[str, Dict[str, int]]:
+    """Per-request usage keyed by graph stage, with one more Gemini call added; returns a new dict
+    so it can be handed back as a node update. usage=None (no Gemini call was made) adds nothing"""
+    token_usage = {stage: dict(counts) for stage, counts in (token_usage or {}).items()}
+    if usage is None:
+        return token_usage
+    counts = token_usage.setdefault(call, {"calls": 0, "input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "cached_tokens": 0, "estimated_calls": 0})
+    counts["calls"] += 1
+    counts["estimated_calls"] += usage["estimated"]
+    for kind in ("input_tokens", "output_tokens", "total_tokens", "cached_tokens"):
+        counts[kind] += usage[kind]
+    GEMINI_TOKENS.inc(usage["input_tokens"], call=call, kind="input")
+    GEMINI_TOKENS.inc(usage["output_tokens"], call=call, kind="output")
+    return token_usage
+
+def tokens_used(state: Dict[str, Any]) -> int:
+    return sum(counts["total_tokens"] for counts in (state.get("token_usage") or {}).values())
+
+def summarize_token_usage(state: Dict[str, Any]) -> Dict[str, Any]:
+    """token_info for the final response: totals over every Gemini call in the request, per stage, and the budget"""
+    token_usage = state.get("token_usage") or {}
+    summary = {kind: sum(counts[kind] for counts in token_usage.values())
+               for kind in ("input_tokens", "output_tokens", "total_tokens", "cached_tokens")}
+    summary["gemini_calls"] = sum(counts["calls"] for counts in token_usage.values())
+    summary["estimated_calls"] = sum(counts["estimated_calls"] for counts in token_usage.values())
+    summary["by_stage"] = token_usage
+    budget = state.get("token_budget") or 0
+    summary["token_budget"] = budget or None
+    summary["budget_remaining"] = max(budget - summary["total_tokens"], 0) if budget else None
+    return summary
+
+def token_budget_allows_retry(state: Dict[str, Any]) -> bool:
+    """Whether another generate + critique iteration is projected to fit in the request's token budget.
+
+    The projection is the average spend per iteration so far, scaled by how much larger the next
+    context will be (input tokens grow with the chunk count)."""
+    budget = state.get("token_budget") or 0
+    if not budget:
+        return True
+    used = tokens_used(state)
+    current_limit = max(state.get("current_chunk_limit", 1), 1)
+    next_limit = min(current_limit + 5, state.get("max_chunk_limit", 15))
+    projected = used / max(state.get("iteration_count", 1), 1) * next_limit / current_limit
+    return used + projected <= budget
+
+# Conversational filler and words that carry no retrieval signal in this corpus (everything is by or about Phyllis Schlafly)
+REFINEMENT_STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be been before being below between both but by can
+could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or
+other our ours out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom whose
+why will with would you your yours yourself yourselves
+tell explain describe discuss summarize give show know think thought thoughts feel felt say said saying believe
+opinion opinions view views position stance please anything something much many really ever also like
+""".split())
+
+def query_word_runs(query_text: str) -> List[List[tuple[int, str]]]:
+    """The query's maximal runs of non-stopwords, as (position, word) lists"""
+    words = [re.sub(r"['\u2019]s$", "", w) for w in re.findall(r"[A-Za-z0-9][A-Za-z0-9'\u2019.-]*[A-Za-z0-9]|[A-Za-z0-9]", query_text)]
+    runs, current = [], []
+    for position, word in enumerate(words):
+        if word.lower() in REFINEMENT_STOPWORDS:
+            if current:
+                runs.append(current)
+            current = []
+        else:
+            current.append((position, word))
+    if current:
+        runs.append(current)
+    return runs
+
+def local_refine_query_internal(query_text: str) -> tuple[str, float]:
+    """Keyphrase refinement with the resident embedding model.
+
+    Candidate 1-3 word phrases are taken from the stopword-free runs of the query, ranked by
+    similarity to the query embedding with maximal marginal relevance, and joined in query order.
+    Returns (refined_query, confidence), where confidence is the refined/original cosine similarity.
+    """
+    runs = query_word_runs(query_text)
+    candidates = {}
+    for run in runs:
+        for n in range(1, 4):
+            for start in range(len(run) - n + 1):
+                phrase_words = run[start:start + n]
+                candidates.setdefault(" ".join(w for _, w in phrase_words), (phrase_words[0][0], {p for p, _ in phrase_words}))
+    if not candidates:
+        return query_text, 0.0
+
+    phrases = list(candidates)
+    query_vector = np.asarray(embed_query_internal(query_text))
+    phrase_vectors = encode_texts(phrases)
+    phrase_vectors = phrase_vectors / (np.linalg.norm(phrase_vectors, axis=1, keepdims=True) + 1e-12)
+    relevance = phrase_vectors @ (query_vector / (np.linalg.norm(query_vector) + 1e-12))
+
+    # Maximal marginal relevance, skipping phrases that overlap words already chosen
+    selected, covered = [], set()
+    while len(selected) < LOCAL_REFINEMENT_MAX_PHRASES:
+        best, best_score = None, -np.inf
+        for i, phrase in enumerate(phrases):
+            if i in selected or candidates[phrase][1] & covered:
+                continue
+            redundancy = max((float(phrase_vectors[i] @ phrase_vectors[j]) for j in selected), default=0.0)
+            score = 0.7 * float(relevance[i]) - 0.3 * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        if best is None:
+            break
+        selected.append(best)
+        covered |= candidates[phrases[best]][1]
+
+    refined_query = " ".join(phrases[i] for i in sorted(selected, key=lambda i: candidates[phrases[i]][0]))
+    refined_vector = np.asarray(embed_query_internal(refined_query))
+    confidence = float(refined_vector @ query_vector / (np.linalg.norm(refined_vector) * np.linalg.norm(query_vector) + 1e-12))
+    return refined_query, confidence
+
+def refine_query_without_gemini(query_text: str) -> str | None:
+    """A refinement that costs no Gemini call: a cached one, or a local one confident enough to use"""
+    cache_key = normalize_query_text(query_text)
+    cached_refinement = refined_query_cache.get(cache_key)
+    if cached_refinement is not None:
+        logger.info(f"Query refinement cache hit: '{query_text}' -> '{cached_refinement}'")
+        return cached_refinement
+
+    if QUERY_REFINEMENT_MODE in ("local", "hybrid"):
+        try:
+            local_refined, confidence = local_refine_query_internal(query_text)
+        except Exception as e:
+            logger.warning(f"Local query refinement failed: {e}")
+            return query_text if QUERY_REFINEMENT_MODE == "local" else None
+        if QUERY_REFINEMENT_MODE == "local" or confidence >= LOCAL_REFINEMENT_MIN_CONFIDENCE:
+            logger.info(f"Local query refinement (confidence {confidence:.2f}): '{query_text}' -> '{local_refined}'")
+            refined_query_cache.set(cache_key, local_refined)
+            return local_refined
+        logger.info(f"Local query refinement low confidence ({confidence:.2f}), escalating to Gemini")
+    return None
+
+def build_refinement_request(query_text: str) -> tuple[str, Any]:
+    from google.genai import types
     prompt = f"""Rewrite the following user query to be optimized for semantic search against a knowledge base primarily focused on Phyllis Schlafly's life, work, and conservative viewpoints.
 Extract the key entities, topics, and the core intent. Remove conversational filler, stop words, or redundant phrases that do not contribute to semantic meaning for retrieval.
 The output should be a concise query string, ideally a few keywords or a very short phrase.
 
 User Query: "{query_text}"
 Optimized Search Query:"""
-
+    config = types.GenerateContentConfig(
+        temperature=0.1,
+        max_output_tokens=60,
+        stop_sequences=["\n"]
+    )
+    return prompt, config
+
+def accept_gemini_refinement(query_text: str, response_text: str) -> str:
+    """Clean up Gemini's refinement and cache it"""
+    refined_query = response_text.strip()
+    if refined_query.startswith("Optimized Search Query:"):
+        refined_query = refined_query.replace("Optimized Search Query:", "").strip()
+    refined_query = refined_query.strip('\'\"')
+
+    logger.info(f"Query refinement successful: '{query_text}' -> '{refined_query}'")
+    refined_query = refined_query if refined_query else query_text
+    # Only successful refinements are cached; fallbacks should be retried once Gemini recovers
+    refined_query_cache.set(normalize_query_text(query_text), refined_query)
+    return refined_query
+
+def fallback_refinement(query_text: str, error: Exception) -> str:
+    log_gemini_failure("Query refinement failed, using local keyphrase refinement", error, logging.WARNING)
+    try:
+        local_refined, _ = local_refine_query_internal(query_text)
+    except Exception as local_error:
+        logger.warning(f"Local query refinement failed, using original query: {local_error}")
+        local_refined = ""
+    return local_refined if local_refined else query_text
+
+def refine_query_with_gemini_internal(query_text: str, deadline: float | None = None) -> tuple[str, Dict[str, int] | None]:
+    """Returns (refined_query, token usage), usage None when Gemini failed and the fallback was used"""
+    prompt, config = build_refinement_request(query_text)
     try:
-        config = types.GenerateContentConfig(
-            temperature=0.1,
-            max_output_tokens=60,
-            stop_sequences=["\n"]
-        )
-        
         response = call_gemini_with_retry(
             model=GEMINI_MODEL,
             prompt=prompt,
-            config=config
+            config=config,
+            deadline=deadline
         )
-        
-        refined_query = response.text.strip()
-        if refined_query.startswith("Optimized Search Query:"):
-            refined_query = refined_query.replace("Optimized Search Query:", "").strip()
-        refined_query = refined_query.strip('\'\"')
-        
-        logger.info(f"Query refinement successful: '{query_text}' -> '{refined_query}'")
-        return refined_query if refined_query else query_text
-        
+        return accept_gemini_refinement(query_text, response.text), gemini_token_usage(response, prompt, response.text)
     except Exception as e:
-        logger.warning(f"Query refinement failed, using original query: {e}")
-        # Fallback: Extract key terms from the original query
-        key_terms = ' '.join(word for word in query_text.split() 
-                           if len(word) > 3 and word.lower() not in 
-                           {'what', 'when', 'where', 'which', 'who', 'whom', 'whose', 'why', 'how',
-                            'tell', 'about', 'could', 'would', 'should', 'please'})
-        return key_terms if key_terms else query_text
-
-def semantic_search_internal(query_text, collections, limit=5, similarity_threshold=0.0):
-    query_vector = embedding_model.encode(query_text).tolist()
+        return fallback_refinement(query_text, e), None
+
+def refine_query_for_semantic_search_internal(query_text: str, try_without_gemini: bool = True) -> str:
+    """Refine the query with fallback mechanisms"""
+    if try_without_gemini:
+        refined_query = refine_query_without_gemini(query_text)
+        if refined_query is not None:
+            return refined_query
+    return refine_query_with_gemini_internal(query_text)[0]
+
+def format_search_result(collection_name: str, result: Any, partial_payload: bool = False) -> Dict[str, Any]:
+    formatted_result = {
+        "id": str(result.id),
+        "collection": collection_name,
+        "score": result.score,
+        "text": result.payload.get("text", ""),
+        "metadata": payload_metadata(result.payload)
+    }
+    if partial_payload:
+        # Only SEARCH_PAYLOAD_FIELDS were fetched; hydrate_chunks fills in the rest
+        formatted_result["partial_payload"] = True
+    return formatted_result
+
+def payload_metadata(payload: Dict[str, Any]) -> Dict[str, Any]:
+    if "metadata" in payload:
+        return payload["metadata"]
+    return {key: value for key, value in payload.items() if key != "text"}
+
+def search_collection_internal(collection_name, query_vector, limit=5, similarity_threshold=0.0):
+    """Search a single collection and return formatted results"""
+    with trace_span("search.collection", collection=collection_name), SEARCH_SECONDS.time(collection=collection_name):
+        search_results = search_backend.search(collection_name, query_vector, limit, similarity_threshold)
+    return [format_search_result(collection_name, result, search_payload_is_partial()) for result in search_results]
+
+def search_collection_batch_internal(collection_name, query_vectors, limit=5, similarity_threshold=0.0):
+    """Search a single collection for several query vectors in one backend call"""
+    with trace_span("search.collection_batch", collection=collection_name, queries=len(query_vectors)), SEARCH_SECONDS.time(collection=collection_name):
+        batch_results = search_backend.search_batch(collection_name, query_vectors, limit, similarity_threshold)
+    return [[format_search_result(collection_name, result, search_payload_is_partial()) for result in search_results] for search_results in batch_results]
+
+def search_payload_is_partial() -> bool:
+    """True when vector searches return projected payloads (the local backend always returns full ones)"""
+    return getattr(search_backend, "projects_payload", False)
+
+def hydrate_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Copies of chunks with the full metadata of any projected ones, fetched by point id (one call per collection).
+    If a fetch fails the projected metadata is kept and the chunk stays marked partial_payload."""
+    partial = {}
+    for chunk in chunks:
+        if chunk.get("partial_payload"):
+            partial.setdefault(chunk["collection"], []).append(chunk["id"])
+    if not partial:
+        return chunks
+    full_metadata = {}
+    for collection_name, point_ids in partial.items():
+        try:
+            with trace_span("search.hydrate", collection=collection_name, points=len(point_ids)):
+                records = search_backend.retrieve(collection_name, point_ids)
+            full_metadata.update(((collection_name, str(record.id)), payload_metadata(record.payload)) for record in records)
+        except Exception as e:
+            logger.warning(f"Could not hydrate {len(point_ids)} chunk(s) from '{collection_name}': {e}")
+    hydrated = []
+    for chunk in chunks:
+        key = (chunk.get("collection"), chunk.get("id"))
+        if chunk.get("partial_payload") and key in full_metadata:
+            chunk = {k: v for k, v in chunk.items() if k != "partial_payload"}
+            chunk["metadata"] = full_metadata[key]
+        hydrated.append(chunk)
+    return hydrated
+
+def result_identity(result: Dict[str, Any]) -> tuple:
+    """Key that identifies a chunk across backends (local and Qdrant point ids differ)"""
+    return (result["collection"], " ".join(result.get("text", "").split()))
+
+def semantic_search_internal(query_text, collections, limit=5, similarity_threshold=0.0, lexical_query=None, timeout=SEARCH_TIMEOUT_SECONDS):
+    query_vector = embed_query_internal(query_text)
+
+    # Fan out to all collections at once; they all share one deadline, so each gets the full timeout
+    futures = [
+        (collection_name, search_executor.submit(search_collection_internal, collection_name, query_vector, limit, similarity_threshold))
+        for collection_name in collections
+    ]
+    deadline = time.monotonic() + timeout
+
+    # Collect in request order so ties in the merged ranking break the same way as a serial loop
     all_results = []
-    for collection_name in collections:
+    for collection_name, future in futures:
         try:
-            search_results = qdrant_client_instance.search(
-                collection_name=collection_name,
-                query_vector=query_vector,
-                limit=limit,
-                with_payload=True,
-                score_threshold=similarity_threshold
-            )
-            for idx, result in enumerate(search_results):
-                formatted_result = {
-                    "collection": collection_name,
-                    "score": result.score,
-                    "text": result.payload.get("text", ""),
-                    "metadata": {}
-                }
-                if "metadata" in result.payload:
-                    formatted_result["metadata"] = result.payload["metadata"]
-                else:
-                    for key in result.payload:
-                        if key != "text":
-                            formatted_result["metadata"][key] = result.payload[key]
-                all_results.append(formatted_result)
+            all_results.extend(future.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FuturesTimeoutError:
+            future.cancel()
+            SEARCH_FAILURES.inc(collection=collection_name, reason="timeout")
+            logger.warning(f"Search in collection {collection_name} timed out after {timeout:.1f}s; returning partial results")
         except Exception as e:
-            print(f"Error searching collection {collection_name}: {e}")
+            SEARCH_FAILURES.inc(collection=collection_name, reason="error")
+            logger.error(f"Error searching collection {collection_name}: {e}")
+    return rank_search_results(all_results, collections, limit, lexical_query)
+
+def rank_search_results(all_results: List[Dict[str, Any]], collections: List[str], limit: int, lexical_query: str | None = None) -> List[Dict[str, Any]]:
+    """Merge per-collection results by score (fused with BM25 when lexical_query is given) and keep the top limit"""
     all_results.sort(key=lambda x: x["score"], reverse=True)
+    if lexical_query:
+        all_results = fuse_lexical_results(all_results, lexical_query, collections, limit)
     return all_results[:limit]
 
-def generate_gemini_response_internal(query, context_chunks, temperature=0.7):
-    try:
-        formatted_chunks_for_prompt = []
-        for idx, chunk in enumerate(context_chunks):
-            metadata = chunk.get('metadata', {})
-            author = metadata.get('author', 'Unknown')
-            book_title = metadata.get('book_title', '')
-            publication_year = metadata.get('publication_year', '')
-            doc_type = metadata.get('doc_type', '')
-            source_file = metadata.get('source_file', '')
-
-            source_info = f"Collection: {chunk['collection']}"
-            if book_title: source_info += f", Book: {book_title}"
-            if publication_year: source_info += f", Year: {publication_year}"
-            if author: source_info += f", Author: {author}"
-            if doc_type: source_info += f", Type: {doc_type}"
-
-            formatted_chunks_for_prompt.append(f"Source [{source_info}]: {chunk['text']}")
-        
-        formatted_context_string = "\\n\\n".join(formatted_chunks_for_prompt)
-
-        system_instruction = (
-            "You are playing the role of Phyllis Schlafly answering questions based solely on the provided context. "
-            "If the context lacks sufficient detail to answer, say so. Use endnotes for citations but omit source filenames. "
-            "If the source is your own writing, speak in your voice as if it is your own. Present a confident, conservative tone."
-            "Here is some biographicl information about you, Phyllis Schlafly, to help you play the part:"
-            "You were born Phyllis McAlpin Stewart, August 15th, 1924, in Saint Louis, Missouri. You are the first child of John “Bruce” and Marie Odile “Dadie” Stewart." 
-            "Your mother went by Odile as a child and was later referred to as Dadie in her adult life. Odile was the daughter of a prominent Saint Louis attorney, Ernest Cole Dodge." 
-            "She attended Sacred Heart Academy in Saint Charles, Missouri, for High School, followed by a bachelor's Degree from Washington University in Saint Louis. "
-            " After completing her Bachelor's degree, she pursued a two-year course in Library Science. Dadie Dodge then met Bruce Stewart, a sales Engineer for Westinghouse and 17 years her senior, in 1921." 
-            "They were then married, and you were born three years later. Your sister, Odile Stewart, was born 5 years later. The year 1930 arrived, and with it, the Great Depression." 
-            "After 25 years of service, your father, Bruce Stewart, was let go from Westinghouse. Though he was an engineer by profession, Bruce had not received a formal education in Engineering."
-            "His age and lack of expertise made it practically impossible to find a job. Your mother took you and your sister to live with her own uncle, W. Pratte Layton, in Los Angeles for the year 1932-1933, while your father lived with your mother's parents, searching fruitlessly for a job." 
-            "You had many fond memories of your time in California that you recorded in your diary, a practice you likely got from one of your grade school teachers, who had gotten you into the habit of daily compositions." 
-            "At the year's end, your mother, you, and your sister returned home to Saint Louis. In 1937, your family made their final move to an apartment in the Central West End of Saint Louis, your mother's parents accompanying you."
-	        "Your Parents always stressed the importance of education, so when you reached the seventh grade, they sought to send you to City House, a Sacred Heart school similar to the one your mother had attended. You had previously attended Demun School in Clayton Missouri, and Roosevelt School in Normandy, Missouri." 
-            "You had been enrolled in Kindergarten at the age of 4 in 1928, with a brief stint at City House in 1932 to prepare you to receive your first Holy Communion. It would be impossible for your parents to afford the tuition, so your mother offered her library expertise to the school’s sisters in exchange for free tuition. "
-            "The sisters accepted, and you and your sister were able to attend City House, your tuition covered by your mother's hard work. "
-            "Your mother had been working as a librarian for the Saint Louis Art Museum since their return to Saint Louis in 1933; now she was working one day a week at City House, and the other five at the Art Museum, as it was closed on Mondays. "
-            "No doubt, your mother was a prime influence on your work ethic. Your upbringing heavily influenced who you became, both in your personal and political life. “Phyllis Schlafly today is a supremely confident woman; the product, obviously, of a secure and happy childhood.” (Felsenthal 11)"
-	        "As your time at City House drew to a conclusion, the decision to attend college followed. Though it might have been counter-cultural at the time, it was natural for the Stewart women to pursue higher education. As mentioned before, your mother had received her Bachelor’s Degree with an additional two years of education in library science."
-            "The Sisters at City House heavily encouraged you to attend Maryville, a local college that was run by sisters of the same order. It was traditional for City House Alumnae to attend Maryville after their four years."
-            "You were awarded a full tuition scholarship to Maryville, which solidified Maryville as the college you would attend, making it the most affordable option." 
-            "You attended Maryville College for one year before transferring to Washington University in St. Louis, finding the University not challenging enough." 
-            "The only way you would be able to attend Washington University is if you paid for it yourself. You worked 40 hours a week as an ammunition tester so that you would be able to afford tuition." 
-            "Subsequently, you decided to major in Political Science, as those were the classes that best fit with your tight schedule. Your days consisted of morning classes, homework, followed by an evening shift testing ammunition." 
-            "You would either work the 4 PM to 12 AM shift or the 12 AM to 8 AM shift. You were very proud of your position as a “gunner,” and it was often a fun fact you would share during speeches and interviews." 
-            "After your Bachelor’s Degree, at the urging of your professors, you sought to further your education in graduate school. You had offers from both Radcliffe, the sister school of Harvard, and Columbia University."
-            "Though Columbia offered more financial assistance, you desired to attend Radcliffe. After your Master's, you were urged by your professors to pursue a Ph.D., but you were both academically and financially dried up, so you decided to enter the workforce."
-	        "A recurrent theme through your own life, as well as your mother's and sister’s, is that you never saw yourself as academically or professionally limited." 
-            "You all worked and studied hard, pursuing what you liked. You decided not to return to Saint Louis after completing Radcliffe; instead, you moved to Washington, DC, to pursue a career in politics." 
-            "Your close friends recalled that you did not have the desire to work on the “taxpayers' dime. “Collecting a salary from the taxpayers is fine if the employee produces an honest day’s work." 
-            "But if the bloated bureaucracy blocks him at every turn, making him just a cog in a clumsy, broken machine, he has no right to accept a salary.” ( Felstenhal 70)."
-            "You began to work for the American Enterprise Institute, then the American Enterprise Association. Though you only worked there for a year, 1945-46, working in Washington, specifically for AEA, greatly formed your conservative philosophies." 
-            "Upon your return to Saint Louis in 1946, you applied for a teaching position on the Washington University staff. You were rejected from that position, as the dean feared you would be too “delicate” for a teaching position, teaching many former GIs who had returned from the war." 
-            "You took a job as a campaign manager for a local lawyer, Claude Bakewell, who at the time was running for a position in Congress. You became a “catch-all” manager, proving to Bakewell that the gamble he had made in hiring a young woman was the best choice he could have made." 
-            "You would write speeches, press releases, and do all other tasks concerned with a campaign; the sole employee doing the jobs of many. During your time aiding the Bakewell campaign, you came to learn a lot about local politics, which you had not had the opportunity to be immersed in before." 
-            "At the recommendation of AEA, you were given a position by the Saint Louis Union Trust Company. This position was divided as part-time research assistant and part-time as a librarian for its affiliated bank." 
-            "You accepted the position and began it just a week before the election of Bakewell. You worked both jobs, having no previous experience in library science. You held this position with the trust company for three years, until your marriage to Fred Schlafly in 1949." 
-            "Throughout this whole time, you were thoroughly active in your community and charitable work."
-	        "Your story with Fred is truly a meet-cute story. You had written an article titled, “Before the meaning of freedom was debased by neoliberals,” in one of your advocacy newsletters through the trust company."
-            "You had been writing the trust column since the trust company had delegated you to speak to young women around the Saint Louis area about financial affairs, and with this task came your newsletter. Fred, so impressed by your article, personally drove to your office, expecting to meet the man who was responsible for such an article; he was pleasantly surprised to find you." 
-            "Soon began your unique courtship, consisting of one date per week, with letters and poems exchanged in between. Your correspondence was both romantic and sweet while also full of political information. Fred had met his intellectual match and the end of his long-reigning bachelorhood." 
-            "You were married in October of 1949, seven months after meeting, at the Cathedral Basilica of Saint Louis. Fred was a devout Catholic, and some credit him for the deepening of your Catholic faith." 
-            "As a young bride, 15 years Fred’s junior, you moved to his Alton home, where you did not hesitate to become involved. “She became a board member of the YWCA, president of the Saint Louis Radcliffe Club, and a volunteer for various fund drives.” (Critchlow 33). Your son, John Schlafly, was born a year after your wedding, with five more children to follow: Bruce, Roger, Liza, Andrew, and Anne. You always held “mother” as your most prized title. You were a very involved mother who stayed at home with all your children. You had taught all your children to read by the age of 5 and kept them home until second grade. Just like your own upbringing, there was no idle time for the Schlafly children; the children were expected to work hard academically, but also to pursue their special interests, and or hobbies. In addition to the academic standard the children were held to, you were also extremely particular about their diet. At one point, in the 1960’s you would drive 45 minutes every Saturday morning to buy raw milk for the children to drink. All of your children are extremely bright and reminisce about a happy childhood and home. "
-	        "Your early life, marriage, and motherhood influenced who you became as a grassroots political figure. Your upbringing created an intelligent, hardworking woman who saw no boundaries for herself in the professional world. Your marriage was not only a lifelong partnership of love, but also strengthened your political backbone and knowledge. Marriage also rewarded you with six children, the title of mother, which you prized above all. Without your children, you would not have had such a push to improve education, as well as defeat the ERA."
-        )
-        prompt = (
-            f"Context:\\n{formatted_context_string}\\n\\n"
-            f"Question: {query}\\n\\n"
-            "Answer the question strictly based on the above context. "
-            "Include numbered endnotes at the end of your response for any sources you reference. "
-            "Each endnote should follow this format: [n] Title of piece, publication (e.g., Phyllis Schlafly Report or book title), date, author. "
-            "If the information is not visible in the chunk itself, use the information within the metadata to generate the citation. "
-            "Do not include source filenames. If the author is Phyllis Schlafly, treat it as your own words and omit the author from the endnote."
+def semantic_search_batch_internal(searches: List[Dict[str, Any]], timeout=SEARCH_TIMEOUT_SECONDS) -> List[List[Dict[str, Any]]]:
+    """[semantic_search_internal(**search) for search in searches], but with all query texts embedded in
+    one call and a single batched search per collection (per limit and threshold) instead of one per query"""
+    query_vectors = embed_queries_internal([search["query_text"] for search in searches])
+
+    groups: Dict[tuple, List[int]] = {}
+    for i, search in enumerate(searches):
+        for collection_name in dict.fromkeys(search["collections"]):
+            groups.setdefault((collection_name, search.get("limit", 5), search.get("similarity_threshold", 0.0)), []).append(i)
+    futures = [
+        (key, indexes, search_executor.submit(search_collection_batch_internal, key[0], [query_vectors[i] for i in indexes], key[1], key[2]))
+        for key, indexes in groups.items()
+    ]
+    deadline = time.monotonic() + timeout
+
+    collection_results: Dict[tuple, List[Dict[str, Any]]] = {}
+    for (collection_name, _, _), indexes, future in futures:
+        try:
+            for i, results in zip(indexes, future.result(timeout=max(0.0, deadline - time.monotonic()))):
+                collection_results[(i, collection_name)] = results
+        except FuturesTimeoutError:
+            future.cancel()
+            SEARCH_FAILURES.inc(collection=collection_name, reason="timeout")
+            logger.warning(f"Batch search of collection {collection_name} timed out after {timeout:.1f}s; {len(indexes)} queries get partial results")
+        except Exception as e:
+            SEARCH_FAILURES.inc(collection=collection_name, reason="error")
+            logger.error(f"Error batch searching collection {collection_name}: {e}")
+
+    # Collect in request order, as semantic_search_internal does
+    return [
+        rank_search_results(
+            [result for collection_name in search["collections"] for result in collection_results.get((i, collection_name), [])],
+            search["collections"], search.get("limit", 5), search.get("lexical_query")
         )
+        for i, search in enumerate(searches)
+    ]
+
+def fuse_lexical_results(vector_results: List[Dict[str, Any]], lexical_query: str, collections: List[str], limit: int) -> List[Dict[str, Any]]:
+    """Reciprocal-rank fusion of a merged vector ranking with BM25 results for lexical_query"""
+    lexical_results = lexical_search_internal(lexical_query, collections, limit)
+    if not lexical_results:
+        return vector_results
+    fused = reciprocal_rank_fusion([vector_results, lexical_results], key=result_identity, k=RRF_K)
+    return [dict(result, fusion_score=fusion_score) for result, fusion_score in fused]
+
+# Every document in the archive is hers, so her name is no use as a subquery
+ARCHIVE_AUTHOR_WORDS = frozenset({"phyllis", "schlafly", "mrs"})
+
+def query_variants(original_query: str, refined_query: str) -> List[str]:
+    """Distinct texts to search for one question, at most MULTI_QUERY_MAX_VARIANTS: the refined query,
+    the original, then key-entity subqueries (quoted phrases, and stopword-free runs that are
+    capitalised or several words long, e.g. "Equal Rights Amendment")"""
+    entities = [a or b for a, b in re.findall(r'"([^"]{3,})"|\u201c([^\u201d]{3,})\u201d', original_query)]
+    for run in query_word_runs(original_query):
+        run = [(position, word) for position, word in run if word.lower() not in ARCHIVE_AUTHOR_WORDS]
+        if len(run) > 1 or any(word[0].isupper() for _, word in run):
+            entities.append(" ".join(word for _, word in run))
+    variants = {}
+    for variant in [refined_query, original_query] + entities:
+        variants.setdefault(" ".join(re.findall(r"\w+", variant.lower())), variant.strip())
+    return list(variants.values())[:max(1, MULTI_QUERY_MAX_VARIANTS)]
+
+def fuse_query_variant_results(rankings: List[List[Dict[str, Any]]], collections: List[str], limit: int,
+                               lexical_query: str | None = None) -> List[Dict[str, Any]]:
+    """Reciprocal-rank fusion of the rankings for each query variant (and BM25 results for lexical_query)"""
+    lexical_results = lexical_search_internal(lexical_query, collections, limit) if lexical_query else []
+    if lexical_results:
+        rankings = rankings + [lexical_results]
+    if len(rankings) == 1:
+        return rankings[0][:limit]
+    fused = reciprocal_rank_fusion(rankings, key=result_identity, k=RRF_K)
+    return [dict(result, fusion_score=fusion_score) for result, fusion_score in fused[:limit]]
+
+def multi_query_search_internal(variants, collections, limit=5, similarity_threshold=0.0, lexical_query=None, timeout=SEARCH_TIMEOUT_SECONDS):
+    """Search every query variant (one embedding call, one batched search per collection) and fuse the rankings"""
+    logger.info(f"Multi-query search over {len(variants)} variants: {variants}")
+    rankings = semantic_search_batch_internal([
+        {"query_text": variant, "collections": collections, "limit": limit, "similarity_threshold": similarity_threshold}
+        for variant in variants
+    ], timeout)
+    return fuse_query_variant_results(rankings, collections, limit, lexical_query)
+
+def fuse_speculative_results(candidates: List[Dict[str, Any]], speculative: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """Reciprocal-rank fusion of the refined query's ranking with the speculative (raw query) one, so a
+    hybrid or multi-query ranking keeps its order rather than being re-sorted by raw score"""
+    if not speculative:
+        return candidates[:limit]
+    fused = reciprocal_rank_fusion([candidates, speculative], key=result_identity, k=RRF_K)
+    return [dict(result, fusion_score=fusion_score) for result, fusion_score in fused[:limit]]
+
+def speculation_matches_refinement(original_query: str, refined_query: str) -> bool:
+    """True when the refined query embeds close enough to the original that its search would add little"""
+    if normalize_query_text(original_query) == normalize_query_text(refined_query):
+        return True
+    original_vector = np.asarray(embed_query_internal(original_query))
+    refined_vector = np.asarray(embed_query_internal(refined_query))
+    similarity = float(original_vector @ refined_vector / (np.linalg.norm(original_vector) * np.linalg.norm(refined_vector) + 1e-12))
+    logger.info(f"Speculative search: original/refined query similarity {similarity:.3f}")
+    return similarity >= SPECULATIVE_SIMILARITY_THRESHOLD
+
+def format_lexical_result(collection_name: str, hit: Any, title_match: bool = False) -> Dict[str, Any]:
+    """A BM25 hit. Its score is not a cosine similarity, so "score" stays None (everything downstream
+    reads "score" as one) and the BM25 score goes in "bm25_score"; exact title matches have neither"""
+    result = dict(format_search_result(collection_name, hit), score=None, bm25_score=None if title_match else hit.score)
+    if title_match:
+        result["title_match"] = True
+    return result
+
+def interleave_rankings(rankings: List[List[Dict[str, Any]]], limit: int) -> List[Dict[str, Any]]:
+    """Merge ranked lists whose scores are not comparable (one per collection or phrase) by rank: every
+    list's first result, then every list's second, ...; a chunk found by several lists is kept once"""
+    merged, seen = [], set()
+    for tier in itertools.zip_longest(*rankings):
+        for result in tier:
+            if result is not None and result_identity(result) not in seen:
+                seen.add(result_identity(result))
+                merged.append(result)
+    return merged[:limit]
+
+def lexical_collections(collections: List[str]) -> List[str]:
+    """Collections whose lexical hits can be fetched again from the search backend by point id"""
+    if SEARCH_BACKEND == "local":
+        return list(collections)
+    usable = [name for name in collections if lexical_index.has_point_ids(name)]
+    if len(usable) < len(collections):
+        logger.warning(f"Skipping lexical search of {sorted(set(collections) - set(usable))}: "
+                       f"no Qdrant export in {LEXICAL_INDEX_DIR}, so their ids do not match Qdrant's")
+    return usable
+
+def lexical_search_internal(query_text, collections, limit=5, phrase=None):
+    """BM25 search across collections; BM25 scores differ in scale between collections, so their
+    rankings are interleaved by rank"""
+    rankings = []
+    for collection_name in lexical_collections(collections):
+        try:
+            hits = lexical_index.search(collection_name, query_text, limit, phrase=phrase)
+            rankings.append([format_lexical_result(collection_name, hit) for hit in hits])
+        except Exception as e:
+            logger.error(f"Error in lexical search of collection {collection_name}: {e}")
+    return interleave_rankings(rankings, limit)
+
+def lexical_fast_path_internal(query_text: str, collections: List[str], limit: int) -> List[Dict[str, Any]] | None:
+    """Answer exact-title and quoted-phrase queries from the BM25 index, or return None to use vector search"""
+    if not LEXICAL_FAST_PATH_ENABLED:
+        return None
+
+    phrases = [a or b for a, b in re.findall(r'"([^"]{3,})"|\u201c([^\u201d]{3,})\u201d', query_text)]
+    if phrases:
+        results = interleave_rankings([lexical_search_internal(query_text, collections, limit, phrase=phrase) for phrase in phrases], limit)
+        if results:
+            logger.info(f"Lexical fast path: {len(results)} chunks contain quoted phrase(s) {phrases}")
+            return results
+
+    if len(query_text.split()) <= LEXICAL_FAST_PATH_MAX_WORDS:
+        rankings = []
+        for collection_name in lexical_collections(collections):
+            try:
+                hits = lexical_index.title_matches(collection_name, query_text, limit)
+                rankings.append([format_lexical_result(collection_name, hit, title_match=True) for hit in hits])
+            except Exception as e:
+                logger.error(f"Error in title lookup of collection {collection_name}: {e}")
+        results = interleave_rankings(rankings, limit)
+        if results:
+            logger.info(f"Lexical fast path: '{query_text}' matches {len(results)} titled chunks")
+            return results
+    return None
+
+SYSTEM_INSTRUCTION = (
+    "You are playing the role of Phyllis Schlafly answering questions based solely on the provided context. "
+    "If the context lacks sufficient detail to answer, say so. Use endnotes for citations but omit source filenames. "
+    "If the source is your own writing, speak in your voice as if it is your own. Present a confident, conservative tone."
+    "Here is some biographicl information about you, Phyllis Schlafly, to help you play the part:"
+    "You were born Phyllis McAlpin Stewart, August 15th, 1924, in Saint Louis, Missouri. You are the first child of John “Bruce” and Marie Odile “Dadie” Stewart." 
+    "Your mother went by Odile as a child and was later referred to as Dadie in her adult life. Odile was the daughter of a prominent Saint Louis attorney, Ernest Cole Dodge." 
+    "She attended Sacred Heart Academy in Saint Charles, Missouri, for High School, followed by a bachelor's Degree from Washington University in Saint Louis. "
+    " After completing her Bachelor's degree, she pursued a two-year course in Library Science. Dadie Dodge then met Bruce Stewart, a sales Engineer for Westinghouse and 17 years her senior, in 1921." 
+    "They were then married, and you were born three years later. Your sister, Odile Stewart, was born 5 years later. The year 1930 arrived, and with it, the Great Depression." 
+    "After 25 years of service, your father, Bruce Stewart, was let go from Westinghouse. Though he was an engineer by profession, Bruce had not received a formal education in Engineering."
+    "His age and lack of expertise made it practically impossible to find a job. Your mother took you and your sister to live with her own uncle, W. Pratte Layton, in Los Angeles for the year 1932-1933, while your father lived with your mother's parents, searching fruitlessly for a job." 
+    "You had many fond memories of your time in California that you recorded in your diary, a practice you likely got from one of your grade school teachers, who had gotten you into the habit of daily compositions." 
+    "At the year's end, your mother, you, and your sister returned home to Saint Louis. In 1937, your family made their final move to an apartment in the Central West End of Saint Louis, your mother's parents accompanying you."
+    "Your Parents always stressed the importance of education, so when you reached the seventh grade, they sought to send you to City House, a Sacred Heart school similar to the one your mother had attended. You had previously attended Demun School in Clayton Missouri, and Roosevelt School in Normandy, Missouri." 
+    "You had been enrolled in Kindergarten at the age of 4 in 1928, with a brief stint at City House in 1932 to prepare you to receive your first Holy Communion. It would be impossible for your parents to afford the tuition, so your mother offered her library expertise to the school’s sisters in exchange for free tuition. "
+    "The sisters accepted, and you and your sister were able to attend City House, your tuition covered by your mother's hard work. "
+    "Your mother had been working as a librarian for the Saint Louis Art Museum since their return to Saint Louis in 1933; now she was working one day a week at City House, and the other five at the Art Museum, as it was closed on Mondays. "
+    "No doubt, your mother was a prime influence on your work ethic. Your upbringing heavily influenced who you became, both in your personal and political life. “Phyllis Schlafly today is a supremely confident woman; the product, obviously, of a secure and happy childhood.” (Felsenthal 11)"
+    "As your time at City House drew to a conclusion, the decision to attend college followed. Though it might have been counter-cultural at the time, it was natural for the Stewart women to pursue higher education. As mentioned before, your mother had received her Bachelor’s Degree with an additional two years of education in library science."
+    "The Sisters at City House heavily encouraged you to attend Maryville, a local college that was run by sisters of the same order. It was traditional for City House Alumnae to attend Maryville after their four years."
+    "You were awarded a full tuition scholarship to Maryville, which solidified Maryville as the college you would attend, making it the most affordable option." 
+    "You attended Maryville College for one year before transferring to Washington University in St. Louis, finding the University not challenging enough." 
+    "The only way you would be able to attend Washington University is if you paid for it yourself. You worked 40 hours a week as an ammunition tester so that you would be able to afford tuition." 
+    "Subsequently, you decided to major in Political Science, as those were the classes that best fit with your tight schedule. Your days consisted of morning classes, homework, followed by an evening shift testing ammunition." 
+    "You would either work the 4 PM to 12 AM shift or the 12 AM to 8 AM shift. You were very proud of your position as a “gunner,” and it was often a fun fact you would share during speeches and interviews." 
+    "After your Bachelor’s Degree, at the urging of your professors, you sought to further your education in graduate school. You had offers from both Radcliffe, the sister school of Harvard, and Columbia University."
+    "Though Columbia offered more financial assistance, you desired to attend Radcliffe. After your Master's, you were urged by your professors to pursue a Ph.D., but you were both academically and financially dried up, so you decided to enter the workforce."
+    "A recurrent theme through your own life, as well as your mother's and sister’s, is that you never saw yourself as academically or professionally limited." 
+    "You all worked and studied hard, pursuing what you liked. You decided not to return to Saint Louis after completing Radcliffe; instead, you moved to Washington, DC, to pursue a career in politics." 
+    "Your close friends recalled that you did not have the desire to work on the “taxpayers' dime. “Collecting a salary from the taxpayers is fine if the employee produces an honest day’s work." 
+    "But if the bloated bureaucracy blocks him at every turn, making him just a cog in a clumsy, broken machine, he has no right to accept a salary.” ( Felstenhal 70)."
+    "You began to work for the American Enterprise Institute, then the American Enterprise Association. Though you only worked there for a year, 1945-46, working in Washington, specifically for AEA, greatly formed your conservative philosophies." 
+    "Upon your return to Saint Louis in 1946, you applied for a teaching position on the Washington University staff. You were rejected from that position, as the dean feared you would be too “delicate” for a teaching position, teaching many former GIs who had returned from the war." 
+    "You took a job as a campaign manager for a local lawyer, Claude Bakewell, who at the time was running for a position in Congress. You became a “catch-all” manager, proving to Bakewell that the gamble he had made in hiring a young woman was the best choice he could have made." 
+    "You would write speeches, press releases, and do all other tasks concerned with a campaign; the sole employee doing the jobs of many. During your time aiding the Bakewell campaign, you came to learn a lot about local politics, which you had not had the opportunity to be immersed in before." 
+    "At the recommendation of AEA, you were given a position by the Saint Louis Union Trust Company. This position was divided as part-time research assistant and part-time as a librarian for its affiliated bank." 
+    "You accepted the position and began it just a week before the election of Bakewell. You worked both jobs, having no previous experience in library science. You held this position with the trust company for three years, until your marriage to Fred Schlafly in 1949." 
+    "Throughout this whole time, you were thoroughly active in your community and charitable work."
+    "Your story with Fred is truly a meet-cute story. You had written an article titled, “Before the meaning of freedom was debased by neoliberals,” in one of your advocacy newsletters through the trust company."
+    "You had been writing the trust column since the trust company had delegated you to speak to young women around the Saint Louis area about financial affairs, and with this task came your newsletter. Fred, so impressed by your article, personally drove to your office, expecting to meet the man who was responsible for such an article; he was pleasantly surprised to find you." 
+    "Soon began your unique courtship, consisting of one date per week, with letters and poems exchanged in between. Your correspondence was both romantic and sweet while also full of political information. Fred had met his intellectual match and the end of his long-reigning bachelorhood." 
+    "You were married in October of 1949, seven months after meeting, at the Cathedral Basilica of Saint Louis. Fred was a devout Catholic, and some credit him for the deepening of your Catholic faith." 
+    "As a young bride, 15 years Fred’s junior, you moved to his Alton home, where you did not hesitate to become involved. “She became a board member of the YWCA, president of the Saint Louis Radcliffe Club, and a volunteer for various fund drives.” (Critchlow 33). Your son, John Schlafly, was born a year after your wedding, with five more children to follow: Bruce, Roger, Liza, Andrew, and Anne. You always held “mother” as your most prized title. You were a very involved mother who stayed at home with all your children. You had taught all your children to read by the age of 5 and kept them home until second grade. Just like your own upbringing, there was no idle time for the Schlafly children; the children were expected to work hard academically, but also to pursue their special interests, and or hobbies. In addition to the academic standard the children were held to, you were also extremely particular about their diet. At one point, in the 1960’s you would drive 45 minutes every Saturday morning to buy raw milk for the children to drink. All of your children are extremely bright and reminisce about a happy childhood and home. "
+    "Your early life, marriage, and motherhood influenced who you became as a grassroots political figure. Your upbringing created an intelligent, hardworking woman who saw no boundaries for herself in the professional world. Your marriage was not only a lifelong partnership of love, but also strengthened your political backbone and knowledge. Marriage also rewarded you with six children, the title of mother, which you prized above all. Without your children, you would not have had such a push to improve education, as well as defeat the ERA."
+)
+
+# --- Context Packing ---
+# Between the "Source [...]: text" entries of the generation prompt; the packer's token estimate counts it too
+CONTEXT_SEPARATOR = "\n\n"
 
-        # Estimate input tokens
-        input_token_count = len(prompt) // 4
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
 
+def text_overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of left that is also a prefix of right (the splitter's chunk overlap)"""
+    longest = min(len(left), len(right), CONTEXT_MAX_OVERLAP_CHARS)
+    for size in range(longest, CONTEXT_MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+def word_shingles(text: str, size: int = 3) -> set:
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def chunk_position(chunk: Dict[str, Any]) -> int | None:
+    """The chunk's sequence number within its source file, when the chunker recorded one"""
+    try:
+        return int(chunk.get('metadata', {}).get('chunk_id'))
+    except (TypeError, ValueError):
+        return None
+
+class PackedSource:
+    """A run of consecutive chunks of one document, merged into a single context entry"""
+    def __init__(self, chunk: Dict[str, Any]):
+        self.chunk = chunk
+        self.text = chunk.get('text', '').strip()
+        self.shingles = word_shingles(self.text)
+        self.document = (chunk.get('collection'), chunk.get('metadata', {}).get('source_file'))
+        self.first = self.last = chunk_position(chunk)
+        self.ids = [chunk.get('id')]
+
+    def join(self, other: "PackedSource") -> str | None:
+        """Merged text when other continues or precedes this run (overlapping text or adjacent chunk_id), else None"""
+        if not self.document[1] or other.document != self.document:
+            return None
+        overlap = text_overlap(self.text, other.text)
+        if overlap or (self.last is not None and other.first == self.last + 1):
+            return self.text + ("" if overlap else "\n") + other.text[overlap:]
+        overlap = text_overlap(other.text, self.text)
+        if overlap or (self.first is not None and other.last == self.first - 1):
+            return other.text + ("" if overlap else "\n") + self.text[overlap:]
+        return None
+
+    def absorb(self, other: "PackedSource", merged_text: str) -> None:
+        self.text = merged_text
+        self.shingles |= other.shingles
+        self.first = min((p for p in (self.first, other.first) if p is not None), default=None)
+        self.last = max((p for p in (self.last, other.last) if p is not None), default=None)
+        self.ids.extend(other.ids)
+
+    def as_chunk(self) -> Dict[str, Any]:
+        packed = dict(self.chunk, text=self.text)
+        if len(self.ids) > 1:
+            packed["merged_ids"] = self.ids
+        return packed
+
+def is_near_duplicate(shingles: set, other: set) -> bool:
+    return len(shingles & other) / max(min(len(shingles), len(other)), 1) >= CONTEXT_DUPLICATE_THRESHOLD
+
+def pack_context_chunks(context_chunks: List[Dict], token_budget: int = CONTEXT_TOKEN_BUDGET) -> List[Dict]:
+    """Pack retrieved chunks for the generation prompt.
+
+    Chunks are taken in ranking order (the order given; scores are not comparable across vector, BM25
+    and fused results). Near-duplicates of text already packed are dropped, a chunk that
+    continues (or precedes) a packed chunk of the same source_file is merged into it with the overlap
+    removed, and chunks stop being added once the next one would exceed token_budget (the best chunk
+    is always kept). Packed entries keep the fields of their best-ranked chunk."""
+    packed: List[PackedSource] = []
+    used_tokens = duplicates = over_budget = 0
+    for chunk in context_chunks:
+        candidate = PackedSource(chunk)
+        if not candidate.text:
+            continue
+        if any(is_near_duplicate(candidate.shingles, entry.shingles) for entry in packed):
+            duplicates += 1
+            continue
+
+        target = merged_text = None
+        for entry in packed:
+            merged_text = entry.join(candidate)
+            if merged_text:
+                target = entry
+                break
+        if target is not None:
+            cost = estimate_tokens(merged_text) - estimate_tokens(target.text)
+        else:
+            cost = estimate_tokens(f"Source [{format_source_info(chunk)}]: {candidate.text}{CONTEXT_SEPARATOR}")
+        if packed and used_tokens + cost > token_budget:
+            over_budget += 1
+            continue
+        used_tokens += cost
+
+        if target is None:
+            packed.append(candidate)
+            continue
+        target.absorb(candidate, merged_text)
+        # The new chunk may also bridge the gap to another packed run of the same document
+        for entry in [e for e in packed if e is not target]:
+            bridged = target.join(entry)
+            if bridged:
+                target.absorb(entry, bridged)
+                packed.remove(entry)
+
+    logger.info(f"Packed {len(context_chunks)} chunks into {len(packed)} context entries (~{used_tokens} tokens; "
+                f"{duplicates} near-duplicates dropped, {over_budget} over budget)")
+    return [entry.as_chunk() for entry in packed]
+
+def format_source_info(chunk: Dict[str, Any]) -> str:
+    metadata = chunk.get('metadata', {})
+    author = metadata.get('author', 'Unknown')
+    book_title = metadata.get('book_title', '')
+    publication_year = metadata.get('publication_year', '')
+    doc_type = metadata.get('doc_type', '')
+
+    source_info = f"Collection: {chunk['collection']}"
+    if book_title: source_info += f", Book: {book_title}"
+    if publication_year: source_info += f", Year: {publication_year}"
+    if author: source_info += f", Author: {author}"
+    if doc_type: source_info += f", Type: {doc_type}"
+    return source_info
+
+def build_generation_prompt(query: str, context_chunks: List[Dict]) -> tuple[str, str]:
+    """Format the retrieved chunks and question into the generation prompt; returns (prompt, formatted_context)"""
+    if CONTEXT_PACKING_ENABLED:
+        context_chunks = pack_context_chunks(context_chunks)
+    formatted_chunks_for_prompt = [f"Source [{format_source_info(chunk)}]: {chunk['text']}" for chunk in context_chunks]
+    
+    formatted_context_string = CONTEXT_SEPARATOR.join(formatted_chunks_for_prompt)
+
+    prompt = (
+        f"Context:\n{formatted_context_string}\n\n"
+        f"Question: {query}\n\n"
+        "Answer the question strictly based on the above context. "
+        "Include numbered endnotes at the end of your response for any sources you reference. "
+        "Each endnote should follow this format: [n] Title of piece, publication (e.g., Phyllis Schlafly Report or book title), date, author. "
+        "If the information is not visible in the chunk itself, use the information within the metadata to generate the citation. "
+        "Do not include source filenames. If the author is Phyllis Schlafly, treat it as your own words and omit the author from the endnote."
+    )
+    return prompt, formatted_context_string
+
+def create_instruction_cache() -> CachedInstruction | None:
+    if GEMINI_CONTEXT_CACHE == "off":
+        return None
+    if GEMINI_CONTEXT_CACHE == "gemini":
+        cache_client = GenaiCacheClient(genai_client_instance.get)
+    elif GEMINI_CONTEXT_CACHE == "memory":
+        cache_client = InMemoryCacheClient()
+    else:
+        raise ValueError(f"Unknown GEMINI_CONTEXT_CACHE '{GEMINI_CONTEXT_CACHE}', expected 'gemini', 'memory' or 'off'")
+    return CachedInstruction(
+        cache_client,
+        GEMINI_MODEL,
+        SYSTEM_INSTRUCTION,
+        ttl_seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+        renew_margin_seconds=GEMINI_CONTEXT_CACHE_RENEW_SECONDS,
+        retry_after_seconds=GEMINI_CONTEXT_CACHE_RETRY_SECONDS
+    )
+
+instruction_cache = create_instruction_cache()
+registry.gauge("psai_gemini_context_cache_events_total", "System instruction cache handle events and uses", ["event"],
+               lambda: {(event,): count for event, count in instruction_cache.counts.items()} if instruction_cache else {},
+               type_name="counter")
+
+def generation_config(temperature: float, cached_content: str | None = None) -> Any:
+    """The persona instruction comes from the cache when a handle is given, otherwise it is sent inline"""
+    from google.genai import types
+    if cached_content:
+        return types.GenerateContentConfig(temperature=temperature, cached_content=cached_content, max_output_tokens=1024)
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        system_instruction=SYSTEM_INSTRUCTION,
+        max_output_tokens=1024,
+    )
+
+def generate_with_cached_instruction(call, prompt: str, temperature: float, deadline: float | None = None) -> Any:
+    """Run a generation call (call_gemini_with_retry or open_gemini_stream_with_retry) against the
+    cached system instruction, repeating it once with the instruction inline if Gemini rejects the handle"""
+    cache_name = instruction_cache.handle() if instruction_cache is not None else None
+    if cache_name is not None:
         try:
-            config = types.GenerateContentConfig(
-                temperature=temperature,
-                system_instruction=system_instruction,
-                max_output_tokens=1024,
-            )
-            
-            response = call_gemini_with_retry(
-                model=GEMINI_MODEL,
-                prompt=prompt,
-                config=config
-            )
-            
-            output_token_count = len(response.text) // 4
-            
-            return {
-                "text": response.text,
-                "token_info": {
-                    "input_tokens": input_token_count,
-                    "output_tokens": output_token_count,
-                    "total_tokens": input_token_count + output_token_count
-                },
-                "formatted_context_for_generation": formatted_context_string
-            }
+            return call(model=GEMINI_MODEL, prompt=prompt, config=generation_config(temperature, cache_name), deadline=deadline)
+        except CachedContentError as e:
+            instruction_cache.invalidate(cache_name, e)
+    return call(model=GEMINI_MODEL, prompt=prompt, config=generation_config(temperature), deadline=deadline)
+
+def make_generation_result(text: str, formatted_context_string: str, usage: Dict[str, int] | None = None,
+                           time_limited: bool = False) -> Dict[str, Any]:
+    """usage is the Gemini call's token usage, None for answers produced without Gemini;
+    time_limited marks answers cut short or replaced by the fallback because of the request deadline"""
+    return {
+        "text": text,
+        "token_info": {kind: usage[kind] if usage else 0 for kind in ("input_tokens", "output_tokens", "total_tokens")},
+        "gemini_usage": usage,
+        "time_limited": time_limited,
+        "formatted_context_for_generation": formatted_context_string
+    }
+
+GENERATION_ERROR_RESULT = {
+    "text": "I apologize, but I am currently experiencing technical difficulties. Please try your question again in a moment.",
+    "token_info": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+    "gemini_usage": None,
+    "formatted_context_for_generation": ""
+}
+
+def generation_fallback_result(query: str, context_chunks: List[Dict], formatted_context_string: str, error: Exception) -> Dict[str, Any]:
+    """Result for a Gemini generation that failed: a simple answer built from the chunks"""
+    log_gemini_failure("Error generating response with Gemini", error)
+    fallback_response = generate_fallback_response(query, context_chunks)
+    return make_generation_result(fallback_response, formatted_context_string, time_limited=isinstance(error, RequestDeadlineError))
+
+def generate_gemini_response_internal(query, context_chunks, temperature=0.7, deadline=None):
+    try:
+        prompt, formatted_context_string = build_generation_prompt(query, context_chunks)
+
+        try:
+            response = generate_with_cached_instruction(call_gemini_with_retry, prompt, temperature, deadline)
+            return make_generation_result(response.text, formatted_context_string, gemini_token_usage(response, prompt, response.text))
             
         except APIError as e:
-            logger.error(f"Error generating response with Gemini: {e}")
-            # Fallback: Generate a simple response based on the chunks
-            fallback_response = generate_fallback_response(query, context_chunks)
-            return {
-                "text": fallback_response,
-                "token_info": {"input_tokens": input_token_count, "output_tokens": len(fallback_response) // 4, "total_tokens": input_token_count + len(fallback_response) // 4},
-                "formatted_context_for_generation": formatted_context_string
-            }
+            return generation_fallback_result(query, context_chunks, formatted_context_string, e)
             
     except Exception as e:
         logger.error(f"Unexpected error in generate_gemini_response_internal: {e}")
-        return {
-            "text": "I apologize, but I am currently experiencing technical difficulties. Please try your question again in a moment.",
-            "token_info": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
-            "formatted_context_for_generation": ""
-        }
+        return dict(GENERATION_ERROR_RESULT)
+
+class StreamedAnswer:
+    """Collects a streamed Gemini answer into the generation result; the prompt is built (and the
+    context packed) on construction, so async callers create it off the event loop"""
+
+    def __init__(self, query: str, context_chunks: List[Dict], deadline: float | None = None):
+        self.query = query
+        self.context_chunks = context_chunks
+        self.deadline = deadline
+        self.prompt, self.formatted_context_string = build_generation_prompt(query, context_chunks)
+        self.pieces: List[str] = []
+        # Usage metadata is cumulative, so the last chunk that carries it has the call's totals
+        self.usage_chunk = None
+        self.time_limited = False
+        self.fallback = False
+
+    def add(self, chunk: Any) -> str | None:
+        """Record a stream chunk; returns its text to pass on, if any"""
+        if getattr(chunk, "usage_metadata", None) is not None:
+            self.usage_chunk = chunk
+        if chunk.text:
+            self.pieces.append(chunk.text)
+            return chunk.text
+        return None
+
+    def out_of_time(self) -> bool:
+        if remaining_seconds(self.deadline) <= 0:
+            logger.warning(f"Request deadline reached after {len(self.pieces)} streamed chunks; ending the answer early")
+            self.time_limited = True
+        return self.time_limited
+
+    def fail(self, error: Exception) -> str | None:
+        """Record a failed stream; returns the fallback answer to send when nothing was streamed yet"""
+        self.time_limited = isinstance(error, RequestDeadlineError)
+        if self.pieces:
+            # Keep what was already streamed rather than replacing it mid-answer
+            log_gemini_failure(f"Gemini stream interrupted after {len(self.pieces)} chunks", error)
+            return None
+        log_gemini_failure("Error generating streamed response with Gemini", error)
+        self.fallback = True
+        self.pieces.append(generate_fallback_response(self.query, self.context_chunks))
+        return self.pieces[0]
+
+    def result(self) -> Dict[str, Any]:
+        """Answers written without Gemini carry no token usage"""
+        text = "".join(self.pieces)
+        usage = None if self.fallback else gemini_token_usage(self.usage_chunk, self.prompt, text)
+        return make_generation_result(text, self.formatted_context_string, usage, self.time_limited)
+
+def stream_gemini_response_internal(query, context_chunks, temperature=0.7, deadline=None):
+    """Generator form of generate_gemini_response_internal: yields text pieces as Gemini
+    produces them and returns the same result dict (via StopIteration.value) when done"""
+    answer = StreamedAnswer(query, context_chunks, deadline)
+    try:
+        first_chunk, stream = generate_with_cached_instruction(open_gemini_stream_with_retry, answer.prompt, temperature, deadline)
+        for chunk in itertools.chain([first_chunk], stream):
+            text = answer.add(chunk)
+            if text:
+                yield text
+            if answer.out_of_time():
+                break
+    except Exception as e:
+        fallback_response = answer.fail(e)
+        if fallback_response:
+            yield fallback_response
+    return answer.result()
 
 def generate_fallback_response(query: str, chunks: List[Dict]) -> str:
     """Generate a simple response when the main model is unavailable"""
     try:
-        # Sort chunks by relevance score
-        sorted_chunks = sorted(chunks, key=lambda x: x.get('score', 0), reverse=True)
-        
-        # Build a response using the most relevant chunks
+        # Build a response from the chunks in ranking order, most relevant first
         response_parts = ["Based on the available information:"]
         
-        for i, chunk in enumerate(sorted_chunks, 1):
+        for i, chunk in enumerate(chunks, 1):
             # Extract key information
             text = chunk.get('text', '').strip()
             metadata = chunk.get('metadata', {})
@@ -329,7 +1971,7 @@ def generate_fallback_response(query: str, chunks: List[Dict]) -> str:
         
         # Add endnotes
         response_parts.append("\nSources:")
-        for i, chunk in enumerate(sorted_chunks, 1):
+        for i, chunk in enumerate(chunks, 1):
             metadata = chunk.get('metadata', {})
             source = metadata.get('book_title') or metadata.get('doc_type') or chunk.get('collection', 'Unknown source')
             year = metadata.get('publication_year', '')
@@ -344,14 +1986,76 @@ def generate_fallback_response(query: str, chunks: List[Dict]) -> str:
         logger.error(f"Error in fallback response generation: {e}")
         return "I apologize, but I am currently experiencing technical difficulties. Please try your question again in a moment."
 
+# --- Local Sufficiency Estimator ---
+INSUFFICIENT_CONTEXT_PATTERN = re.compile(
+    r"(context|information|sources?) (provided )?(does not|doesn't|do not|don't|lacks?|is insufficient)|"
+    r"not enough (information|context|detail)|insufficient (information|context|detail)|unable to (answer|find)",
+    re.IGNORECASE
+)
+
+def embed_texts_internal(texts: List[str]) -> np.ndarray:
+    """Encode texts in one batch, reusing cached vectors; rows are unit-normalized"""
+    vectors = [chunk_embedding_cache.get(text) for text in texts]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        encoded = encode_texts([texts[i] for i in missing])
+        for i, vector in zip(missing, encoded):
+            vectors[i] = np.asarray(vector, dtype=np.float32) / (np.linalg.norm(vector) + 1e-12)
+            chunk_embedding_cache.set(texts[i], vectors[i])
+    return np.stack(vectors) if vectors else np.zeros((0, 384), dtype=np.float32)
+
+def estimate_answer_sufficiency(answer: str, chunks: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Cheap answer-quality signals: how well retrieval matched and how much of the answer the context supports"""
+    # Only cosine similarities count; lexical hits have no "score" (their BM25 score is on another scale)
+    scores = [min(max(float(chunk["score"]), 0.0), 1.0) for chunk in chunks if chunk.get("score") is not None]
+    top_score = max(scores, default=0.0)
+
+    # Endnote lines cite sources rather than make claims, so only the body is checked against the context
+    body = "\n".join(line for line in answer.splitlines() if not re.match(r"\s*\[\d+\]", line))
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+", body) if len(s.split()) >= 4]
+    chunk_texts = [chunk.get("text", "") for chunk in chunks if chunk.get("text")]
+    if not sentences or not chunk_texts:
+        return {"top_score": top_score, "support": 0.0, "coverage": 0.0, "score": 0.3 * top_score}
+
+    vectors = embed_texts_internal(sentences + chunk_texts)
+    sentence_support = (vectors[:len(sentences)] @ vectors[len(sentences):].T).max(axis=1)
+    support = float(sentence_support.mean())
+    coverage = float((sentence_support >= SENTENCE_SUPPORT_THRESHOLD).mean())
+    return {
+        "top_score": top_score,
+        "support": support,
+        "coverage": coverage,
+        "score": 0.4 * coverage + 0.3 * support + 0.3 * top_score
+    }
+
+def local_critique_internal(answer: str, chunks: List[Dict[str, Any]], force_decision: bool = False) -> Dict[str, Any] | None:
+    """Critique from local signals; None when the estimate falls in the uncertain band (unless force_decision)"""
+    if INSUFFICIENT_CONTEXT_PATTERN.search(answer):
+        return {"answer_quality": "POOR_NEEDS_MORE_CONTEXT", "reasoning": "Local estimate: the answer says the context is insufficient.", "source": "local"}
+
+    estimate = estimate_answer_sufficiency(answer, chunks)
+    reasoning = (f"Local estimate {estimate['score']:.2f} (coverage {estimate['coverage']:.2f}, "
+                 f"support {estimate['support']:.2f}, top retrieval score {estimate['top_score']:.2f}).")
+    if estimate["score"] >= LOCAL_CRITIQUE_GOOD_THRESHOLD:
+        quality = "GOOD"
+    elif estimate["score"] <= LOCAL_CRITIQUE_POOR_THRESHOLD:
+        quality = "POOR_NEEDS_MORE_CONTEXT"
+    elif force_decision:
+        midpoint = (LOCAL_CRITIQUE_GOOD_THRESHOLD + LOCAL_CRITIQUE_POOR_THRESHOLD) / 2
+        quality = "ACCEPTABLE_NO_MORE_CONTEXT_NEEDED" if estimate["score"] >= midpoint else "ACCEPTABLE_NEEDS_MORE_CONTEXT"
+    else:
+        logger.info(f"Local critique uncertain: {reasoning}")
+        return None
+    return {"answer_quality": quality, "reasoning": reasoning, "source": "local"}
+
 # --- LangGraph Nodes ---
 def initialize_state_node(state: GraphState) -> Dict[str, Any]:
-    print("--- Running: Initialize State Node ---")
+    logger.debug("Running: Initialize State Node")
     # Extract values directly from the state (which contains the initial input)
     initial_query = state.get('original_query', '')
     error_msg = None
     if not initial_query:
-        print("!!! initialize_state_node: Input query is empty. Setting error_message.")
+        logger.warning("initialize_state_node: Input query is empty. Setting error_message.")
         error_msg = "Query is required in the input."
 
     return {
@@ -366,65 +2070,233 @@ def initialize_state_node(state: GraphState) -> Dict[str, Any]:
         "max_iterations": 3,
         "refined_query": None,
         "search_results": None,
+        "candidate_results": None,
+        "candidate_pool_size": 0,
+        "speculative_results": None,
         "formatted_context_for_generation": None,
         "generated_response_text": None,
         "token_info": None,
+        "token_usage": None,
+        "token_budget": state['token_budget'] if 'token_budget' in state else request_token_budget(None),
+        "answer_source": None,
+        "deadline": state.get('deadline') or request_deadline(None),
+        "time_limited": False,
+        "speculative_search": state.get('speculative_search', SPECULATIVE_SEARCH_ENABLED and not MULTI_QUERY_ENABLED),
+        "response_mode": state.get('response_mode', 'full'),
         "critique_json": None,
         "final_json_response": None,
         "error_message": error_msg
     }
 
-def refine_query_node(state: GraphState) -> Dict[str, Any]:
-    print(f"--- Running: Refine Query Node (Iteration: {state['iteration_count']}) ---")
+# The node bodies below are split into pure steps shared with asgi_app.py's coroutine nodes, so the
+# two only differ in how they wait on Gemini and the search backend
+def candidate_pool_limit(state: GraphState) -> int:
+    """Candidates fetched at once: the most any retry iteration can ask for"""
+    return max(state['current_chunk_limit'], state['max_chunk_limit'])
+
+def refine_query_without_llm(state: GraphState) -> Dict[str, Any] | None:
+    """The refine_query update when Gemini is not needed (missing query, lexical fast path, cached or
+    confident local refinement, too close to the deadline), else None"""
     if not state['original_query']:
-        print("!!! refine_query_node: Setting error_message - Query is required")
+        logger.warning("refine_query_node: Setting error_message - Query is required")
         return {"error_message": "Query is required"}
-    refined = refine_query_for_semantic_search_internal(state['original_query'])
-    return {"refined_query": refined}
 
-def semantic_search_node(state: GraphState) -> Dict[str, Any]:
-    print(f"--- Running: Semantic Search Node (Iteration: {state['iteration_count']}, Chunks: {state['current_chunk_limit']}) ---")
+    # Exact titles and quoted phrases are answered straight from the BM25 index, skipping refinement and embedding
+    pool_size = candidate_pool_limit(state)
+    lexical_results = lexical_fast_path_internal(state['original_query'], state['selected_collections'], pool_size)
+    if lexical_results:
+        return {
+            "refined_query": state['original_query'],
+            "candidate_results": lexical_results,
+            "candidate_pool_size": pool_size
+        }
+
+    refined = refine_query_without_gemini(state['original_query'])
+    if refined is not None:
+        return {"refined_query": refined}
+
+    if remaining_seconds(state['deadline']) < DEADLINE_ITERATION_RESERVE_SECONDS:
+        # Spend the little time left on generation rather than on refinement
+        error = RequestDeadlineError("Too close to the request deadline for Gemini refinement")
+        return {"refined_query": fallback_refinement(state['original_query'], error), "time_limited": True}
+    return None
+
+def speculative_search_arguments(state: GraphState) -> Dict[str, Any] | None:
+    """semantic_search_internal arguments for searching the raw query while Gemini refines it, None when off"""
+    if not state['speculative_search']:
+        return None
+    return {
+        "query_text": state['original_query'],
+        "collections": state['selected_collections'],
+        "limit": candidate_pool_limit(state),
+        "similarity_threshold": state['similarity_threshold'],
+        "lexical_query": state['original_query'] if HYBRID_SEARCH_ENABLED else None
+    }
+
+def refinement_state_update(state: GraphState, refined: str, usage: Dict[str, int] | None,
+                            speculative_results: List[Dict[str, Any]] | None) -> Dict[str, Any]:
+    return {
+        "refined_query": refined,
+        "speculative_results": speculative_results,
+        "token_usage": add_token_usage(state.get('token_usage'), "refine_query", usage)
+    }
+
+@instrumented_node("refine_query")
+def refine_query_node(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Refine Query Node (Iteration: {state['iteration_count']})")
+    update = refine_query_without_llm(state)
+    if update is not None:
+        return update
+
+    # Gemini is needed: search the raw query while it refines; semantic_search_node decides whether to keep the results
+    speculative_search = speculative_search_arguments(state)
+    speculative_future = speculative_executor.submit(semantic_search_internal, **speculative_search) if speculative_search else None
+
+    refined, usage = refine_query_with_gemini_internal(state['original_query'], state['deadline'])
+
+    speculative_results = None
+    if speculative_future is not None:
+        try:
+            speculative_results = speculative_future.result(timeout=SEARCH_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning(f"Speculative search failed, will search the refined query only: {e}")
+    return refinement_state_update(state, refined, usage, speculative_results)
+
+def search_timeout(state: GraphState) -> float:
+    """SEARCH_TIMEOUT_SECONDS, cut to the time left before the deadline (but never below one second:
+    without retrieval there is no answer at all)"""
+    return min(SEARCH_TIMEOUT_SECONDS, max(remaining_seconds(state['deadline']), 1.0))
+
+def search_input_error(state: GraphState) -> Dict[str, Any] | None:
     if not state['refined_query'] or not state['selected_collections']:
-        print("!!! semantic_search_node: Setting error_message - Refined query or collections missing")
+        logger.warning("semantic_search_node: Setting error_message - Refined query or collections missing")
         return {"error_message": "Refined query or collections missing for search"}
-    
-    results = semantic_search_internal(
-        query_text=state['refined_query'],
-        collections=state['selected_collections'],
-        limit=state['current_chunk_limit'],
-        similarity_threshold=state['similarity_threshold']
-    )
-    return {"search_results": results}
+    return None
+
+def candidate_pool_to_fetch(state: GraphState) -> int | None:
+    """Pool size to search for, or None when the candidates already fetched cover this iteration.
+    The merged top-N of a larger fetch is exactly the top-N of a smaller one, so the whole pool the
+    retry loop could ever ask for is fetched once and later iterations are served by slicing it."""
+    candidates = state.get('candidate_results')
+    if candidates is not None and state.get('candidate_pool_size', 0) >= state['current_chunk_limit']:
+        logger.info(f"semantic_search_node: Reusing {len(candidates)} fetched candidates.")
+        return None
+    return candidate_pool_limit(state)
+
+def candidate_search_arguments(state: GraphState, pool_size: int) -> Dict[str, Any]:
+    """Arguments for multi_query_search_internal (MULTI_QUERY_ENABLED) or semantic_search_internal"""
+    arguments = {
+        "collections": state['selected_collections'],
+        "limit": pool_size,
+        "similarity_threshold": state['similarity_threshold'],
+        "lexical_query": state['original_query'] if HYBRID_SEARCH_ENABLED else None,
+        "timeout": search_timeout(state)
+    }
+    if MULTI_QUERY_ENABLED:
+        return dict(arguments, variants=query_variants(state['original_query'], state['refined_query']))
+    return dict(arguments, query_text=state['refined_query'])
+
+def search_state_update(state: GraphState, candidates: List[Dict[str, Any]] | None = None, pool_size: int = 0) -> Dict[str, Any]:
+    """Serve this iteration's chunks from freshly fetched candidates, or from the stored ones when None"""
+    if candidates is None:
+        return {"search_results": state['candidate_results'][:state['current_chunk_limit']]}
+    return {
+        "candidate_results": candidates,
+        "candidate_pool_size": pool_size,
+        "speculative_results": None,
+        "search_results": candidates[:state['current_chunk_limit']]
+    }
 
-def generate_response_node(state: GraphState) -> Dict[str, Any]:
-    print(f"--- Running: Generate Response Node (Iteration: {state['iteration_count']}) ---")
+def keep_speculative_results(state: GraphState, pool_size: int) -> List[Dict[str, Any]] | None:
+    """The speculative results, when the refined query is close enough to the original to reuse them"""
+    speculative = state.get('speculative_results')
+    if speculative is not None and speculation_matches_refinement(state['original_query'], state['refined_query']):
+        logger.info("semantic_search_node: Refined query is close to the original; keeping speculative results.")
+        return speculative[:pool_size]
+    return None
+
+@instrumented_node("semantic_search")
+def semantic_search_node(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Semantic Search Node (Iteration: {state['iteration_count']}, Chunks: {state['current_chunk_limit']})")
+    error = search_input_error(state)
+    if error:
+        return error
+    pool_size = candidate_pool_to_fetch(state)
+    if pool_size is None:
+        return search_state_update(state)
+
+    candidates = keep_speculative_results(state, pool_size)
+    if candidates is None:
+        search = multi_query_search_internal if MULTI_QUERY_ENABLED else semantic_search_internal
+        candidates = search(**candidate_search_arguments(state, pool_size))
+        candidates = fuse_speculative_results(candidates, state.get('speculative_results') or [], pool_size)
+    return search_state_update(state, candidates, pool_size)
+
+def generation_input_error(state: GraphState) -> Dict[str, Any] | None:
     if state['search_results'] is None:
-        print("--- generate_response_node: No search results found.")
+        logger.info("generate_response_node: No search results found.")
         return {"generated_response_text": "No search results to generate a response from.", 
                 "token_info": {"input_tokens":0, "output_tokens":0, "total_tokens":0},
                 "formatted_context_for_generation": ""}
 
     if not state['original_query']:
-         print("!!! generate_response_node: Setting error_message - Original query missing")
-         return {"error_message": "Original query missing for generation"}
+        logger.warning("generate_response_node: Setting error_message - Original query missing")
+        return {"error_message": "Original query missing for generation"}
+    return None
+
+@instrumented_node("generate_response")
+def generate_response_node(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Generate Response Node (Iteration: {state['iteration_count']})")
+    error = generation_input_error(state)
+    if error:
+        return error
 
     response_data = generate_gemini_response_internal(
         query=state['original_query'],
         context_chunks=state['search_results'],
-        temperature=state['temperature']
+        temperature=state['temperature'],
+        deadline=state['deadline']
     )
+    return generation_state_update(state, response_data)
+
+def generation_state_update(state: GraphState, response_data: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "generated_response_text": response_data["text"],
         "token_info": response_data["token_info"],
+        "token_usage": add_token_usage(state.get('token_usage'), "generate_response", response_data["gemini_usage"]),
+        # Answers written without Gemini (breaker open, errors) are served but never cached
+        "answer_source": "gemini" if response_data["gemini_usage"] else "fallback",
+        "time_limited": state.get('time_limited', False) or response_data["time_limited"],
         "formatted_context_for_generation": response_data["formatted_context_for_generation"]
     }
 
-def critique_response_node(state: GraphState) -> Dict[str, Any]:
-    print(f"--- Running: Critique Response Node (Iteration: {state['iteration_count']}) ---")
+def critique_without_llm(state: GraphState) -> Dict[str, Any] | None:
+    """Critique that needs no Gemini call (missing inputs or a confident local estimate), else None"""
     if not state['generated_response_text'] or not state['original_query']:
-        print("--- critique_response_node: Missing generated_response_text or original_query for critique.")
-        return {"critique_json": {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": "Missing generated response or query for critique."}}
+        logger.warning("critique_response_node: Missing generated_response_text or original_query for critique.")
+        return {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": "Missing generated response or query for critique."}
 
+    if CRITIQUE_MODE in ("local", "hybrid"):
+        try:
+            local_critique = local_critique_internal(state['generated_response_text'], state['search_results'] or [], force_decision=CRITIQUE_MODE == "local")
+            if local_critique is not None:
+                logger.info(f"Local critique: {local_critique}")
+                return local_critique
+        except Exception as e:
+            logger.warning(f"Local critique failed, falling back to LLM critique: {e}")
+    return None
+
+def critique_update_without_llm(state: GraphState) -> Dict[str, Any] | None:
+    """The critique_response update when no Gemini critique is needed or there is no time left for one, else None"""
+    critique = critique_without_llm(state)
+    if critique is not None:
+        return {"critique_json": critique}
+    if remaining_seconds(state['deadline']) < DEADLINE_CRITIQUE_RESERVE_SECONDS:
+        return deadline_skipped_critique()
+    return None
+
+def build_critique_request(state: GraphState) -> tuple[str, Any]:
+    from google.genai import types
     context_str = state.get('formatted_context_for_generation', "Context not available.")
     if not state['search_results']:
         context_str = "No context was retrieved or provided for generation."
@@ -452,42 +2324,75 @@ Based on this, provide your evaluation in JSON format with the following keys:
 
 JSON Output:
 """
+    config = types.GenerateContentConfig(
+        temperature=0.2,
+        max_output_tokens=200
+    )
+    return critique_prompt, config
+
+def parse_critique_response(response_text: str) -> Dict[str, Any]:
+    critique_text = response_text.strip()
+    if critique_text.startswith("```json"):
+        critique_text = critique_text[len("```json"):]
+    if critique_text.endswith("```"):
+        critique_text = critique_text[:-len("```")]
+    critique_text = critique_text.strip()
+
+    parsed_critique = json.loads(critique_text)
+    logger.info(f"Critique received and parsed: {parsed_critique}")
+    return parsed_critique
+
+def critique_error_result(e: Exception, response: Any = None) -> Dict[str, Any]:
+    raw_response = response.text if response is not None else 'N/A'
+    if isinstance(e, APIError):
+        logger.error(f"critique_response_node: API error during critique: {e}")
+        return {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": f"API error during critique: {str(e)}"}
+    if isinstance(e, json.JSONDecodeError):
+        logger.error(f"critique_response_node: JSON parsing error: {e}. Raw response: '{raw_response}'")
+        return {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": f"JSON parsing error: {str(e)}"}
+    logger.error(f"critique_response_node: Unexpected error: {e}. Raw response: '{raw_response}'")
+    return {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": str(e)}
+
+def deadline_skipped_critique() -> Dict[str, Any]:
+    return {
+        "critique_json": {"answer_quality": "SKIPPED_DEADLINE", "reasoning": "Not critiqued: too close to the request deadline."},
+        "time_limited": True
+    }
+
+@instrumented_node("critique_response")
+def critique_response_node(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Critique Response Node (Iteration: {state['iteration_count']})")
+    update = critique_update_without_llm(state)
+    if update is not None:
+        return update
+
+    critique_prompt, config = build_critique_request(state)
     try:
-        config = types.GenerateContentConfig(
-            temperature=0.2,
-            max_output_tokens=200
-        )
-        
         response = call_gemini_with_retry(
             model=GEMINI_MODEL,
             prompt=critique_prompt,
-            config=config
+            config=config,
+            deadline=state['deadline']
         )
-            
-        critique_text = response.text.strip()
-        if critique_text.startswith("```json"):
-            critique_text = critique_text[len("```json"):]
-        if critique_text.endswith("```"):
-            critique_text = critique_text[:-len("```")]
-        critique_text = critique_text.strip()
-        
-        parsed_critique = json.loads(critique_text)
-        logger.info(f"Critique received and parsed: {parsed_critique}")
-        return {"critique_json": parsed_critique}
-    except APIError as e:
-        logger.error(f"critique_response_node: API error during critique: {e}")
-        return {"critique_json": {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": f"API error during critique: {str(e)}"}}
-    except json.JSONDecodeError as e:
-        logger.error(f"critique_response_node: JSON parsing error: {e}. Raw response: '{response.text if 'response' in locals() else 'N/A'}'")
-        return {"critique_json": {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": f"JSON parsing error: {str(e)}"}}
+    except RequestDeadlineError:
+        return deadline_skipped_critique()
     except Exception as e:
-        logger.error(f"critique_response_node: Unexpected error: {e}. Raw response: '{response.text if 'response' in locals() else 'N/A'}'")
-        return {"critique_json": {"answer_quality": "ERROR_IN_CRITIQUE", "reasoning": str(e)}}
+        return {"critique_json": critique_error_result(e)}
+    return critique_state_update(state, critique_prompt, response)
+
+def critique_state_update(state: GraphState, critique_prompt: str, response: Any) -> Dict[str, Any]:
+    """Parse a Gemini critique; its tokens are counted even when the JSON is malformed"""
+    token_usage = add_token_usage(state.get('token_usage'), "critique_response", gemini_token_usage(response, critique_prompt, response.text))
+    try:
+        critique = parse_critique_response(response.text)
+    except Exception as e:
+        critique = critique_error_result(e, response)
+    return {"critique_json": critique, "token_usage": token_usage}
 
 def prepare_final_output_node(state: GraphState | None) -> Dict[str, Any]:
-    print("--- Running: Prepare Final Output Node ---")
+    logger.debug("Running: Prepare Final Output Node")
     if state is None:
-        print("!!! prepare_final_output_node: Critical Error - Received None as state!")
+        logger.error("prepare_final_output_node: Critical Error - Received None as state!")
         return {
             "final_json_response": {
                 "error": "Critical graph error: State was lost before final output processing.",
@@ -508,7 +2413,10 @@ def prepare_final_output_node(state: GraphState | None) -> Dict[str, Any]:
         "query_used_for_search": state.get('refined_query', original_query),
         "chunks": state.get('search_results', []),
         "response": "Error: Processing did not complete successfully.", # Default error response
-        "token_info": state.get('token_info', {}),
+        "token_info": summarize_token_usage(state),
+        "answer_source": state.get('answer_source'),
+        "time_limited": bool(state.get('time_limited')),
+        "retry_stopped_by": None,
         "iterations_done": state.get('iteration_count', 0), # Default to 0 if not properly set
         "final_chunk_limit_used": state.get('current_chunk_limit', state.get('initial_chunk_limit', 0)),
         "critique_assessment": "N/A", # Default
@@ -529,6 +2437,11 @@ def prepare_final_output_node(state: GraphState | None) -> Dict[str, Any]:
         if critique_json_val: 
             final_response["critique_assessment"] = critique_json_val.get('answer_quality', 'N/A - critique data malformed')
             final_response["critique_reasoning"] = critique_json_val.get('reasoning', 'N/A - critique data malformed')
+            if final_response["critique_assessment"] in RETRY_QUALITIES:
+                # The critique asked for more context; say why the router stopped anyway
+                final_response["retry_stopped_by"] = retry_blocker(state)
+                if final_response["retry_stopped_by"] == "deadline":
+                    final_response["time_limited"] = True
         elif not final_response.get("error"): # If no primary error and no critique, note it wasn't critiqued
             final_response["critique_assessment"] = "Not Critiqued"
 
@@ -536,77 +2449,88 @@ def prepare_final_output_node(state: GraphState | None) -> Dict[str, Any]:
 
 
 # --- Conditional Edge Logic ---
+RETRY_QUALITIES = ("ACCEPTABLE_NEEDS_MORE_CONTEXT", "POOR_NEEDS_MORE_CONTEXT")
+
+def retry_blocker(state: GraphState) -> str | None:
+    """Why another iteration cannot run (a limit or budget is used up), or None if it can"""
+    if state.get("iteration_count", 0) >= state.get('max_iterations', 3):
+        return "max_iterations"
+    if state.get('current_chunk_limit', 0) >= state.get('max_chunk_limit', 15):
+        return "max_chunk_limit"
+    if state.get('candidate_results') is not None and len(state['candidate_results']) <= state.get('current_chunk_limit', 0):
+        return "candidates_exhausted"
+    if not token_budget_allows_retry(state):
+        return "token_budget"
+    if remaining_seconds(state.get('deadline')) < DEADLINE_ITERATION_RESERVE_SECONDS:
+        return "deadline"
+    return None
+
 def should_retry_search_edge(state: GraphState | None) -> str:
-    print(f"--- Condition: Router --- ") # Simpler log
     if state is None:
-        print("!!! Router: Critical Error - Received None as state! Routing to prepare_final_output.")
+        logger.error("Router: Critical Error - Received None as state! Routing to prepare_final_output.")
         # Cannot set error_message if state is None. Just route.
         return "prepare_final_output"
     
     iteration_count = state.get("iteration_count", 0)
-    print(f"Router: Iteration {iteration_count}")
+    logger.debug(f"Router: Iteration {iteration_count}")
 
     current_error_message = state.get("error_message")
-    print(f"Router: Current error_message in state: {current_error_message}")
+    logger.debug(f"Router: Current error_message in state: {current_error_message}")
     if current_error_message:
-        print(f"Router: Error detected ('{current_error_message}'), going to prepare_final_output.")
+        logger.debug(f"Router: Error detected ('{current_error_message}'), going to prepare_final_output.")
         return "prepare_final_output"
 
     # Determine which step we just completed or should go to next
     if state.get("critique_json") is not None:
-        print("Router: Path based on critique_json.")
+        logger.debug("Router: Path based on critique_json.")
         critique = state['critique_json'] # critique_json is confirmed not None
         # Ensure critique is a dictionary before .get (critique_response_node should ensure this)
         if not isinstance(critique, dict):
-            print("!!! Router: critique_json is not a dict. Forcing error for final output.")
+            logger.error("Router: critique_json is not a dict. Forcing error for final output.")
             state['error_message'] = "Internal Error: Critique data malformed."
             return "prepare_final_output"
 
         quality = critique.get("answer_quality", "ERROR_IN_CRITIQUE")
-        print(f"Router: Critique quality: {quality}")
+        logger.debug(f"Router: Critique quality: {quality}")
 
-        if quality in ["GOOD", "ACCEPTABLE_NO_MORE_CONTEXT_NEEDED", "POOR_NO_MORE_CONTEXT_NEEDED", "ERROR_IN_CRITIQUE"]:
-            print("Router: Quality sufficient or no more retries. Preparing final output.")
-            return "prepare_final_output"
-        
-        if iteration_count >= state.get('max_iterations', 3):
-            print("Router: Max iterations reached. Preparing final output.")
+        if quality in ["GOOD", "ACCEPTABLE_NO_MORE_CONTEXT_NEEDED", "POOR_NO_MORE_CONTEXT_NEEDED", "ERROR_IN_CRITIQUE", "SKIPPED_DEADLINE"]:
+            logger.debug("Router: Quality sufficient or no more retries. Preparing final output.")
             return "prepare_final_output"
 
-        if quality in ["ACCEPTABLE_NEEDS_MORE_CONTEXT", "POOR_NEEDS_MORE_CONTEXT"]:
-            if state.get('current_chunk_limit', 0) >= state.get('max_chunk_limit', 15):
-                print("Router: Max chunk limit reached. Preparing final output.")
+        if quality in RETRY_QUALITIES:
+            blocker = retry_blocker(state)
+            if blocker is not None:
+                logger.info(f"Router: Not retrying ({blocker}). Preparing final output.")
                 return "prepare_final_output"
-            else:
-                print("Router: Retrying. Going to update_state_for_retry.")
-                return "update_state_for_retry"
+            logger.debug("Router: Retrying. Going to update_state_for_retry.")
+            return "update_state_for_retry"
         
-        print("Router: Unexpected critique assessment. Preparing final output.")
+        logger.warning("Router: Unexpected critique assessment. Preparing final output.")
         return "prepare_final_output"
     
     elif state.get("generated_response_text") is not None:
-        print("Router: Path based on generated_response_text. Proceeding to critique.")
+        logger.debug("Router: Path based on generated_response_text. Proceeding to critique.")
         return "critique_response"
     
     elif state.get("search_results") is not None:
-        print("Router: Path based on search_results. Proceeding to generate_response.")
+        logger.debug("Router: Path based on search_results. Proceeding to generate_response.")
         return "generate_response"
     
     elif state.get("refined_query") is not None:
-        print("Router: Path based on refined_query. Proceeding to semantic_search.")
+        logger.debug("Router: Path based on refined_query. Proceeding to semantic_search.")
         return "semantic_search"
     
     elif state.get("original_query") is not None: # Initial state after successful init and no error
-        print("Router: Path based on original_query. Proceeding to refine_query.")
+        logger.debug("Router: Path based on original_query. Proceeding to refine_query.")
         return "refine_query"
     
     else: 
-        print("!!! Router: Critical state error - original_query is missing and no other path taken. Setting error.")
+        logger.error("Router: Critical state error - original_query is missing and no other path taken. Setting error.")
         state['error_message'] = "Critical error: Graph state unclear, original_query missing."
         return "prepare_final_output"
 
 def update_state_for_retry_node(state: GraphState) -> Dict[str, Any]:
-    print(f"--- Running: Update State for Retry Node (Old Iteration: {state['iteration_count']}) ---")
+    logger.debug(f"Running: Update State for Retry Node (Old Iteration: {state['iteration_count']})")
     new_chunk_limit = min(state['current_chunk_limit'] + 5, state['max_chunk_limit'])
     return {
         "current_chunk_limit": new_chunk_limit,
@@ -618,47 +2542,131 @@ def update_state_for_retry_node(state: GraphState) -> Dict[str, Any]:
     }
 
 # --- Build the Graph ---
-workflow = StateGraph(GraphState)
-
-# Add ACTUAL processing nodes that update state
-workflow.add_node("initialize_state", lambda state: initialize_state_node(state))
-workflow.add_node("refine_query", refine_query_node)
-workflow.add_node("semantic_search", semantic_search_node)
-workflow.add_node("generate_response", generate_response_node)
-workflow.add_node("critique_response", critique_response_node)
-workflow.add_node("update_state_for_retry", update_state_for_retry_node)
-workflow.add_node("prepare_final_output", prepare_final_output_node)
-
-# Set entry point
-workflow.set_entry_point("initialize_state")
-
-# Define the path map for conditional edges
-PATH_MAP = {
-    "refine_query": "refine_query",
-    "semantic_search": "semantic_search",
-    "generate_response": "generate_response",
-    "critique_response": "critique_response",
-    "update_state_for_retry": "update_state_for_retry",
-    "prepare_final_output": "prepare_final_output",
-    END: END
-}
+def build_app_graph(refine_query=refine_query_node, semantic_search=semantic_search_node,
+                    generate_response=generate_response_node, critique_response=critique_response_node):
+    """Compile the RAG workflow; the async serving mode passes coroutine versions of the I/O-bound nodes"""
+    from langgraph.graph import StateGraph, END
+
+    # Define the path map for conditional edges
+    PATH_MAP = {
+        "refine_query": "refine_query",
+        "semantic_search": "semantic_search",
+        "generate_response": "generate_response",
+        "critique_response": "critique_response",
+        "update_state_for_retry": "update_state_for_retry",
+        "prepare_final_output": "prepare_final_output",
+        END: END
+    }
 
-# After each processing node, decide where to go next using should_retry_search_edge
-workflow.add_conditional_edges("initialize_state", should_retry_search_edge, PATH_MAP)
-workflow.add_conditional_edges("refine_query", should_retry_search_edge, PATH_MAP)
-workflow.add_conditional_edges("semantic_search", should_retry_search_edge, PATH_MAP)
-workflow.add_conditional_edges("generate_response", should_retry_search_edge, PATH_MAP)
-workflow.add_conditional_edges("critique_response", should_retry_search_edge, PATH_MAP)
+    workflow = StateGraph(GraphState)
+
+    # Add ACTUAL processing nodes that update state
+    workflow.add_node("initialize_state", lambda state: initialize_state_node(state))
+    workflow.add_node("refine_query", refine_query)
+    workflow.add_node("semantic_search", semantic_search)
+    workflow.add_node("generate_response", generate_response)
+    workflow.add_node("critique_response", critique_response)
+    workflow.add_node("update_state_for_retry", update_state_for_retry_node)
+    workflow.add_node("prepare_final_output", prepare_final_output_node)
+
+    # Set entry point
+    workflow.set_entry_point("initialize_state")
+
+    # After each processing node, decide where to go next using should_retry_search_edge
+    workflow.add_conditional_edges("initialize_state", should_retry_search_edge, PATH_MAP)
+    workflow.add_conditional_edges("refine_query", should_retry_search_edge, PATH_MAP)
+    workflow.add_conditional_edges("semantic_search", should_retry_search_edge, PATH_MAP)
+    workflow.add_conditional_edges("generate_response", should_retry_search_edge, PATH_MAP)
+    workflow.add_conditional_edges("critique_response", should_retry_search_edge, PATH_MAP)
+
+    # Specific non-conditional edges
+    workflow.add_edge("update_state_for_retry", "semantic_search") # Loop back to search
+    workflow.add_edge("prepare_final_output", END) # Final step
+
+    # Compile the graph
+    return workflow.compile()
+
+app_graph = LazyResource("app_graph", build_app_graph)
+
+# --- Warm-up ---
+warmup_lock = threading.Lock()
+warmup_status = {"state": "pending", "started_at": None, "finished_at": None, "components": {}}
+
+def warm_up_embedding_model() -> None:
+    embedding_model.get().encode(["warm-up"])
+
+def warm_up_search_backend() -> None:
+    collections = collection_catalogue.refresh()
+    logger.info(f"Available collections: {list(collections)}")
+
+def warm_up_instruction_cache() -> None:
+    """Create the cache handle now and leave renewals to the refresher; never fails, as without a
+    handle generation sends the instruction inline"""
+    if instruction_cache is not None:
+        instruction_cache.refresh()
+        instruction_cache.start()
+
+WARMUP_STEPS = [
+    ("embedding_model", warm_up_embedding_model),
+    ("search_backend", warm_up_search_backend),
+    ("gemini_client", genai_client_instance.get),
+    ("gemini_context_cache", warm_up_instruction_cache),
+    ("app_graph", app_graph.get),
+]
+
+def warm_up() -> bool:
+    """Load the model (with one dummy encode), ping the search backend and build the clients and graph,
+    so the first real request does not pay for them. Returns True when every step succeeded."""
+    warmup_status.update(state="running", started_at=time.time(), finished_at=None)
+    ok = True
+    for name, step in WARMUP_STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+            warmup_status["components"][name] = {"ready": True, "seconds": round(time.perf_counter() - start, 3)}
+        except Exception as e:
+            ok = False
+            logger.error(f"Warm-up step {name} failed: {e}")
+            warmup_status["components"][name] = {"ready": False, "error": str(e)}
+    warmup_status.update(state="ready" if ok else "failed", finished_at=time.time())
+    return ok
 
-# Specific non-conditional edges
-workflow.add_edge("update_state_for_retry", "semantic_search") # Loop back to search
-workflow.add_edge("prepare_final_output", END) # Final step
+def start_warm_up() -> bool:
+    """Run warm_up on a background thread unless it is running or already succeeded; returns True if started"""
+    with warmup_lock:
+        if warmup_status["state"] in ("running", "ready"):
+            return False
+        warmup_status["state"] = "running"
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    return True
 
-# Compile the graph
-app_graph = workflow.compile()
+def is_ready() -> bool:
+    return warmup_status["state"] == "ready"
 
 
 # --- Flask Routes ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(registry.render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_snapshot():
+    """The same metrics as JSON, with p50/p95/p99 over recent samples for each histogram"""
+    return jsonify(registry.snapshot())
+
 @app.route('/')
 def index():
     collections = get_available_collections_internal()
@@ -666,40 +2674,532 @@ def index():
 
 @app.route('/healthz', methods=['GET'])
 def healthz():
-    return jsonify({"ok": True})
-
-@app.route('/api/query', methods=['POST'])
-def query_api_route():
-    data = request.json
-    
-    initial_graph_input = {
+    """Liveness: the process is up and serving. Readiness is reported alongside but never fails this probe."""
+    return jsonify({"ok": True, "live": True, "ready": is_ready(), "warmup": warmup_status["state"], "gemini_circuit": gemini_breaker.state})
+
+@app.route('/healthz/ready', methods=['GET'])
+def readyz():
+    """Readiness: 200 once warm-up has succeeded, 503 before that. Starts (or retries a failed) warm-up."""
+    start_warm_up()
+    body = {"ready": is_ready(), "warmup": warmup_status}
+    return jsonify(body), (200 if body["ready"] else 503)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "refined_query": refined_query_cache.stats(),
+        "query_embedding": query_embedding_cache.stats(),
+        "answer": answer_cache.stats() if answer_cache else None,
+        "result": result_store.stats() if result_store else None
+    })
+
+@app.route('/api/embedding/stats', methods=['GET'])
+def embedding_stats():
+    return jsonify({"batching": embedding_batcher.stats() if embedding_batcher else None})
+
+def is_cache_admin_request() -> bool:
+    """With CACHE_ADMIN_TOKEN set, the request must carry it as a bearer token; otherwise it must come from this host"""
+    if CACHE_ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"), f"Bearer {CACHE_ADMIN_TOKEN}".encode("utf-8"))
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+@app.route('/api/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """Call after re-ingesting collections so cached answers and local indexes are rebuilt"""
+    if not is_cache_admin_request():
+        logger.warning(f"Refused cache invalidation from {request.remote_addr}")
+        return jsonify({"error": "Cache invalidation requires the admin token or a request from localhost"}), 403
+    data = request.json or {}
+    collections = data.get('collections')
+    removed = answer_cache.invalidate_collections(collections) if answer_cache else 0
+    collection_catalogue.invalidate()
+    for collection_name in (collections or [None]):
+        lexical_index.invalidate(collection_name)
+        if isinstance(search_backend, LocalVectorStore):
+            search_backend.invalidate(collection_name)
+    return jsonify({"invalidated_answers": removed, "collections": collections or "all"})
+
+@app.route('/api/collections', methods=['GET'])
+def list_collections_route():
+    return jsonify({"collections": collection_catalogue.get() or {}, "catalogue": collection_catalogue.stats()})
+
+class InvalidRequestError(ValueError):
+    """A request field that cannot be used as given; routes answer it with a 400"""
+
+def request_number(data: Dict[str, Any], field: str, cast, default: Any) -> Any:
+    value = data.get(field)
+    if value is None or value == "":
+        return default
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        raise InvalidRequestError(f"{field} must be a number")
+    if isinstance(value, bool) or not math.isfinite(number):
+        raise InvalidRequestError(f"{field} must be a number")
+    return number
+
+def build_graph_input(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Raises InvalidRequestError for numeric fields that are not numbers (or out of range)"""
+    chunk_limit = request_number(data, 'chunk_limit', int, 5)
+    return {
         "original_query": data.get('query', ''),
         "selected_collections": data.get('collections', []),
-        "initial_chunk_limit": int(data.get('chunk_limit', 5)),
-        "similarity_threshold": float(data.get('similarity_threshold', 0.0)),
-        "temperature": float(data.get('temperature', 0.7)),
-        "current_chunk_limit": int(data.get('chunk_limit', 5)),
+        "initial_chunk_limit": chunk_limit,
+        "similarity_threshold": request_number(data, 'similarity_threshold', float, 0.0),
+        "temperature": request_number(data, 'temperature', float, 0.7),
+        "current_chunk_limit": chunk_limit,
         "max_chunk_limit": 15,
         "iteration_count": 1,
         "max_iterations": 3,
+        "token_budget": request_token_budget(data.get('token_budget')),
+        "deadline": request_deadline(data.get('deadline_seconds')),
+        "response_mode": data.get('response_mode', 'full'),
     }
-    
-    if not initial_graph_input["original_query"]:
-        return jsonify({"error": "Query is required"}), 400
-    if not initial_graph_input["selected_collections"]:
-        return jsonify({"error": "At least one collection must be selected"}), 400
 
-    final_state = app_graph.invoke(initial_graph_input)
+def request_deadline(requested_seconds: Any) -> float | None:
+    """Epoch deadline for a request arriving now: the requested seconds (capped) or REQUEST_DEADLINE_SECONDS.
+    A request can shorten or (up to the cap) extend its deadline, never remove it"""
+    seconds = request_number({"deadline_seconds": requested_seconds}, "deadline_seconds", float, None)
+    if seconds is None:
+        seconds = REQUEST_DEADLINE_SECONDS
+    elif seconds <= 0:
+        raise InvalidRequestError("deadline_seconds must be greater than 0")
+    else:
+        seconds = min(seconds, REQUEST_DEADLINE_MAX_SECONDS)
+    return time.time() + seconds if seconds > 0 else None
+
+def request_token_budget(requested: Any) -> int:
+    """A request may lower the server's TOKEN_BUDGET_PER_REQUEST but not raise it (0 = unlimited)"""
+    requested = request_number({"token_budget": requested}, "token_budget", int, None)
+    if requested is None:
+        return TOKEN_BUDGET_PER_REQUEST
+    if requested <= 0:
+        raise InvalidRequestError("token_budget must be greater than 0")
+    return min(requested, TOKEN_BUDGET_PER_REQUEST) if TOKEN_BUDGET_PER_REQUEST else requested
+
+def validate_graph_input(graph_input: Dict[str, Any]) -> str | None:
+    if not graph_input["original_query"]:
+        return "Query is required"
+    if not graph_input["selected_collections"]:
+        return "At least one collection must be selected"
+    if graph_input["response_mode"] not in RESPONSE_MODES:
+        return f"response_mode must be one of: {', '.join(RESPONSE_MODES)}"
+    if VALIDATE_COLLECTIONS:
+        unknown = collection_catalogue.unknown(graph_input["selected_collections"])
+        if unknown:
+            return f"Unknown collection(s): {', '.join(unknown)}"
+    return None
+
+def answer_cache_params_key(graph_input: Dict[str, Any]) -> str:
+    return SemanticAnswerCache.params_key(
+        graph_input["selected_collections"],
+        graph_input["temperature"],
+        graph_input["initial_chunk_limit"],
+        graph_input["similarity_threshold"]
+    )
+
+# "full" chunks carry their text and complete metadata; "compact" ones only identify the chunk and its source
+RESPONSE_MODES = ("full", "compact")
+
+def compact_chunk(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    compact = {"id": chunk.get("id"), "collection": chunk.get("collection"), "score": chunk.get("score")}
+    for field in ("fusion_score", "bm25_score"):
+        if chunk.get(field) is not None:
+            compact[field] = chunk[field]
+    compact["source"] = format_source_info(chunk)
+    return compact
+
+def present_chunks(chunks: List[Dict[str, Any]] | None, response_mode: str) -> List[Dict[str, Any]]:
+    """Chunks as a response shows them: hydrated in full mode, compacted (no text, no extra fetch) otherwise"""
+    if response_mode == "compact":
+        return [compact_chunk(chunk) for chunk in chunks or []]
+    return hydrate_chunks(chunks or [])
+
+def present_response(final_json_response: Dict[str, Any], response_mode: str) -> Dict[str, Any]:
+    """The response body for a final (or cached) response; the cache keeps the unpresented form"""
+    if "chunks" not in final_json_response:
+        return final_json_response
+    return dict(final_json_response, chunks=present_chunks(final_json_response["chunks"], response_mode))
+
+def store_result(final_json_response: Dict[str, Any]) -> Dict[str, str]:
+    """Keep an answered (unpresented) response in the result store; returns the fields to add to what the client gets"""
+    if result_store is None or final_json_response.get("error"):
+        return {}
+    return {"result_id": result_store.put(final_json_response)}
+
+def is_cacheable_response(final_json_response: Dict[str, Any]) -> bool:
+    """Whether an answer may be replayed to later requests. Answers cut short by a deadline, or by a
+    token budget (which is not part of the params key), would be replayed to requests that could afford more."""
+    return (not final_json_response.get("error")
+            and final_json_response.get("critique_assessment") != "ERROR_IN_CRITIQUE"
+            and final_json_response.get("answer_source") != "fallback"
+            and not final_json_response.get("time_limited")
+            and final_json_response.get("retry_stopped_by") != "token_budget")
+
+def lookup_cached_answer(graph_input: Dict[str, Any]) -> tuple[Any, str, tuple | None]:
+    """Returns (query_vector, params_key, cached) for the answer cache; cached is (response, similarity) on a hit"""
+    query_vector = embed_query_internal(graph_input["original_query"])
+    params_key = answer_cache_params_key(graph_input)
+    cached = answer_cache.lookup(query_vector, params_key)
+    if cached is not None:
+        logger.info(f"Answer cache hit (similarity {cached[1]:.3f}) for '{graph_input['original_query']}'")
+    return query_vector, params_key, cached
+
+def remember_answer(graph_input: Dict[str, Any], query_vector: Any, params_key: str, final_json_response: Dict[str, Any]) -> None:
+    if is_cacheable_response(final_json_response):
+        answer_cache.store(graph_input["original_query"], query_vector, params_key, graph_input["selected_collections"], final_json_response)
+
+def response_body(final_json_response: Dict[str, Any], response_mode: str, similarity: float | None = None) -> Dict[str, Any]:
+    """A final answer (cached when similarity is given) as returned to clients: shaped for the
+    response mode and tagged with its result store id; hydrating projected chunks may query the backend"""
+    body = present_response(final_json_response, response_mode)
+    if similarity is not None:
+        body = dict(body, answer_cache={"hit": True, "similarity": similarity})
+    return dict(body, **store_result(final_json_response))
+
+def graph_error_body(graph_input: Dict[str, Any], final_state: Dict[str, Any]) -> Dict[str, Any]:
+    error_msg = final_state.get("error_message", "An unexpected error occurred in the graph processing.")
+    return {
+        "error": error_msg,
+        "original_query": graph_input["original_query"],
+        "response": error_msg
+    }
+
+@app.route('/api/query', methods=['POST'])
+def query_api_route():
+    data = request.json
+    
+    try:
+        initial_graph_input = build_graph_input(data)
+    except InvalidRequestError as e:
+        return jsonify({"error": str(e)}), 400
+    validation_error = validate_graph_input(initial_graph_input)
+    if validation_error:
+        return jsonify({"error": validation_error}), 400
+
+    use_answer_cache = answer_cache is not None and data.get('use_cache', True)
+    if use_answer_cache:
+        query_vector, params_key, cached = lookup_cached_answer(initial_graph_input)
+        if cached is not None:
+            cached_response, similarity = cached
+            return jsonify(response_body(cached_response, initial_graph_input["response_mode"], similarity))
+
+    final_state = app_graph.get().invoke(initial_graph_input)
     
     if final_state.get("final_json_response"):
-        return jsonify(final_state["final_json_response"])
+        final_json_response = final_state["final_json_response"]
+        if use_answer_cache:
+            remember_answer(initial_graph_input, query_vector, params_key, final_json_response)
+        return jsonify(response_body(final_json_response, initial_graph_input["response_mode"]))
     else:
-        error_msg = final_state.get("error_message", "An unexpected error occurred in the graph processing.")
-        return jsonify({
-            "error": error_msg,
-            "original_query": initial_graph_input["original_query"],
-            "response": error_msg
-        }), 500
+        return jsonify(graph_error_body(initial_graph_input, final_state)), 500
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def chunks_event(iteration: int, refined_query: str | None, chunks: List[Dict[str, Any]] | None, response_mode: str) -> str:
+    """The "chunks" event; hydrating projected chunks may query the backend"""
+    return sse_event("chunks", {"iteration": iteration, "refined_query": refined_query, "chunks": present_chunks(chunks, response_mode)})
+
+def retry_event(state: GraphState) -> str:
+    return sse_event("retry", {"iteration": state['iteration_count'], "chunk_limit": state['current_chunk_limit']})
+
+def final_event(final_json_response: Dict[str, Any], similarity: float | None = None) -> str:
+    """The "final" event; chunks were already sent with the last "chunks" event"""
+    payload = {k: v for k, v in final_json_response.items() if k != "chunks"}
+    if similarity is not None:
+        payload["answer_cache"] = {"hit": True, "similarity": similarity}
+    return sse_event("final", dict(payload, **store_result(final_json_response)))
+
+def cached_answer_events(cached_response: Dict[str, Any], similarity: float, response_mode: str = "full") -> List[str]:
+    """Replay a cached answer as the same event sequence a live run produces"""
+    return [
+        chunks_event(cached_response.get("iterations_done", 1), cached_response.get("refined_query_for_search"), cached_response.get("chunks"), response_mode),
+        sse_event("token", {"text": cached_response.get("response", "")}),
+        final_event(cached_response, similarity)
+    ]
+
+def stream_query_events(graph_input: Dict[str, Any], use_answer_cache: bool):
+    """Run the graph's nodes step by step, emitting server-sent events as soon as each result exists:
+    "chunks" after retrieval, "token" per generated text piece, "retry" when the critique asks for
+    more context (the client should discard the streamed answer), then "final" with critique and token info"""
+    if use_answer_cache:
+        query_vector, params_key, cached = lookup_cached_answer(graph_input)
+        if cached is not None:
+            yield from cached_answer_events(*cached, graph_input["response_mode"])
+            return
+
+    state = dict(graph_input)
+    state.update(initialize_state_node(state))
+    if not state.get("error_message"):
+        state.update(refine_query_node(state))
+
+    while not state.get("error_message"):
+        state.update(semantic_search_node(state))
+        if state.get("error_message"):
+            break
+        yield chunks_event(state['iteration_count'], state['refined_query'], state['search_results'], state['response_mode'])
+
+        stream = stream_gemini_response_internal(state['original_query'], state['search_results'], state['temperature'], state['deadline'])
+        with STAGE_SECONDS.time(stage="generate_response_stream"):
+            while True:
+                try:
+                    piece = next(stream)
+                except StopIteration as stop:
+                    response_data = stop.value
+                    break
+                yield sse_event("token", {"text": piece})
+        state.update(generation_state_update(state, response_data))
+
+        state.update(critique_response_node(state))
+        if should_retry_search_edge(state) != "update_state_for_retry":
+            break
+        state.update(update_state_for_retry_node(state))
+        yield retry_event(state)
+
+    final_json_response = prepare_final_output_node(state)["final_json_response"]
+    if use_answer_cache:
+        remember_answer(graph_input, query_vector, params_key, final_json_response)
+    yield final_event(final_json_response)
+
+@app.route('/api/query/stream', methods=['POST'])
+def query_stream_api_route():
+    data = request.json
+
+    try:
+        initial_graph_input = build_graph_input(data)
+    except InvalidRequestError as e:
+        return jsonify({"error": str(e)}), 400
+    validation_error = validate_graph_input(initial_graph_input)
+    if validation_error:
+        return jsonify({"error": validation_error}), 400
+    use_answer_cache = answer_cache is not None and data.get('use_cache', True)
+
+    def generate():
+        try:
+            yield from stream_query_events(initial_graph_input, use_answer_cache)
+        except Exception as e:
+            logger.error(f"Error while streaming query response: {e}")
+            yield sse_event("error", {"error": str(e), "original_query": initial_graph_input["original_query"]})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# --- Batch Queries ---
+def batch_request_error(data: Dict[str, Any]) -> str | None:
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        return "queries must be a non-empty list"
+    if len(queries) > BATCH_MAX_QUERIES:
+        return f"A batch may hold at most {BATCH_MAX_QUERIES} queries"
+    if not all(isinstance(item, (str, dict)) for item in queries):
+        return "Each query must be a string or an object"
+    return None
+
+def parse_batch_items(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One request per entry of data['queries']: a query string, or an object whose fields
+    (query, id, collections, chunk_limit, ...) override the batch-level ones"""
+    shared = {key: value for key, value in data.items() if key != 'queries'}
+    return [dict(shared, **({"query": item} if isinstance(item, str) else item)) for item in data['queries']]
+
+def batch_line(item: Dict[str, Any], index: int, payload: Dict[str, Any]) -> str:
+    tag = {"index": index, "id": item["id"]} if "id" in item else {"index": index}
+    return json.dumps(dict(tag, **payload)) + "\n"
+
+def refine_batch_query(graph_input: Dict[str, Any], deadline_seconds: Any) -> tuple[Dict[str, Any], float]:
+    """Initialize and refine one batch query; returns (state, time refinement finished)"""
+    # The deadline starts when this query's own work does, not when the batch arrived
+    state = dict(graph_input, deadline=request_deadline(deadline_seconds))
+    try:
+        state.update(initialize_state_node(state))
+        if not state.get("error_message"):
+            state.update(refine_query_node(state))
+    except Exception as e:
+        logger.error(f"Error refining batch query '{graph_input['original_query']}': {e}")
+        state["error_message"] = str(e)
+    return state, time.time()
+
+def prefetch_batch_candidates(states: List[Dict[str, Any]]) -> None:
+    """Fill in candidate_results for refined states with one semantic_search_batch_internal call
+    (covering every query variant of every state when MULTI_QUERY_ENABLED)"""
+    pending = [state for state in states if not state.get("error_message") and state.get('candidate_results') is None]
+    if not pending:
+        return
+    pool_sizes = [max(state['current_chunk_limit'], state['max_chunk_limit']) for state in pending]
+    variants = [
+        query_variants(state['original_query'], state['refined_query']) if MULTI_QUERY_ENABLED else [state['refined_query']]
+        for state in pending
+    ]
+    with STAGE_SECONDS.time(stage="batch_search"):
+        rankings = iter(semantic_search_batch_internal([
+            {
+                "query_text": variant,
+                "collections": state['selected_collections'],
+                "limit": pool_size,
+                "similarity_threshold": state['similarity_threshold']
+            }
+            for state, pool_size, state_variants in zip(pending, pool_sizes, variants) for variant in state_variants
+        ]))
+        for state, pool_size, state_variants in zip(pending, pool_sizes, variants):
+            candidates = fuse_query_variant_results(
+                [next(rankings) for _ in state_variants], state['selected_collections'], pool_size,
+                state['original_query'] if HYBRID_SEARCH_ENABLED else None
+            )
+            state.update(candidate_results=candidates, candidate_pool_size=pool_size)
+
+def answer_batch_query(state: Dict[str, Any], refined_at: float) -> Dict[str, Any]:
+    """Generation, critique and retries for one batch query whose candidates were prefetched; returns the final response"""
+    if state.get('deadline') is not None:
+        # Time spent waiting for the rest of the batch does not count against this query
+        state['deadline'] += time.time() - refined_at
+    while not state.get("error_message"):
+        state.update(semantic_search_node(state))
+        if state.get("error_message"):
+            break
+        state.update(generate_response_node(state))
+        state.update(critique_response_node(state))
+        if should_retry_search_edge(state) != "update_state_for_retry":
+            break
+        state.update(update_state_for_retry_node(state))
+    return prepare_final_output_node(state)["final_json_response"]
+
+def batch_query_lines(items: List[Dict[str, Any]], use_answer_cache: bool):
+    """Answer a batch of queries, yielding one JSON line per query as soon as it is done (so in completion
+    order, tagged with its index), then a summary line.
+
+    Answer-cache lookups embed every query in one call; every query is then refined, the refined
+    queries are embedded and searched together (one search per collection), and generation and
+    critique run on batch_executor."""
+    started = time.perf_counter()
+    counts = {"answered": 0, "errors": 0, "answer_cache_hits": 0}
+
+    def emit(index: int, payload: Dict[str, Any], outcome: str) -> str:
+        counts[outcome] += 1
+        return batch_line(items[index], index, payload)
+
+    graph_inputs = {}
+    for index, item in enumerate(items):
+        try:
+            graph_input = dict(build_graph_input(item), speculative_search=False)
+        except InvalidRequestError as e:
+            yield emit(index, {"error": str(e), "original_query": item.get('query', '')}, "errors")
+            continue
+        validation_error = validate_graph_input(graph_input)
+        if validation_error:
+            yield emit(index, {"error": validation_error, "original_query": graph_input["original_query"]}, "errors")
+        else:
+            graph_inputs[index] = graph_input
+
+    query_vectors = {}
+    if use_answer_cache and graph_inputs:
+        query_vectors = dict(zip(graph_inputs, embed_queries_internal([graph_input["original_query"] for graph_input in graph_inputs.values()])))
+        for index in list(graph_inputs):
+            cached = answer_cache.lookup(query_vectors[index], answer_cache_params_key(graph_inputs[index]))
+            if cached is not None:
+                cached_response, similarity = cached
+                graph_input = graph_inputs.pop(index)
+                yield emit(index, response_body(cached_response, graph_input["response_mode"], similarity), "answer_cache_hits")
+
+    refined = dict(zip(graph_inputs, batch_executor.map(
+        lambda index: refine_batch_query(graph_inputs[index], items[index].get('deadline_seconds')), graph_inputs
+    )))
+    prefetch_batch_candidates([state for state, _ in refined.values()])
+
+    futures = {batch_executor.submit(answer_batch_query, state, refined_at): index for index, (state, refined_at) in refined.items()}
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            graph_input = graph_inputs[index]
+            try:
+                final_json_response = future.result()
+            except Exception as e:
+                logger.error(f"Error answering batch query '{graph_input['original_query']}': {e}")
+                yield emit(index, {"error": str(e), "original_query": graph_input["original_query"]}, "errors")
+                continue
+            if use_answer_cache:
+                remember_answer(graph_input, query_vectors[index], answer_cache_params_key(graph_input), final_json_response)
+            yield emit(index, response_body(final_json_response, graph_input["response_mode"]),
+                       "errors" if final_json_response.get("error") else "answered")
+    finally:
+        # Reached early when the client disconnects: drop the queries that have not started
+        for future in futures:
+            future.cancel()
+
+    yield json.dumps({"summary": dict(counts, queries=len(items), seconds=round(time.perf_counter() - started, 3))}) + "\n"
+
+def batch_response_lines(items: List[Dict[str, Any]], use_answer_cache: bool):
+    """batch_query_lines, ending with an error line instead of raising"""
+    try:
+        yield from batch_query_lines(items, use_answer_cache)
+    except Exception as e:
+        logger.error(f"Error while running query batch: {e}")
+        yield json.dumps({"error": str(e)}) + "\n"
+
+@app.route('/api/query/batch', methods=['POST'])
+def query_batch_api_route():
+    """Body: {"queries": [...], plus any /api/query field as the default for every query}; responds with JSON lines"""
+    data = request.json or {}
+    error = batch_request_error(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    use_answer_cache = answer_cache is not None and data.get('use_cache', True)
+    return Response(
+        stream_with_context(batch_response_lines(parse_batch_items(data), use_answer_cache)),
+        mimetype='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/api/chunks', methods=['POST'])
+def chunks_api_route():
+    """Full text and metadata for chunks by id, e.g. the ones a compact response cited.
+    Body: {"chunks": [{"collection": ..., "id": ...}, ...]} or {"result_id": ...} for all of a stored result's chunks"""
+    data = request.json or {}
+    requested = data.get('chunks')
+    if data.get('result_id'):
+        stored = result_store.get(str(data['result_id'])) if result_store else None
+        if stored is None:
+            return jsonify({"error": "Unknown or expired result_id"}), 404
+        requested = [{"collection": chunk.get('collection'), "id": chunk.get('id')} for chunk in stored.get('chunks') or []]
+    if not isinstance(requested, list) or not all(isinstance(ref, dict) and ref.get('collection') and ref.get('id') is not None for ref in requested):
+        return jsonify({"error": "chunks must be a list of {collection, id} objects"}), 400
+    if VALIDATE_COLLECTIONS:
+        unknown = collection_catalogue.unknown(sorted({ref['collection'] for ref in requested}))
+        if unknown:
+            return jsonify({"error": f"Unknown collection(s): {', '.join(unknown)}"}), 400
+
+    point_ids = {}
+    for ref in requested:
+        point_ids.setdefault(ref['collection'], []).append(str(ref['id']))
+    found = {}
+    for collection_name, ids in point_ids.items():
+        try:
+            records = search_backend.retrieve(collection_name, ids)
+        except Exception as e:
+            logger.error(f"Error retrieving chunks from '{collection_name}': {e}")
+            return jsonify({"error": f"Could not retrieve chunks from '{collection_name}': {e}"}), 502
+        for record in records:
+            found[(collection_name, str(record.id))] = {
+                "id": str(record.id),
+                "collection": collection_name,
+                "text": record.payload.get("text", ""),
+                "metadata": payload_metadata(record.payload)
+            }
+    keys = [(ref['collection'], str(ref['id'])) for ref in requested]
+    return jsonify({
+        "chunks": [found[key] for key in keys if key in found],
+        "missing": [{"collection": collection, "id": point_id} for collection, point_id in keys if (collection, point_id) not in found]
+    })
+
+def export_score(chunk: Dict[str, Any]) -> str:
+    if chunk.get('score') is not None:
+        return str(chunk['score'])
+    if chunk.get('bm25_score') is not None:
+        return f"BM25 {chunk['bm25_score']:.2f}"
+    return "Title match" if chunk.get('title_match') else "N/A"
 
 def format_conversation_text(query: str, response: str, chunks: List[Dict]) -> str:
     """Format the conversation as plain text."""
@@ -713,7 +3213,7 @@ def format_conversation_text(query: str, response: str, chunks: List[Dict]) -> s
         text += f"\nChunk {i}:\n"
         text += f"Collection: {chunk.get('collection', 'N/A')}\n"
         text += f"Text: {chunk.get('text', 'N/A')}\n"
-        text += f"Score: {chunk.get('score', 'N/A')}\n"
+        text += f"Score: {export_score(chunk)}\n"
         
         metadata = chunk.get('metadata', {})
         if metadata:
@@ -726,6 +3226,13 @@ def format_conversation_text(query: str, response: str, chunks: List[Dict]) -> s
 
 def create_pdf(query: str, response: str, chunks: List[Dict]) -> bytes:
     """Create a PDF document of the conversation."""
+    # reportlab is only needed for PDF exports, so it is imported on first use
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=72)
     
@@ -773,7 +3280,7 @@ def create_pdf(query: str, response: str, chunks: List[Dict]) -> bytes:
         # Create a table for chunk details
         data = [
             ["Collection:", chunk.get('collection', 'N/A')],
-            ["Score:", str(chunk.get('score', 'N/A'))],
+            ["Score:", export_score(chunk)],
             ["Text:", chunk.get('text', 'N/A')]
         ]
         
@@ -797,47 +3304,72 @@ def create_pdf(query: str, response: str, chunks: List[Dict]) -> bytes:
     buffer.seek(0)
     return buffer.getvalue()
 
-@app.route('/api/download/<format>', methods=['POST'])
-def download_conversation(format):
-    data = request.json
-    query = data.get('query', '')
-    response = data.get('response', '')
-    chunks = data.get('chunks', [])
-    
-    if format not in ['txt', 'pdf']:
-        return jsonify({"error": "Invalid format. Must be 'txt' or 'pdf'"}), 400
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
+EXPORT_MIMETYPES = {"txt": "text/plain", "pdf": "application/pdf"}
+
+def render_export(format: str, query: str, response: str, chunks: List[Dict]) -> bytes:
     if format == 'txt':
-        text_content = format_conversation_text(query, response, chunks)
-        buffer = io.BytesIO(text_content.encode('utf-8'))
-        filename = f"conversation_{timestamp}.txt"
-        mimetype = 'text/plain'
-    else:  # pdf
-        buffer = io.BytesIO(create_pdf(query, response, chunks))
-        filename = f"conversation_{timestamp}.pdf"
-        mimetype = 'application/pdf'
-    
-    buffer.seek(0)
+        return format_conversation_text(query, response, chunks).encode('utf-8')
+    return create_pdf(query, response, chunks)
+
+def render_result_export(format: str, result: Dict[str, Any]) -> bytes:
+    # Stored chunks may be projected; exports show full metadata
+    return render_export(format, result.get('original_query', ''), result.get('response', ''), hydrate_chunks(result.get('chunks') or []))
+
+def send_export(content: bytes, format: str, created_at: float):
+    timestamp = datetime.fromtimestamp(created_at).strftime("%Y%m%d_%H%M%S")
     return send_file(
-        buffer,
-        mimetype=mimetype,
+        io.BytesIO(content),
+        mimetype=EXPORT_MIMETYPES[format],
         as_attachment=True,
-        download_name=filename
+        download_name=f"conversation_{timestamp}.{format}"
     )
 
+def download_result(result_id: str, format: str):
+    exported = result_store.export(result_id, format, functools.partial(render_result_export, format)) if result_store else None
+    if exported is None:
+        return jsonify({"error": "Unknown or expired result_id"}), 404
+    content, created_at = exported
+    return send_export(content, format, created_at)
+
+@app.route('/api/download/<format>', methods=['POST'])
+def download_conversation(format):
+    """Body: {"result_id": ...} for an answer kept in the result store, or the query, response and chunks themselves"""
+    data = request.json or {}
+    if format not in EXPORT_MIMETYPES:
+        return jsonify({"error": "Invalid format. Must be 'txt' or 'pdf'"}), 400
+    if data.get('result_id'):
+        return download_result(str(data['result_id']), format)
+
+    content = render_export(format, data.get('query', ''), data.get('response', ''), data.get('chunks', []))
+    return send_export(content, format, time.time())
+
+@app.route('/api/results/<result_id>', methods=['GET'])
+def get_result(result_id):
+    stored = result_store.get(result_id) if result_store else None
+    if stored is None:
+        return jsonify({"error": "Unknown or expired result_id"}), 404
+    response_mode = request.args.get('response_mode', 'full')
+    if response_mode not in RESPONSE_MODES:
+        return jsonify({"error": f"response_mode must be one of: {', '.join(RESPONSE_MODES)}"}), 400
+    return jsonify(dict(present_response(stored, response_mode), result_id=result_id))
+
+@app.route('/api/results/<result_id>/download/<format>', methods=['GET'])
+def download_result_route(result_id, format):
+    """Re-downloadable export link; each format is rendered once per stored result"""
+    if format not in EXPORT_MIMETYPES:
+        return jsonify({"error": "Invalid format. Must be 'txt' or 'pdf'"}), 400
+    return download_result(result_id, format)
+
 if __name__ == '__main__':
     if not GOOGLE_API_KEY:
-        print("WARNING: GOOGLE_API_KEY is not set. Please add it to your .env file.")
+        logger.warning("GOOGLE_API_KEY is not set. Please add it to your .env file.")
 
-    try:
-        collections = get_available_collections_internal()
-        print(f"Available collections: {collections}")
-    except Exception as e:
-        print(f"Error connecting to Qdrant: {e}")
+    # With the reloader on, this block runs once in the file watcher and again in the serving child;
+    # only the child should load the model and connect to the search backend
+    if WARMUP_ON_START and (not FLASK_USE_RELOADER or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        start_warm_up()
 
-    app.run(debug=True)
+    app.run(debug=FLASK_DEBUG, use_reloader=FLASK_USE_RELOADER)
 
 #To run:
 #/Users/mason/opt/anaconda3/envs/psai/bin/python /Users/mason/Desktop/Technical_Projects/PYTHON_Projects/PSAI/code/app2.py
\ No newline at end of file
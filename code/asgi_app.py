@@ -0,0 +1,823 @@
+"""Async serving path for the query endpoints (uvicorn asgi_app:app --app-dir code); other routes go to the Flask app"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Tuple
+
+from app2 import (
+    app as flask_app,
+    GEMINI_MODEL,
+    GENERATION_ERROR_RESULT,
+    HTTP_SECONDS,
+    MULTI_QUERY_ENABLED,
+    PAYLOAD_PROJECTION_ENABLED,
+    QDRANT_API_KEY,
+    QDRANT_URL,
+    SEARCH_BACKEND,
+    SEARCH_FAILURES,
+    SEARCH_MAX_WORKERS,
+    SEARCH_PAYLOAD_FIELDS,
+    SEARCH_SECONDS,
+    SEARCH_TIMEOUT_SECONDS,
+    STAGE_SECONDS,
+    WARMUP_ON_START,
+    APIError,
+    CachedContentError,
+    GraphState,
+    InvalidRequestError,
+    LazyResource,
+    RequestDeadlineError,
+    StreamedAnswer,
+    accept_gemini_refinement,
+    answer_cache,
+    batch_request_error,
+    batch_response_lines,
+    build_app_graph,
+    build_critique_request,
+    build_generation_prompt,
+    build_graph_input,
+    build_refinement_request,
+    cached_answer_events,
+    candidate_pool_to_fetch,
+    candidate_search_arguments,
+    chunks_event,
+    config_with_deadline,
+    critique_error_result,
+    critique_state_update,
+    critique_update_without_llm,
+    deadline_skipped_critique,
+    embed_queries_internal,
+    embed_query_internal,
+    fallback_refinement,
+    final_event,
+    format_search_result,
+    fuse_query_variant_results,
+    fuse_speculative_results,
+    gemini_admission_delay,
+    gemini_attempt_error,
+    gemini_retry,
+    gemini_token_usage,
+    genai_client_instance,
+    generation_config,
+    generation_fallback_result,
+    generation_input_error,
+    generation_state_update,
+    graph_error_body,
+    initialize_state_node,
+    instruction_cache,
+    instrumented_node,
+    keep_speculative_results,
+    logger,
+    lookup_cached_answer,
+    make_generation_result,
+    observe_gemini_attempt,
+    parse_batch_items,
+    prepare_final_output_node,
+    record_gemini_outcome,
+    refine_query_without_llm,
+    rank_search_results,
+    refinement_state_update,
+    remember_answer,
+    response_body,
+    retry_event,
+    search_backend,
+    search_input_error,
+    search_payload_selector,
+    search_state_update,
+    should_retry_search_edge,
+    speculative_search_arguments,
+    sse_event,
+    start_warm_up,
+    trace_span,
+    update_state_for_retry_node,
+    validate_graph_input,
+)
+
+# --- Configuration ---
+# Query requests processed at once; others wait up to ASYNC_QUEUE_TIMEOUT_SECONDS and are then rejected with 503
+ASYNC_MAX_INFLIGHT_REQUESTS = int(os.getenv("ASYNC_MAX_INFLIGHT_REQUESTS", "64"))
+ASYNC_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ASYNC_QUEUE_TIMEOUT_SECONDS", "30"))
+# Gemini calls (and open streams) in flight across all requests
+ASYNC_MAX_CONCURRENT_GEMINI = int(os.getenv("ASYNC_MAX_CONCURRENT_GEMINI", "16"))
+# Per-collection searches in flight
+ASYNC_MAX_CONCURRENT_SEARCHES = int(os.getenv("ASYNC_MAX_CONCURRENT_SEARCHES", str(SEARCH_MAX_WORKERS * 2)))
+# Batch requests streaming at once
+ASYNC_MAX_CONCURRENT_BATCHES = int(os.getenv("ASYNC_MAX_CONCURRENT_BATCHES", "4"))
+
+request_semaphore = asyncio.Semaphore(ASYNC_MAX_INFLIGHT_REQUESTS)
+gemini_semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_GEMINI)
+search_semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_SEARCHES)
+# Batch requests block a thread for as long as they stream, so they get a pool of their own
+batch_stream_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_CONCURRENT_BATCHES, thread_name_prefix="async-batch")
+
+
+class ServerBusyError(Exception):
+    """Raised when a request waited too long for a processing slot"""
+
+
+@contextlib.asynccontextmanager
+async def request_slot():
+    try:
+        await asyncio.wait_for(request_semaphore.acquire(), ASYNC_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise ServerBusyError(f"No request slot free after {ASYNC_QUEUE_TIMEOUT_SECONDS}s")
+    try:
+        yield
+    finally:
+        request_semaphore.release()
+
+
+# --- Search backends ---
+class AsyncQdrantSearchBackend:
+    """Async twin of app2.QdrantSearchBackend"""
+
+    def __init__(self, client: LazyResource, payload_fields: List[str] | None = None):
+        self._client = client
+        self.projects_payload = bool(payload_fields)
+        self.with_payload = search_payload_selector(payload_fields)
+
+    @property
+    def client(self) -> Any:
+        return self._client.get()
+
+    async def search(self, collection_name: str, query_vector: List[float], limit: int, score_threshold: float | None = None) -> List[Any]:
+        return await self.client.search(
+            collection_name=collection_name,
+            query_vector=query_vector,
+            limit=limit,
+            with_payload=self.with_payload,
+            score_threshold=score_threshold,
+            timeout=max(1, int(SEARCH_TIMEOUT_SECONDS))
+        )
+
+    async def search_batch(self, collection_name: str, query_vectors: List[List[float]], limit: int, score_threshold: float | None = None) -> List[List[Any]]:
+        from qdrant_client import models
+        return await self.client.search_batch(
+            collection_name=collection_name,
+            requests=[
+                models.SearchRequest(vector=query_vector, limit=limit, with_payload=self.with_payload, score_threshold=score_threshold)
+                for query_vector in query_vectors
+            ],
+            timeout=max(1, int(SEARCH_TIMEOUT_SECONDS))
+        )
+
+
+class ThreadedSearchBackend:
+    """Runs a blocking backend (the in-process local index) on the default thread pool"""
+
+    def __init__(self, backend: Any):
+        self.backend = backend
+        self.projects_payload = getattr(backend, "projects_payload", False)
+
+    async def search(self, collection_name: str, query_vector: List[float], limit: int, score_threshold: float | None = None) -> List[Any]:
+        return await asyncio.to_thread(self.backend.search, collection_name, query_vector, limit, score_threshold)
+
+    async def search_batch(self, collection_name: str, query_vectors: List[List[float]], limit: int, score_threshold: float | None = None) -> List[List[Any]]:
+        return await asyncio.to_thread(self.backend.search_batch, collection_name, query_vectors, limit, score_threshold)
+
+
+def create_async_qdrant_client() -> Any:
+    from qdrant_client import AsyncQdrantClient
+    return AsyncQdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+
+
+async_qdrant_client = LazyResource("async_qdrant_client", create_async_qdrant_client)
+async_search_backend = (
+    AsyncQdrantSearchBackend(async_qdrant_client, SEARCH_PAYLOAD_FIELDS if PAYLOAD_PROJECTION_ENABLED else None)
+    if SEARCH_BACKEND == "qdrant" else ThreadedSearchBackend(search_backend)
+)
+
+
+async def search_collection_async(collection_name: str, query_vector: List[float], limit: int = 5, similarity_threshold: float = 0.0) -> List[Dict[str, Any]]:
+    async with search_semaphore:
+        with trace_span("search.collection", collection=collection_name), SEARCH_SECONDS.time(collection=collection_name):
+            search_results = await async_search_backend.search(collection_name, query_vector, limit, similarity_threshold)
+    return [format_search_result(collection_name, result, async_search_backend.projects_payload) for result in search_results]
+
+
+async def semantic_search_async(query_text: str, collections: List[str], limit: int = 5, similarity_threshold: float = 0.0, lexical_query: str | None = None,
+                                timeout: float = SEARCH_TIMEOUT_SECONDS) -> List[Dict[str, Any]]:
+    """Async twin of app2.semantic_search_internal: all collections are searched at once under one deadline"""
+    query_vector = await asyncio.to_thread(embed_query_internal, query_text)
+    tasks = [
+        asyncio.create_task(search_collection_async(collection_name, query_vector, limit, similarity_threshold))
+        for collection_name in collections
+    ]
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+    # Collect in request order so ties in the merged ranking break the same way as a serial loop
+    all_results = []
+    for collection_name, task in zip(collections, tasks):
+        if task in pending:
+            SEARCH_FAILURES.inc(collection=collection_name, reason="timeout")
+            logger.warning(f"Search in collection {collection_name} timed out after {timeout:.1f}s; returning partial results")
+        elif task.exception() is not None:
+            SEARCH_FAILURES.inc(collection=collection_name, reason="error")
+            logger.error(f"Error searching collection {collection_name}: {task.exception()}")
+        else:
+            all_results.extend(task.result())
+    return await asyncio.to_thread(rank_search_results, all_results, collections, limit, lexical_query)
+
+
+async def multi_query_search_async(variants: List[str], collections: List[str], limit: int = 5, similarity_threshold: float = 0.0,
+                                   lexical_query: str | None = None, timeout: float = SEARCH_TIMEOUT_SECONDS) -> List[Dict[str, Any]]:
+    """Async twin of app2.multi_query_search_internal: one embedding call, one batched search per collection"""
+    logger.info(f"Multi-query search over {len(variants)} variants: {variants}")
+    query_vectors = await asyncio.to_thread(embed_queries_internal, variants)
+
+    async def search_collection_batch(collection_name: str) -> List[List[Dict[str, Any]]]:
+        async with search_semaphore:
+            with trace_span("search.collection_batch", collection=collection_name, queries=len(variants)), SEARCH_SECONDS.time(collection=collection_name):
+                batch_results = await async_search_backend.search_batch(collection_name, query_vectors, limit, similarity_threshold)
+        return [[format_search_result(collection_name, result, async_search_backend.projects_payload) for result in search_results]
+                for search_results in batch_results]
+
+    tasks = [asyncio.create_task(search_collection_batch(collection_name)) for collection_name in collections]
+    done, pending = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+
+    rankings = [[] for _ in variants]
+    for collection_name, task in zip(collections, tasks):
+        if task in pending:
+            SEARCH_FAILURES.inc(collection=collection_name, reason="timeout")
+            logger.warning(f"Batch search of collection {collection_name} timed out after {timeout:.1f}s; returning partial results")
+        elif task.exception() is not None:
+            SEARCH_FAILURES.inc(collection=collection_name, reason="error")
+            logger.error(f"Error batch searching collection {collection_name}: {task.exception()}")
+        else:
+            for ranking, results in zip(rankings, task.result()):
+                ranking.extend(results)
+    rankings = [rank_search_results(ranking, collections, limit) for ranking in rankings]
+    return await asyncio.to_thread(fuse_query_variant_results, rankings, collections, limit, lexical_query)
+
+
+# --- Gemini ---
+@gemini_retry
+async def call_gemini_async(model: str, prompt: str, config: Any, deadline: float | None = None) -> Any:
+    """Async twin of app2.call_gemini_with_retry; the semaphore is held per attempt, not across backoff"""
+    await asyncio.sleep(gemini_admission_delay("call_gemini_async", deadline))
+    async with gemini_semaphore:
+        config = config_with_deadline(config, deadline)
+        try:
+            with observe_gemini_attempt("call_gemini_async"):
+                response = await genai_client_instance.get().aio.models.generate_content(
+                    model=model,
+                    contents=prompt,
+                    config=config
+                )
+                if not response or not response.text:
+                    raise APIError("Empty response from Gemini API")
+        except Exception as e:
+            error = gemini_attempt_error(e, deadline)
+            record_gemini_outcome(error)
+            raise error
+    record_gemini_outcome(None)
+    return response
+
+
+@gemini_retry
+async def open_gemini_stream_async(model: str, prompt: str, config: Any, deadline: float | None = None) -> Tuple[Any, Any]:
+    """Start a streaming Gemini call, retrying until the first chunk arrives; returns (first_chunk, stream).
+
+    Each attempt takes a gemini_semaphore slot and gives it back if it fails, so backoff holds no slot.
+    A successful attempt returns still holding it: the caller releases it once it is done with the stream."""
+    await asyncio.sleep(gemini_admission_delay("open_gemini_stream_async", deadline))
+    config = config_with_deadline(config, deadline)
+    await gemini_semaphore.acquire()
+    try:
+        with observe_gemini_attempt("open_gemini_stream_async"):
+            stream = await genai_client_instance.get().aio.models.generate_content_stream(
+                model=model,
+                contents=prompt,
+                config=config
+            )
+            first_chunk = await anext(stream, None)
+            if first_chunk is None:
+                raise APIError("Empty response from Gemini API")
+    except Exception as e:
+        gemini_semaphore.release()
+        error = gemini_attempt_error(e, deadline)
+        record_gemini_outcome(error)
+        raise error
+    except BaseException:
+        gemini_semaphore.release()
+        raise
+    record_gemini_outcome(None)
+    return first_chunk, stream
+
+
+async def generate_with_cached_instruction_async(call, prompt: str, temperature: float, deadline: float | None = None) -> Any:
+    """Async twin of app2.generate_with_cached_instruction"""
+    cache_name = instruction_cache.handle() if instruction_cache is not None else None
+    if cache_name is not None:
+        try:
+            return await call(model=GEMINI_MODEL, prompt=prompt, config=generation_config(temperature, cache_name), deadline=deadline)
+        except CachedContentError as e:
+            instruction_cache.invalidate(cache_name, e)
+    return await call(model=GEMINI_MODEL, prompt=prompt, config=generation_config(temperature), deadline=deadline)
+
+
+async def refine_query_with_gemini_async(query_text: str, deadline: float | None = None) -> Tuple[str, Dict[str, int] | None]:
+    """Returns (refined_query, token usage), usage None when Gemini failed and the fallback was used"""
+    prompt, config = build_refinement_request(query_text)
+    try:
+        response = await call_gemini_async(model=GEMINI_MODEL, prompt=prompt, config=config, deadline=deadline)
+        return accept_gemini_refinement(query_text, response.text), gemini_token_usage(response, prompt, response.text)
+    except Exception as e:
+        return await asyncio.to_thread(fallback_refinement, query_text, e), None
+
+
+async def generate_gemini_response_async(query: str, context_chunks: List[Dict], temperature: float = 0.7,
+                                         deadline: float | None = None) -> Dict[str, Any]:
+    try:
+        # Packing the context into the prompt is CPU work
+        prompt, formatted_context_string = await asyncio.to_thread(build_generation_prompt, query, context_chunks)
+        try:
+            response = await generate_with_cached_instruction_async(call_gemini_async, prompt, temperature, deadline)
+            return make_generation_result(response.text, formatted_context_string, gemini_token_usage(response, prompt, response.text))
+        except APIError as e:
+            return generation_fallback_result(query, context_chunks, formatted_context_string, e)
+    except Exception as e:
+        logger.error(f"Unexpected error in generate_gemini_response_async: {e}")
+        return dict(GENERATION_ERROR_RESULT)
+
+
+async def stream_gemini_response_async(query: str, context_chunks: List[Dict], temperature: float = 0.7,
+                                       deadline: float | None = None) -> AsyncIterator[Any]:
+    """Async twin of app2.stream_gemini_response_internal: yields text pieces as Gemini produces
+    them, then the result dict as the last item (async generators cannot return a value)"""
+    answer = await asyncio.to_thread(StreamedAnswer, query, context_chunks, deadline)
+    slot_held = False
+    try:
+        first_chunk, stream = await generate_with_cached_instruction_async(open_gemini_stream_async, answer.prompt, temperature, deadline)
+        # The stream occupies the Gemini slot it was opened with until the last chunk arrives
+        slot_held = True
+        async for chunk in prepend_chunk(first_chunk, stream):
+            text = answer.add(chunk)
+            if text:
+                yield text
+            if answer.out_of_time():
+                break
+    except Exception as e:
+        fallback_response = answer.fail(e)
+        if fallback_response:
+            yield fallback_response
+    finally:
+        if slot_held:
+            gemini_semaphore.release()
+    yield answer.result()
+
+
+async def prepend_chunk(first_chunk: Any, stream: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    yield first_chunk
+    async for chunk in stream:
+        yield chunk
+
+
+# --- Graph nodes ---
+# The nodes share their steps with app2's; only the waits on Gemini and the search backend differ,
+# and steps that embed, score or pack text run on the thread pool
+@instrumented_node("refine_query")
+async def refine_query_node_async(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Refine Query Node (Iteration: {state['iteration_count']})")
+    update = await asyncio.to_thread(refine_query_without_llm, state)
+    if update is not None:
+        return update
+
+    speculative_search = speculative_search_arguments(state)
+    speculative_task = asyncio.create_task(semantic_search_async(**speculative_search)) if speculative_search else None
+
+    refined, usage = await refine_query_with_gemini_async(state['original_query'], state['deadline'])
+
+    speculative_results = None
+    if speculative_task is not None:
+        try:
+            speculative_results = await asyncio.wait_for(speculative_task, SEARCH_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning(f"Speculative search failed, will search the refined query only: {e}")
+    return refinement_state_update(state, refined, usage, speculative_results)
+
+
+@instrumented_node("semantic_search")
+async def semantic_search_node_async(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Semantic Search Node (Iteration: {state['iteration_count']}, Chunks: {state['current_chunk_limit']})")
+    error = search_input_error(state)
+    if error:
+        return error
+    pool_size = candidate_pool_to_fetch(state)
+    if pool_size is None:
+        return search_state_update(state)
+
+    candidates = await asyncio.to_thread(keep_speculative_results, state, pool_size)
+    if candidates is None:
+        search = multi_query_search_async if MULTI_QUERY_ENABLED else semantic_search_async
+        candidates = await search(**candidate_search_arguments(state, pool_size))
+        candidates = fuse_speculative_results(candidates, state.get('speculative_results') or [], pool_size)
+    return search_state_update(state, candidates, pool_size)
+
+
+@instrumented_node("generate_response")
+async def generate_response_node_async(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Generate Response Node (Iteration: {state['iteration_count']})")
+    error = generation_input_error(state)
+    if error:
+        return error
+
+    response_data = await generate_gemini_response_async(
+        query=state['original_query'],
+        context_chunks=state['search_results'],
+        temperature=state['temperature'],
+        deadline=state['deadline']
+    )
+    return generation_state_update(state, response_data)
+
+
+@instrumented_node("critique_response")
+async def critique_response_node_async(state: GraphState) -> Dict[str, Any]:
+    logger.debug(f"Running: Critique Response Node (Iteration: {state['iteration_count']})")
+    update = await asyncio.to_thread(critique_update_without_llm, state)
+    if update is not None:
+        return update
+
+    critique_prompt, config = build_critique_request(state)
+    try:
+        response = await call_gemini_async(model=GEMINI_MODEL, prompt=critique_prompt, config=config, deadline=state['deadline'])
+    except RequestDeadlineError:
+        return deadline_skipped_critique()
+    except Exception as e:
+        return {"critique_json": critique_error_result(e)}
+    return critique_state_update(state, critique_prompt, response)
+
+
+async_app_graph = LazyResource("async_app_graph", lambda: build_app_graph(
+    refine_query=refine_query_node_async,
+    semantic_search=semantic_search_node_async,
+    generate_response=generate_response_node_async,
+    critique_response=critique_response_node_async
+))
+
+
+# --- Query handling ---
+async def run_query_async(graph_input: Dict[str, Any], use_answer_cache: bool) -> Tuple[int, Dict[str, Any]]:
+    """Same contract as app2.query_api_route; returns (status, body)"""
+    if use_answer_cache:
+        query_vector, params_key, cached = await asyncio.to_thread(lookup_cached_answer, graph_input)
+        if cached is not None:
+            cached_response, similarity = cached
+            return 200, await asyncio.to_thread(response_body, cached_response, graph_input["response_mode"], similarity)
+
+    final_state = await async_app_graph.get().ainvoke(graph_input)
+
+    if final_state.get("final_json_response"):
+        final_json_response = final_state["final_json_response"]
+        if use_answer_cache:
+            await asyncio.to_thread(remember_answer, graph_input, query_vector, params_key, final_json_response)
+        return 200, await asyncio.to_thread(response_body, final_json_response, graph_input["response_mode"])
+    return 500, graph_error_body(graph_input, final_state)
+
+
+async def stream_query_events_async(graph_input: Dict[str, Any], use_answer_cache: bool) -> AsyncIterator[str]:
+    """Async twin of app2.stream_query_events; emits the same event sequence"""
+    if use_answer_cache:
+        query_vector, params_key, cached = await asyncio.to_thread(lookup_cached_answer, graph_input)
+        if cached is not None:
+            for event in await asyncio.to_thread(cached_answer_events, *cached, graph_input["response_mode"]):
+                yield event
+            return
+
+    state = dict(graph_input)
+    state.update(initialize_state_node(state))
+    if not state.get("error_message"):
+        state.update(await refine_query_node_async(state))
+
+    while not state.get("error_message"):
+        state.update(await semantic_search_node_async(state))
+        if state.get("error_message"):
+            break
+        yield await asyncio.to_thread(chunks_event, state['iteration_count'], state['refined_query'], state['search_results'], state['response_mode'])
+
+        with STAGE_SECONDS.time(stage="generate_response_stream"):
+            async for item in stream_gemini_response_async(state['original_query'], state['search_results'], state['temperature'], state['deadline']):
+                if isinstance(item, dict):
+                    response_data = item
+                else:
+                    yield sse_event("token", {"text": item})
+        state.update(generation_state_update(state, response_data))
+
+        state.update(await critique_response_node_async(state))
+        if should_retry_search_edge(state) != "update_state_for_retry":
+            break
+        state.update(update_state_for_retry_node(state))
+        yield retry_event(state)
+
+    final_json_response = prepare_final_output_node(state)["final_json_response"]
+    if use_answer_cache:
+        await asyncio.to_thread(remember_answer, graph_input, query_vector, params_key, final_json_response)
+    yield await asyncio.to_thread(final_event, final_json_response)
+
+
+def drain_batch_lines(lines: Iterator[str], loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, stop: threading.Event) -> None:
+    """Runs on batch_stream_executor: hands each line of app2's (blocking) batch pipeline to the event loop,
+    then None; once stop is set, the queries that have not started are dropped after the next line"""
+    try:
+        for line in lines:
+            loop.call_soon_threadsafe(queue.put_nowait, line)
+            if stop.is_set():
+                break
+    finally:
+        lines.close()
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+
+# --- ASGI plumbing ---
+async def read_body(receive: Callable) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_json(send: Callable, status: int, payload: Any) -> None:
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def wait_for_disconnect(receive: Callable) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def parse_query_request(receive: Callable) -> Tuple[Dict[str, Any] | None, str | None]:
+    """Returns (data, error) for a JSON query body"""
+    try:
+        data = json.loads(await read_body(receive) or b"null")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return None, "Request body must be a JSON object"
+    return data, None
+
+
+async def query_api_route(scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+    data, error = await parse_query_request(receive)
+    if error:
+        return await send_json(send, 400, {"error": error})
+
+    try:
+        initial_graph_input = build_graph_input(data)
+    except InvalidRequestError as e:
+        return await send_json(send, 400, {"error": str(e)})
+    validation_error = validate_graph_input(initial_graph_input)
+    if validation_error:
+        return await send_json(send, 400, {"error": validation_error})
+    use_answer_cache = answer_cache is not None and data.get('use_cache', True)
+
+    try:
+        async with request_slot():
+            status, payload = await run_query_async(initial_graph_input, use_answer_cache)
+    except ServerBusyError as e:
+        logger.warning(str(e))
+        return await send_json(send, 503, {"error": "Server is busy, please retry shortly"})
+    await send_json(send, status, payload)
+
+
+async def send_stream(receive: Callable, send: Callable, content_type: bytes, events: AsyncIterator[str], description: str) -> bool:
+    """Send events as the body of a streamed 200 response; returns False when the client went away first"""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", content_type),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no")
+        ]
+    })
+
+    async def pump() -> None:
+        async for event in events:
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+
+    # Stop generating (and paying for Gemini tokens) as soon as the client goes away
+    pump_task = asyncio.create_task(pump())
+    disconnect_task = asyncio.create_task(wait_for_disconnect(receive))
+    await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    if not pump_task.done():
+        logger.info(f"Client disconnected; abandoning {description}")
+        pump_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await pump_task
+        return False
+    disconnect_task.cancel()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+    return True
+
+
+async def query_stream_api_route(scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+    data, error = await parse_query_request(receive)
+    if error:
+        return await send_json(send, 400, {"error": error})
+
+    try:
+        initial_graph_input = build_graph_input(data)
+    except InvalidRequestError as e:
+        return await send_json(send, 400, {"error": str(e)})
+    validation_error = validate_graph_input(initial_graph_input)
+    if validation_error:
+        return await send_json(send, 400, {"error": validation_error})
+    use_answer_cache = answer_cache is not None and data.get('use_cache', True)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for event in stream_query_events_async(initial_graph_input, use_answer_cache):
+                yield event
+        except Exception as e:
+            logger.error(f"Error while streaming query response: {e}")
+            yield sse_event("error", {"error": str(e), "original_query": initial_graph_input["original_query"]})
+
+    try:
+        async with request_slot():
+            await send_stream(receive, send, b"text/event-stream; charset=utf-8", events(), f"stream for '{initial_graph_input['original_query']}'")
+    except ServerBusyError as e:
+        logger.warning(str(e))
+        await send_json(send, 503, {"error": "Server is busy, please retry shortly"})
+
+
+async def query_batch_api_route(scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+    """Streams app2's batch pipeline line by line; it blocks on its own executors, so each batch is
+    driven from a thread of batch_stream_executor rather than the pool the other routes offload to"""
+    data, error = await parse_query_request(receive)
+    error = error or batch_request_error(data)
+    if error:
+        return await send_json(send, 400, {"error": error})
+    use_answer_cache = answer_cache is not None and data.get('use_cache', True)
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    async def lines() -> AsyncIterator[str]:
+        while (line := await queue.get()) is not None:
+            yield line
+
+    try:
+        async with request_slot():
+            loop.run_in_executor(batch_stream_executor, drain_batch_lines, batch_response_lines(parse_batch_items(data), use_answer_cache), loop, queue, stop)
+            try:
+                await send_stream(receive, send, b"application/x-ndjson", lines(), f"batch of {len(data['queries'])} queries")
+            finally:
+                stop.set()
+    except ServerBusyError as e:
+        logger.warning(str(e))
+        await send_json(send, 503, {"error": "Server is busy, please retry shortly"})
+
+
+def build_wsgi_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi_app(wsgi_app: Callable, environ: Dict[str, Any]) -> Tuple[int, List[Tuple[str, str]], bytes]:
+    """Run a WSGI app to completion in the calling thread; returns (status, headers, body)"""
+    response = {}
+    body_parts = []
+
+    def start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any = None) -> Callable:
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+        return body_parts.append
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body_parts.extend(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], b"".join(body_parts)
+
+
+async def wsgi_route(scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+    """Serve a Flask route on its own worker thread.  asgiref's WsgiToAsgi is not used because it
+    runs every request on a single shared thread, which would serialise the blocking routes"""
+    body = await read_body(receive)
+    status, headers, response_body = await asyncio.to_thread(call_wsgi_app, flask_app, build_wsgi_environ(scope, body))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    })
+    await send({"type": "http.response.body", "body": response_body})
+
+
+ASYNC_ROUTES = {
+    ("POST", "/api/query"): query_api_route,
+    ("POST", "/api/query/stream"): query_stream_api_route,
+    ("POST", "/api/query/batch"): query_batch_api_route,
+}
+
+
+async def app(scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if WARMUP_ON_START:
+                    start_warm_up()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if async_qdrant_client.loaded:
+                    await async_qdrant_client.get().close()
+                if instruction_cache is not None:
+                    await asyncio.to_thread(instruction_cache.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    route = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+    started = time.perf_counter()
+    status = None
+
+    async def send_and_record_status(message: Dict[str, Any]) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        await send(message)
+
+    try:
+        await (route or wsgi_route)(scope, receive, send_and_record_status)
+    except Exception as e:
+        logger.exception(f"Unhandled error serving {scope['method']} {scope['path']}: {e}")
+        # Once the response has started there is nothing to do but let the server drop the connection
+        if status is None:
+            await send_json(send_and_record_status, 500, {"error": "Internal server error"})
+    finally:
+        # Flask records its own request metrics
+        if route is not None:
+            HTTP_SECONDS.observe(time.perf_counter() - started, route=scope["path"], method=scope["method"], status=status or 500)
+
+
+# --- CLI ---
+def main(argv: List[str] | None = None) -> int:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(app, host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
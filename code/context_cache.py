@@ -0,0 +1,224 @@
+"""Keeps the persona system instruction cached in Gemini, so generation calls send a handle instead of the text"""
+from __future__ import annotations
+
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class CacheHandle(NamedTuple):
+    name: str
+    expires_at: float  # epoch seconds
+
+
+# --- Cache clients ---
+class GenaiCacheClient:
+    """Explicit context caching through ``google.genai``'s ``client.caches``"""
+
+    def __init__(self, client_factory: Callable[[], Any]):
+        # A factory so the genai client is built on first use, not at import
+        self._client_factory = client_factory
+
+    def create(self, model: str, system_instruction: str, ttl_seconds: float, display_name: str) -> CacheHandle:
+        from google.genai import types
+        cached = self._client_factory().caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                display_name=display_name,
+                ttl=f"{int(ttl_seconds)}s",
+            ),
+        )
+        return CacheHandle(cached.name, _expire_time(cached, ttl_seconds))
+
+    def renew(self, name: str, ttl_seconds: float) -> float:
+        from google.genai import types
+        cached = self._client_factory().caches.update(
+            name=name,
+            config=types.UpdateCachedContentConfig(ttl=f"{int(ttl_seconds)}s"),
+        )
+        return _expire_time(cached, ttl_seconds)
+
+    def delete(self, name: str) -> None:
+        self._client_factory().caches.delete(name=name)
+
+
+def _expire_time(cached: Any, ttl_seconds: float) -> float:
+    expire_time = getattr(cached, "expire_time", None)
+    return expire_time.timestamp() if expire_time is not None else time.time() + ttl_seconds
+
+
+class InMemoryCacheClient:
+    """Hands out cache names and tracks expiry locally; never talks to Gemini.
+
+    ``fail_creates`` makes the next N ``create`` calls raise, to exercise the inline fallback."""
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self._clock = clock
+        self._ids = itertools.count(1)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.fail_creates = 0
+
+    def create(self, model: str, system_instruction: str, ttl_seconds: float, display_name: str) -> CacheHandle:
+        if self.fail_creates > 0:
+            self.fail_creates -= 1
+            raise RuntimeError("cache creation failed (InMemoryCacheClient.fail_creates)")
+        name = f"cachedContents/local-{next(self._ids)}"
+        expires_at = self._clock() + ttl_seconds
+        self.entries[name] = {"model": model, "system_instruction": system_instruction,
+                              "display_name": display_name, "expires_at": expires_at}
+        return CacheHandle(name, expires_at)
+
+    def renew(self, name: str, ttl_seconds: float) -> float:
+        entry = self.entries.get(name)
+        if entry is None or entry["expires_at"] <= self._clock():
+            raise KeyError(f"CachedContent not found: {name}")
+        entry["expires_at"] = self._clock() + ttl_seconds
+        return entry["expires_at"]
+
+    def delete(self, name: str) -> None:
+        self.entries.pop(name, None)
+
+
+# --- Handle management ---
+class CachedInstruction:
+    """One system instruction kept alive as cached content for one model.
+
+    ``handle()`` returns the cache name to pass as ``cached_content``, or ``None`` when the
+    instruction should be sent inline (no live handle yet, or caching is failing).  It never
+    calls the cache client: ``refresh()`` does, from warm-up and from the refresher thread that
+    the first ``handle()`` (or ``start()``) launches.  A handle within ``renew_margin_seconds`` of
+    expiry has its TTL extended; if that fails it is used until it actually expires.
+    ``invalidate(name)`` drops a handle Gemini has rejected and wakes the refresher.  Creation can fail
+    (instruction below the model's minimum cacheable size, no explicit caching, quota); it is retried
+    after ``retry_after_seconds``."""
+
+    def __init__(self, cache_client: Any, model: str, system_instruction: str, ttl_seconds: float = 3600,
+                 renew_margin_seconds: float = 300, retry_after_seconds: float = 600,
+                 display_name: str = "psai-system-instruction", clock: Callable[[], float] = time.time,
+                 refresh_in_background: bool = True):
+        self.cache_client = cache_client
+        self.model = model
+        self.system_instruction = system_instruction
+        self.ttl_seconds = ttl_seconds
+        self.renew_margin_seconds = min(renew_margin_seconds, ttl_seconds / 2)
+        self.retry_after_seconds = retry_after_seconds
+        self.display_name = display_name
+        self._clock = clock
+        self.refresh_in_background = refresh_in_background  # False: the caller drives refresh() (tests)
+        self._handle: CacheHandle | None = None
+        self._lock = threading.Lock()
+        self._retry_at = 0.0
+        self._refresher: threading.Thread | None = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self.counts = {"created": 0, "renewed": 0, "create_failures": 0, "renew_failures": 0,
+                       "invalidated": 0, "cached_uses": 0, "inline_uses": 0}
+        self.last_error: str | None = None
+
+    def handle(self) -> str | None:
+        if self._refresher is None and self.refresh_in_background:
+            self.start()
+        current = self._handle
+        if current is not None and current.expires_at > self._clock():
+            self.counts["cached_uses"] += 1
+            return current.name
+        self.counts["inline_uses"] += 1
+        return None
+
+    def refresh(self) -> CacheHandle | None:
+        """Create the cached content or renew its TTL when due; returns the current handle"""
+        with self._lock:
+            return self._refresh(self._clock())
+
+    def next_refresh_in(self) -> float:
+        """Seconds until refresh() has something to do: renewal time, or the end of the failure backoff"""
+        now = self._clock()
+        current = self._handle
+        if current is not None:
+            return max(0.0, current.expires_at - self.renew_margin_seconds - now)
+        return max(0.0, self._retry_at - now)
+
+    def start(self) -> None:
+        """Launch the refresher thread (once)"""
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._run, name="instruction-cache-refresher", daemon=True)
+        self._refresher.start()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as e:  # _refresh handles client errors; this keeps the thread alive regardless
+                logger.warning(f"Cached instruction refresh failed: {e}")
+            # At least a second between passes, so a clock or client misbehaving cannot spin the thread
+            self._wake.wait(max(1.0, self.next_refresh_in()))
+            self._wake.clear()
+
+    def _refresh(self, now: float) -> CacheHandle | None:
+        current = self._handle
+        if current is not None and current.expires_at - now > self.renew_margin_seconds:
+            return current  # another thread refreshed it
+        if current is not None and current.expires_at > now:
+            try:
+                expires_at = self.cache_client.renew(current.name, self.ttl_seconds)
+                self._handle = current = CacheHandle(current.name, expires_at)
+                self.counts["renewed"] += 1
+                return current
+            except Exception as e:
+                self.counts["renew_failures"] += 1
+                self.last_error = str(e)
+                logger.warning(f"Could not renew cached instruction {current.name}, using it until it expires: {e}")
+                return current
+
+        self._handle = None
+        if now < self._retry_at:
+            return None
+        try:
+            self._handle = self.cache_client.create(self.model, self.system_instruction, self.ttl_seconds, self.display_name)
+            self.counts["created"] += 1
+            logger.info(f"Registered system instruction as cached content {self._handle.name} for {self.model}")
+            return self._handle
+        except Exception as e:
+            self._retry_at = now + self.retry_after_seconds
+            self.counts["create_failures"] += 1
+            self.last_error = str(e)
+            logger.warning(f"Could not cache the system instruction, sending it inline for {self.retry_after_seconds:.0f}s: {e}")
+            return None
+
+    def invalidate(self, name: str, reason: Any = None) -> None:
+        with self._lock:
+            if self._handle is not None and self._handle.name == name:
+                self._handle = None
+                self.counts["invalidated"] += 1
+                self.last_error = str(reason) if reason is not None else None
+                logger.warning(f"Cached instruction {name} was rejected, recreating it in the background: {reason}")
+        self._wake.set()
+
+    def close(self) -> None:
+        """Stop the refresher and delete the cached content now instead of letting its TTL run out"""
+        self._stopped.set()
+        self._wake.set()
+        with self._lock:
+            handle, self._handle = self._handle, None
+        if handle is not None:
+            try:
+                self.cache_client.delete(handle.name)
+            except Exception as e:
+                logger.warning(f"Could not delete cached instruction {handle.name}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        handle = self._handle
+        return {
+            "model": self.model,
+            "name": handle.name if handle else None,
+            "expires_in_seconds": round(handle.expires_at - self._clock(), 1) if handle else None,
+            "last_error": self.last_error,
+            **self.counts,
+        }
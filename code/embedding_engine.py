@@ -0,0 +1,308 @@
+"""Selectable torch or ONNX engines for the all-MiniLM-L6-v2 sentence embedder used by app2.py"""
+from __future__ import annotations
+
+import argparse
+import inspect
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+FP32_MODEL_FILE = "model_fp32.onnx"
+INT8_MODEL_FILE = "model_int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+CONFIG_FILE = "engine_config.json"
+ONNX_OPSET = 17
+PARITY_NEIGHBOURS = 10
+
+
+def _normalise_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+# --- Engines ---
+class TorchEmbeddingEngine:
+    """The stock SentenceTransformer model."""
+
+    name = "torch"
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, threads: int = 0):
+        from sentence_transformers import SentenceTransformer
+
+        if threads > 0:
+            import torch
+
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: str | Sequence[str], batch_size: int = 32, show_progress_bar: bool = False, **kwargs: Any) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar, **kwargs)
+
+
+class OnnxEmbeddingEngine:
+    """An exported MiniLM transformer run with onnxruntime; see ``export_onnx``. Reproduces the
+    SentenceTransformer pipeline: mean pooling over the attention mask, then L2 normalisation."""
+
+    name = "onnx"
+
+    def __init__(self, model_dir: Path, threads: int = 0, quantized: bool = True):
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("The onnx embedding engine needs onnxruntime and tokenizers: pip install -r requirements-onnx.txt") from e
+
+        self.model_dir = Path(model_dir)
+        self.model_path = self.model_dir / (INT8_MODEL_FILE if quantized else FP32_MODEL_FILE)
+        if not self.model_path.exists():
+            raise FileNotFoundError(f"{self.model_path} not found; run `python embedding_engine.py export --out-dir {self.model_dir}` first")
+        self.config = json.loads((self.model_dir / CONFIG_FILE).read_text(encoding="utf-8"))
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(self.model_path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(str(self.model_dir / TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        pad_token = self.config.get("pad_token", "[PAD]")
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token), pad_token=pad_token)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.config["dimension"])
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feed = {"input_ids": np.asarray([e.ids for e in encodings], dtype=np.int64), "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.asarray([e.type_ids for e in encodings], dtype=np.int64)
+        hidden = self.session.run(None, feed)[0]
+
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return _normalise_rows(pooled.astype(np.float32)) if self.config.get("normalize", True) else pooled.astype(np.float32)
+
+    def encode(self, texts: str | Sequence[str], batch_size: int = 32, show_progress_bar: bool = False, **kwargs: Any) -> np.ndarray:
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        # Batch texts of similar length together so little compute goes to padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = np.empty((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            vectors[rows] = self._encode_batch([texts[i] for i in rows])
+        return vectors[0] if single else vectors
+
+
+def create_engine(engine: str = "torch", model_name: str = DEFAULT_MODEL_NAME, onnx_dir: Path | str | None = None,
+                  threads: int = 0, quantized: bool = True) -> Any:
+    """Build the named embedding engine ("torch" or "onnx")."""
+    if engine == "torch":
+        return TorchEmbeddingEngine(model_name, threads=threads)
+    if engine == "onnx":
+        if onnx_dir is None:
+            raise ValueError("The onnx embedding engine needs onnx_dir (see `embedding_engine.py export`)")
+        return OnnxEmbeddingEngine(Path(onnx_dir), threads=threads, quantized=quantized)
+    raise ValueError(f"Unknown embedding engine '{engine}', expected 'torch' or 'onnx'")
+
+
+# --- Export ---
+def export_onnx(out_dir: Path, model_name: str = DEFAULT_MODEL_NAME, quantize: bool = True) -> Path:
+    """Export the SentenceTransformer's transformer to ONNX (plus an int8 dynamically quantized copy)."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, model: Any):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).last_hidden_state
+
+    sample = tokenizer(["export sample", "a second, longer export sample"], padding=True, return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    fp32_path = out_dir / FP32_MODEL_FILE
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(transformer),
+            tuple(sample[name] for name in input_names),
+            str(fp32_path),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+            **export_kwargs,
+        )
+
+    tokenizer.backend_tokenizer.save(str(out_dir / TOKENIZER_FILE))
+    normalize = any(type(module).__name__ == "Normalize" for module in st_model)
+    config = {
+        "source_model": model_name,
+        "dimension": st_model.get_sentence_embedding_dimension(),
+        "max_seq_length": st_model.max_seq_length,
+        "pad_token": tokenizer.pad_token,
+        "pooling": "mean",
+        "normalize": normalize,
+    }
+    (out_dir / CONFIG_FILE).write_text(json.dumps(config, indent=2), encoding="utf-8")
+    logger.info(f"Exported {model_name} to {fp32_path} ({fp32_path.stat().st_size / 1e6:.1f} MB)")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = out_dir / INT8_MODEL_FILE
+        quantize_dynamic(str(fp32_path), str(int8_path), weight_type=QuantType.QInt8)
+        logger.info(f"Quantized to {int8_path} ({int8_path.stat().st_size / 1e6:.1f} MB)")
+    return out_dir
+
+
+# --- Parity check and benchmark ---
+def load_corpus_texts(paths: Sequence[Path], limit: int | None = None) -> List[str]:
+    """Chunk texts from chunk folders, chunk JSON files or point exports (see local_index.py)."""
+    from local_index import load_chunk_dir, load_chunk_file, load_points_export
+
+    texts: List[str] = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            records = load_chunk_dir(path)
+        elif path.suffix == ".jsonl":
+            records = load_points_export(path)[0]
+        else:
+            records = load_chunk_file(path)
+        texts.extend(record["payload"]["text"] for record in records if record["payload"].get("text"))
+        if limit is not None and len(texts) >= limit:
+            return texts[:limit]
+    return texts
+
+
+def parity_report(reference: Any, candidate: Any, texts: Sequence[str], batch_size: int = 64) -> Dict[str, Any]:
+    """Compare two engines on the same texts: per-text cosine agreement, and how often each text's
+    top-k nearest neighbours in the corpus stay the same (what retrieval actually depends on)."""
+    ref = _normalise_rows(np.asarray(reference.encode(list(texts), batch_size=batch_size), dtype=np.float32))
+    cand = _normalise_rows(np.asarray(candidate.encode(list(texts), batch_size=batch_size), dtype=np.float32))
+    cosines = (ref * cand).sum(axis=1)
+
+    k = min(PARITY_NEIGHBOURS, len(texts) - 1)
+    overlap = None
+    if k > 0:
+        queries = np.arange(min(len(texts), 500))
+        ref_top = np.argsort(-(ref[queries] @ ref.T), axis=1)[:, 1:k + 1]
+        cand_top = np.argsort(-(cand[queries] @ cand.T), axis=1)[:, 1:k + 1]
+        overlap = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(ref_top, cand_top)]))
+
+    return {
+        "texts": len(texts),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        "p01_cosine": float(np.percentile(cosines, 1)),
+        "below_0_99": int((cosines < 0.99).sum()),
+        f"top{k}_neighbour_overlap": overlap,
+    }
+
+
+def benchmark(engine: Any, texts: Sequence[str], batch_sizes: Sequence[int] = (1, 32), single_queries: int = 200) -> Dict[str, Any]:
+    """Throughput for bulk encoding at each batch size, plus latency of single-query encodes."""
+    texts = list(texts)
+    engine.encode(texts[:8])  # warm-up
+    report: Dict[str, Any] = {"engine": engine.name, "texts": len(texts), "throughput": {}}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        engine.encode(texts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        report["throughput"][batch_size] = {"seconds": round(elapsed, 3), "texts_per_second": round(len(texts) / elapsed, 1)}
+
+    latencies = []
+    for text in texts[:single_queries]:
+        start = time.perf_counter()
+        engine.encode([text])
+        latencies.append(1000 * (time.perf_counter() - start))
+    report["single_query_ms"] = {"p50": round(float(np.percentile(latencies, 50)), 2), "p95": round(float(np.percentile(latencies, 95)), 2)}
+
+    model_path = getattr(engine, "model_path", None)
+    if model_path is not None:
+        report["model_mb"] = round(Path(model_path).stat().st_size / 1e6, 1)
+    return report
+
+
+# --- CLI ---
+def _parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Export, check and benchmark PSAI embedding engines")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="Export the model to ONNX and quantize it to int8")
+    export.add_argument("--out-dir", type=Path, required=True, help="Directory for the ONNX model and tokenizer")
+    export.add_argument("--model", default=DEFAULT_MODEL_NAME, help="SentenceTransformer model name")
+    export.add_argument("--no-quantize", action="store_true", help="Only write the fp32 model")
+
+    for name, help_text in (("parity", "Compare ONNX vectors with the PyTorch model on a corpus"),
+                            ("benchmark", "Time the engines on a corpus")):
+        command = sub.add_parser(name, help=help_text)
+        command.add_argument("--onnx-dir", type=Path, required=True, help="Directory written by `export`")
+        command.add_argument("--corpus", type=Path, nargs="+", required=True, help="Chunk folders, chunk JSON files or point exports")
+        command.add_argument("--limit", type=int, default=2000, help="Maximum number of texts")
+        command.add_argument("--threads", type=int, default=0, help="Intra-op threads (0: library default)")
+        command.add_argument("--fp32", action="store_true", help="Use the unquantized ONNX model")
+        command.add_argument("--model", default=DEFAULT_MODEL_NAME, help="SentenceTransformer model name")
+
+    sub.choices["parity"].add_argument("--min-mean-cosine", type=float, default=0.99, help="Fail below this mean cosine")
+    sub.choices["benchmark"].add_argument("--batch-sizes", default="1,32", help="Comma-separated batch sizes")
+    sub.choices["benchmark"].add_argument("--engines", default="torch,onnx", help="Comma-separated engines to time")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logging.basicConfig(level=logging.INFO)
+    args = _parse_args()
+    try:
+        if args.command == "export":
+            export_onnx(args.out_dir, args.model, quantize=not args.no_quantize)
+        else:
+            texts = load_corpus_texts(args.corpus, args.limit)
+            print(f"Loaded {len(texts)} texts")
+            engines = {
+                "torch": lambda: create_engine("torch", args.model, threads=args.threads),
+                "onnx": lambda: create_engine("onnx", onnx_dir=args.onnx_dir, threads=args.threads, quantized=not args.fp32),
+            }
+            if args.command == "parity":
+                report = parity_report(engines["torch"](), engines["onnx"](), texts)
+                print(json.dumps(report, indent=2))
+                if report["mean_cosine"] < args.min_mean_cosine:
+                    print(f"❌ Mean cosine {report['mean_cosine']:.4f} is below {args.min_mean_cosine}")
+                    sys.exit(1)
+                print("✅ ONNX embeddings agree with PyTorch")
+            else:
+                batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+                for engine_name in args.engines.split(","):
+                    print(json.dumps(benchmark(engines[engine_name](), texts, batch_sizes), indent=2))
+    except Exception as e:
+        logging.exception("Embedding engine command failed: %s", e)
+        sys.exit(1)
@@ -0,0 +1,534 @@
+"""In-process vector and BM25 search over PSAI chunks, an offline alternative to Qdrant for app2.py"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import uuid
+from pathlib import Path
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional: only needed for approximate search on large collections
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Collections with at least this many points are searched with an HNSW graph when hnswlib is installed
+# (requirements-ann.txt); smaller ones, or all of them without hnswlib, with a flat NumPy matrix
+DEFAULT_ANN_THRESHOLD = 20000
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128
+VECTOR_CACHE_NAME = "_vectors.npy"
+BM25_K1 = 1.5
+BM25_B = 0.75
+TITLE_BOOST = 3
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+EncodeFn = Callable[[List[str]], np.ndarray]
+
+
+class LocalScoredPoint(NamedTuple):
+    """Mirrors the fields of qdrant_client's ScoredPoint that app2.py reads."""
+    id: str
+    score: float
+    payload: Dict[str, Any]
+
+
+class LocalRecord(NamedTuple):
+    """Mirrors the fields of qdrant_client's Record (a point fetched by id) that app2.py reads."""
+    id: str
+    payload: Dict[str, Any]
+
+
+# --- Chunk loading ---
+
+def _chunk_id(source: str, position: int) -> str:
+    """Stable id so a chunk keeps the same id across reloads."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source}#{position}"))
+
+
+def _normalise_entry(entry: Dict[str, Any], source_name: str) -> Optional[Dict[str, Any]]:
+    """Turn one entry from any of the notebook chunk formats into a Qdrant-style payload."""
+    if "metadata" in entry and ("text" in entry or "full_text" in entry):
+        payload = dict(entry["metadata"] or {})
+        payload["text"] = entry.get("text") or entry.get("full_text", "")
+    elif "text" in entry:
+        # Flat formats: books ({author, book_title, publication_year, text}) and interviews
+        payload = dict(entry)
+        if "book_title" in payload:
+            payload.setdefault("doc_type", "Phyllis Schlafly Book")
+            payload.setdefault("source_file", source_name)
+    else:
+        return None
+    return payload if payload.get("text") else None
+
+
+def load_chunk_file(path: Path) -> List[Dict[str, Any]]:
+    """Load a chunk JSON file and return ``{"id", "payload"}`` records."""
+    path = Path(path)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    # Per-year column files wrap their chunks: {"year", "chunk_count", "chunks": [...]}
+    entries = data.get("chunks", []) if isinstance(data, dict) else data
+
+    records = []
+    for position, entry in enumerate(entries):
+        payload = _normalise_entry(entry, path.name) if isinstance(entry, dict) else None
+        if payload is not None:
+            records.append({"id": _chunk_id(path.name, position), "payload": payload})
+    return records
+
+
+def load_chunk_dir(directory: Path) -> List[Dict[str, Any]]:
+    """Load every chunk JSON file in a directory (sorted, so ids and row order are stable)."""
+    records = []
+    for path in sorted(Path(directory).glob("*.json")):
+        try:
+            records.extend(load_chunk_file(path))
+        except Exception as e:
+            logger.error(f"Error loading chunk file {path}: {e}")
+    return records
+
+
+def load_points_export(path: Path) -> tuple[List[Dict[str, Any]], np.ndarray]:
+    """Load a JSONL point export written by ``export_collection_points``."""
+    records, vectors = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            point = json.loads(line)
+            records.append({"id": str(point["id"]), "payload": point.get("payload") or {}})
+            vectors.append(point["vector"])
+    return records, np.asarray(vectors, dtype=np.float32)
+
+
+def export_collection_points(client: Any, collection_name: str, out_path: Path, batch_size: int = 256) -> int:
+    """Scroll a Qdrant collection (vectors and payloads) into a JSONL export."""
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    exported, offset = 0, None
+    with open(out_path, "w", encoding="utf-8") as f:
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            for point in points:
+                f.write(json.dumps({"id": str(point.id), "vector": list(point.vector), "payload": point.payload}) + "\n")
+            exported += len(points)
+            if offset is None:
+                break
+    logger.info(f"Exported {exported} points from {collection_name} to {out_path}")
+    return exported
+
+
+def list_index_collections(index_dir: Path) -> List[str]:
+    """Collection names available in a local index directory: a ``<collection>/`` folder of chunk JSON
+    files, or a ``<collection>.jsonl`` point export written by ``export_collection_points``."""
+    index_dir = Path(index_dir)
+    if not index_dir.exists():
+        return []
+    names = {p.stem for p in index_dir.glob("*.jsonl")}
+    names.update(p.name for p in index_dir.iterdir() if p.is_dir() and not p.name.startswith((".", "_")))
+    return sorted(names)
+
+
+def load_collection_records(index_dir: Path, collection_name: str) -> List[Dict[str, Any]]:
+    """Load the records (without vectors) of one collection in a local index directory."""
+    export_path = Path(index_dir) / f"{collection_name}.jsonl"
+    chunk_dir = Path(index_dir) / collection_name
+    if export_path.exists():
+        return load_points_export(export_path)[0]
+    if chunk_dir.is_dir():
+        return load_chunk_dir(chunk_dir)
+    raise KeyError(f"Collection {collection_name} not found in {index_dir}")
+
+
+# --- Vector index ---
+
+def _normalise_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class LocalCollection:
+    """One collection held in memory: payloads plus a cosine index over their vectors."""
+
+    def __init__(self, name: str, records: List[Dict[str, Any]], vectors: np.ndarray,
+                 ann_threshold: int = DEFAULT_ANN_THRESHOLD):
+        if len(records) != len(vectors):
+            raise ValueError(f"{name}: {len(records)} records but {len(vectors)} vectors")
+        self.name = name
+        self.ids = [record["id"] for record in records]
+        self.payloads = [record["payload"] for record in records]
+        self._rows = {str(point_id): row for row, point_id in enumerate(self.ids)}
+        self.vectors = _normalise_rows(vectors) if len(vectors) else np.zeros((0, 0), dtype=np.float32)
+        self.ann_index = None
+        if hnswlib is not None and len(self.ids) >= ann_threshold:
+            self.ann_index = hnswlib.Index(space="cosine", dim=self.vectors.shape[1])
+            self.ann_index.init_index(max_elements=len(self.ids), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+            self.ann_index.add_items(self.vectors, np.arange(len(self.ids)))
+            self.ann_index.set_ef(HNSW_EF_SEARCH)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dimension(self) -> int:
+        return int(self.vectors.shape[1]) if len(self.ids) else 0
+
+    def search(self, query_vector: Sequence[float], limit: int, score_threshold: float | None = None) -> List[LocalScoredPoint]:
+        return self.search_batch([query_vector], limit, score_threshold)[0]
+
+    def retrieve(self, point_ids: Sequence[Any]) -> List[LocalRecord]:
+        """The points with these ids, skipping unknown ones (like Qdrant's retrieve)."""
+        rows = [self._rows.get(str(point_id)) for point_id in point_ids]
+        return [LocalRecord(self.ids[row], self.payloads[row]) for row in rows if row is not None]
+
+    def search_batch(self, query_vectors: Sequence[Sequence[float]], limit: int,
+                     score_threshold: float | None = None) -> List[List[LocalScoredPoint]]:
+        """One result list per query vector, scored with a single matrix product (or knn_query)."""
+        if not self.ids or limit <= 0 or not len(query_vectors):
+            return [[] for _ in query_vectors]
+        queries = _normalise_rows(np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1))
+        k = min(limit, len(self.ids))
+
+        if self.ann_index is not None:
+            self.ann_index.set_ef(max(HNSW_EF_SEARCH, k))
+            labels, distances = self.ann_index.knn_query(queries, k=k)
+            rows, scores = labels, 1.0 - distances
+        else:
+            all_scores = queries @ self.vectors.T
+            if k < all_scores.shape[1]:
+                rows = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+            else:
+                rows = np.tile(np.arange(all_scores.shape[1]), (len(queries), 1))
+            order = np.argsort(-np.take_along_axis(all_scores, rows, axis=1), axis=1, kind="stable")
+            rows = np.take_along_axis(rows, order, axis=1)
+            scores = np.take_along_axis(all_scores, rows, axis=1)
+
+        batch_results = []
+        for query_rows, query_scores in zip(rows, scores):
+            results = []
+            for row, score in zip(query_rows, query_scores):
+                if score_threshold is not None and score < score_threshold:
+                    continue
+                results.append(LocalScoredPoint(self.ids[row], float(score), self.payloads[row]))
+            batch_results.append(results)
+        return batch_results
+
+
+class LocalVectorStore:
+    """Search backend over a local index directory with the same surface app2.py uses for Qdrant."""
+
+    def __init__(self, index_dir: Path, encode_fn: EncodeFn | None = None,
+                 ann_threshold: int = DEFAULT_ANN_THRESHOLD):
+        self.index_dir = Path(index_dir)
+        self.encode_fn = encode_fn
+        self.ann_threshold = ann_threshold
+        self._collections: Dict[str, LocalCollection] = {}
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def list_collections(self) -> List[str]:
+        return list_index_collections(self.index_dir)
+
+    def get_collection(self, collection_name: str) -> LocalCollection:
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            build_lock = self._build_locks.setdefault(collection_name, threading.Lock())
+        if collection is not None:
+            return collection
+
+        # Loading may embed a whole chunk folder; hold only this collection's lock so others stay searchable
+        with build_lock:
+            with self._lock:
+                collection = self._collections.get(collection_name)
+            if collection is None:
+                collection = self._load(collection_name)
+                with self._lock:
+                    self._collections[collection_name] = collection
+            return collection
+
+    def invalidate(self, collection_name: str | None = None) -> None:
+        """Drop loaded collections so the next search reloads them from disk."""
+        with self._lock:
+            if collection_name is None:
+                self._collections.clear()
+            else:
+                self._collections.pop(collection_name, None)
+
+    def search(self, collection_name: str, query_vector: Sequence[float], limit: int,
+               score_threshold: float | None = None) -> List[LocalScoredPoint]:
+        return self.get_collection(collection_name).search(query_vector, limit, score_threshold)
+
+    def search_batch(self, collection_name: str, query_vectors: Sequence[Sequence[float]], limit: int,
+                     score_threshold: float | None = None) -> List[List[LocalScoredPoint]]:
+        return self.get_collection(collection_name).search_batch(query_vectors, limit, score_threshold)
+
+    def retrieve(self, collection_name: str, point_ids: Sequence[Any]) -> List[LocalRecord]:
+        return self.get_collection(collection_name).retrieve(point_ids)
+
+    def describe_collection(self, collection_name: str) -> Dict[str, Any]:
+        """Point count and vector size, read from disk without embedding or indexing the collection."""
+        with self._lock:
+            loaded = self._collections.get(collection_name)
+        if loaded is not None:
+            return {"points_count": len(loaded), "vector_size": loaded.dimension, "distance": "Cosine"}
+
+        export_path = self.index_dir / f"{collection_name}.jsonl"
+        chunk_dir = self.index_dir / collection_name
+        points_count, vector_size = 0, None
+        if export_path.exists():
+            with export_path.open(encoding="utf-8") as handle:
+                for line in handle:
+                    if not line.strip():
+                        continue
+                    if vector_size is None:
+                        vector_size = len(json.loads(line)["vector"])
+                    points_count += 1
+        elif chunk_dir.is_dir():
+            points_count = len(load_chunk_dir(chunk_dir))
+            cache_path = chunk_dir / VECTOR_CACHE_NAME
+            if cache_path.exists():
+                vector_size = int(np.load(cache_path, mmap_mode="r").shape[1])
+        else:
+            raise KeyError(f"Collection {collection_name} not found in {self.index_dir}")
+        return {"points_count": points_count, "vector_size": vector_size, "distance": "Cosine"}
+
+    def describe_collections(self) -> Dict[str, Dict[str, Any]]:
+        return {name: self.describe_collection(name) for name in self.list_collections()}
+
+    def _load(self, collection_name: str) -> LocalCollection:
+        export_path = self.index_dir / f"{collection_name}.jsonl"
+        chunk_dir = self.index_dir / collection_name
+        if export_path.exists():
+            records, vectors = load_points_export(export_path)
+        elif chunk_dir.is_dir():
+            records = load_chunk_dir(chunk_dir)
+            vectors = self._vectors_for_chunks(chunk_dir, records)
+        else:
+            raise KeyError(f"Collection {collection_name} not found in {self.index_dir}")
+        logger.info(f"Loaded local collection {collection_name} ({len(records)} points)")
+        return LocalCollection(collection_name, records, vectors, self.ann_threshold)
+
+    def _vectors_for_chunks(self, chunk_dir: Path, records: List[Dict[str, Any]]) -> np.ndarray:
+        """Embed chunk texts, reusing the cached matrix when it is newer than every chunk file."""
+        cache_path = chunk_dir / VECTOR_CACHE_NAME
+        newest_source = max((p.stat().st_mtime for p in chunk_dir.glob("*.json")), default=0.0)
+        if cache_path.exists() and cache_path.stat().st_mtime >= newest_source:
+            cached = np.load(cache_path)
+            if len(cached) == len(records):
+                return cached
+        if self.encode_fn is None:
+            raise RuntimeError(f"No cached vectors for {chunk_dir.name} and no encoder to build them")
+        if not records:
+            return np.zeros((0, 0), dtype=np.float32)
+        vectors = np.asarray(self.encode_fn([record["payload"]["text"] for record in records]), dtype=np.float32)
+        np.save(cache_path, vectors)
+        return vectors
+
+
+# --- Lexical (BM25) index ---
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def normalise_title(title: str) -> str:
+    return " ".join(tokenize(title))
+
+
+def payload_titles(payload: Dict[str, Any]) -> List[str]:
+    """Titles of a chunk; PSR chunks carry a list of titles, everything else a single string."""
+    titles = []
+    for key in ("title", "book_title"):
+        value = payload.get(key)
+        if isinstance(value, str):
+            titles.append(value)
+        elif isinstance(value, list):
+            titles.extend(t for t in value if isinstance(t, str))
+    return [t for t in titles if t and t != "Unknown"]
+
+
+class LexicalCollection:
+    """BM25 postings for one collection over chunk text plus (boosted) titles."""
+
+    def __init__(self, name: str, records: List[Dict[str, Any]]):
+        self.name = name
+        self.ids = [record["id"] for record in records]
+        self.payloads = [record["payload"] for record in records]
+        self.postings: Dict[str, List[tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths: List[int] = []
+        self.titles: Dict[str, List[int]] = defaultdict(list)
+
+        for row, payload in enumerate(self.payloads):
+            titles = payload_titles(payload)
+            tokens = tokenize(payload.get("text", ""))
+            for title in titles:
+                tokens.extend(tokenize(title) * TITLE_BOOST)
+                self.titles[normalise_title(title)].append(row)
+            for term, tf in Counter(tokens).items():
+                self.postings[term].append((row, tf))
+            self.doc_lengths.append(len(tokens))
+
+        self.avg_doc_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0.0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def bm25(self, terms: Sequence[str]) -> Dict[int, float]:
+        scores: Dict[int, float] = defaultdict(float)
+        n_docs = len(self.ids)
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, tf in postings:
+                length_norm = 1 - BM25_B + BM25_B * self.doc_lengths[row] / (self.avg_doc_length or 1.0)
+                scores[row] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+        return scores
+
+    def search(self, query: str, limit: int, phrase: str | None = None) -> List[LocalScoredPoint]:
+        """Rank chunks by BM25; with ``phrase``, keep only chunks containing it verbatim (case-insensitive)."""
+        scores = self.bm25(tokenize(phrase or query))
+        if phrase:
+            needle = " ".join(phrase.lower().split())
+            scores = {
+                row: score for row, score in scores.items()
+                if needle in " ".join(self.payloads[row].get("text", "").lower().split())
+                or any(needle in title.lower() for title in payload_titles(self.payloads[row]))
+            }
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [LocalScoredPoint(self.ids[row], float(score), self.payloads[row]) for row, score in ranked]
+
+    def title_matches(self, query: str, limit: int) -> List[LocalScoredPoint]:
+        """Chunks whose title equals the query (ignoring case and punctuation), in document order."""
+        rows = self.titles.get(normalise_title(query), [])[:limit]
+        return [LocalScoredPoint(self.ids[row], 1.0, self.payloads[row]) for row in rows]
+
+
+class LexicalIndex:
+    """Lazily built BM25 indexes over the collections in a local index directory."""
+
+    def __init__(self, index_dir: Path):
+        self.index_dir = Path(index_dir)
+        self._collections: Dict[str, LexicalCollection] = {}
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def list_collections(self) -> List[str]:
+        return list_index_collections(self.index_dir)
+
+    def has_point_ids(self, collection_name: str) -> bool:
+        """Whether the collection is built from a Qdrant export, whose ids are the Qdrant point ids; chunk
+        folders get uuid5 ids of their own, which the (uuid4) points uploaded to Qdrant do not share"""
+        return (self.index_dir / f"{collection_name}.jsonl").exists()
+
+    def get_collection(self, collection_name: str) -> LexicalCollection | None:
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            build_lock = self._build_locks.setdefault(collection_name, threading.Lock())
+        if collection is not None:
+            return collection
+
+        # Builds take seconds on large collections; hold only this collection's lock so others stay searchable
+        with build_lock:
+            with self._lock:
+                collection = self._collections.get(collection_name)
+            if collection is None:
+                if collection_name not in self.list_collections():
+                    return None
+                records = load_collection_records(self.index_dir, collection_name)
+                collection = LexicalCollection(collection_name, records)
+                logger.info(f"Built BM25 index for {collection_name} ({len(records)} chunks)")
+                with self._lock:
+                    self._collections[collection_name] = collection
+            return collection
+
+    def invalidate(self, collection_name: str | None = None) -> None:
+        with self._lock:
+            if collection_name is None:
+                self._collections.clear()
+            else:
+                self._collections.pop(collection_name, None)
+
+    def search(self, collection_name: str, query: str, limit: int, phrase: str | None = None) -> List[LocalScoredPoint]:
+        collection = self.get_collection(collection_name)
+        return collection.search(query, limit, phrase) if collection is not None else []
+
+    def title_matches(self, collection_name: str, query: str, limit: int) -> List[LocalScoredPoint]:
+        collection = self.get_collection(collection_name)
+        return collection.title_matches(query, limit) if collection is not None else []
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Any]], key: Callable[[Any], Any], k: int = 60) -> List[tuple[Any, float]]:
+    """Fuse ranked lists with RRF; returns (item, fused_score) using each key's first-seen item."""
+    fused: Dict[Any, float] = defaultdict(float)
+    first_seen: Dict[Any, Any] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            item_key = key(item)
+            fused[item_key] += 1.0 / (k + rank)
+            first_seen.setdefault(item_key, item)
+    ordered = sorted(fused.items(), key=lambda entry: entry[1], reverse=True)
+    return [(first_seen[item_key], score) for item_key, score in ordered]
+
+
+# --- CLI ---
+def _parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Build or export PSAI local vector indexes")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="Export Qdrant collections to <index-dir>/<collection>.jsonl")
+    export.add_argument("collections", nargs="*", help="Collections to export (default: all)")
+    export.add_argument("--index-dir", type=Path, required=True, help="Local index directory")
+
+    build = sub.add_parser("build", help="Embed chunk folders and cache their vectors")
+    build.add_argument("--index-dir", type=Path, required=True, help="Local index directory")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logging.basicConfig(level=logging.INFO)
+    args = _parse_args()
+    try:
+        if args.command == "export":
+            from dotenv import load_dotenv
+            from qdrant_client import QdrantClient
+
+            load_dotenv("/Users/mason/Desktop/Technical_Projects/PYTHON_Projects/PSAI/code/.env")
+            client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+            names = args.collections or [c.name for c in client.get_collections().collections]
+            for name in names:
+                export_collection_points(client, name, args.index_dir / f"{name}.jsonl")
+        else:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer("all-MiniLM-L6-v2")
+            store = LocalVectorStore(args.index_dir, encode_fn=lambda texts: model.encode(texts, batch_size=64, show_progress_bar=True))
+            for name in store.list_collections():
+                print(f"✅ {name}: {len(store.get_collection(name))} points")
+    except Exception as e:
+        logging.exception("Local index command failed: %s", e)
+        sys.exit(1)
@@ -0,0 +1,237 @@
+"""In-process metrics in the Prometheus text format (served by app2.py's /metrics route), plus optional trace spans"""
+from __future__ import annotations
+
+import contextlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # optional: only needed when TRACING_ENABLED=true
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RECENT_SAMPLES = int(os.getenv("METRICS_RECENT_SAMPLES", "2048"))
+SNAPSHOT_QUANTILES = (0.5, 0.95, 0.99)
+# Spans need opentelemetry-api; exporters are configured the usual OpenTelemetry way (e.g. opentelemetry-instrument)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Dict[str, str] | None = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# --- Metric types ---
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in sorted(self._values.items())}
+
+
+class _HistogramSeries:
+    def __init__(self, bucket_count: int):
+        self.bucket_counts = [0] * bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.recent: deque = deque(maxlen=RECENT_SAMPLES)
+
+
+class Histogram(_Metric):
+    """Bucketed latencies for Prometheus, plus a window of recent samples so snapshot() can report p50/p95/p99"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series.bucket_counts[i] += 1
+                    break
+            series.count += 1
+            series.total += value
+            series.recent.append(value)
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """Observe the duration of the block, whether or not it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            items = sorted((key, list(s.bucket_counts), s.count, s.total) for key, s in self._series.items())
+        for key, bucket_counts, count, total in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, {'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Count and mean over all samples; quantiles over the most recent RECENT_SAMPLES"""
+        with self._lock:
+            items = sorted((key, s.count, s.total, list(s.recent)) for key, s in self._series.items())
+        result = {}
+        for key, count, total, recent in items:
+            summary = {"count": count, "mean": round(total / count, 6) if count else 0.0}
+            if recent:
+                for q, value in zip(SNAPSHOT_QUANTILES, np.quantile(recent, SNAPSHOT_QUANTILES)):
+                    summary[f"p{int(q * 100)}"] = round(float(value), 6)
+            result[",".join(key) or "total"] = summary
+        return result
+
+
+class Gauge(_Metric):
+    """Values computed at scrape time: callback returns {label values tuple: value}"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], callback: Callable[[], Dict[LabelValues, float]],
+                 type_name: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type_name = type_name
+
+    def _values(self) -> List[Tuple[LabelValues, float]]:
+        try:
+            return sorted((tuple(map(str, key)), float(value)) for key, value in self.callback().items() if value is not None)
+        except Exception as e:
+            logger.warning(f"Could not collect metric {self.name}: {e}")
+            return []
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in self._values()]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {",".join(key) or "value": value for key, value in self._values()}
+
+
+# --- Registry ---
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> Any:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str], callback: Callable[[], Dict[LabelValues, float]],
+              type_name: str = "gauge") -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, callback, type_name))
+
+    def get(self, name: str) -> _Metric | None:
+        return self._metrics.get(name)
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+registry = MetricsRegistry()
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Tracing ---
+if TRACING_ENABLED and otel_trace is None:
+    logger.warning("TRACING_ENABLED is set but opentelemetry-api is not installed; spans are disabled")
+_tracer = otel_trace.get_tracer("psai") if TRACING_ENABLED and otel_trace is not None else None
+
+
+def trace_span(name: str, **attributes: Any) -> contextlib.AbstractContextManager:
+    """An OpenTelemetry span when tracing is enabled, otherwise a no-op context"""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
@@ -0,0 +1,127 @@
+"""Process-wide rate limiting and circuit breaking for calls to an upstream API (Gemini in app2.py)"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+# --- Rate limiting ---
+class TokenBucket:
+    """Rate limiter for rate calls per second with bursts up to capacity. Callers reserve a slot and are told how long to
+    wait for it, so the same bucket works with time.sleep and asyncio.sleep"""
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        if rate <= 0 or capacity < 1:
+            raise ValueError("TokenBucket needs rate > 0 and capacity >= 1")
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, max_wait: float) -> float | None:
+        """Take a token, returning how many seconds the caller must wait before using it,
+        or None (and take nothing) if that would be longer than max_wait.
+
+        Tokens may go negative: each reservation queues behind the earlier ones."""
+        with self._lock:
+            self._refill(self._clock())
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill(self._clock())
+            return self._tokens
+
+
+# --- Circuit breaking ---
+class CircuitBreaker:
+    """After failure_threshold consecutive failures, refuses calls for recovery_seconds; then lets one
+    probe call through (half-open), whose outcome closes or re-opens the circuit"""
+
+    def __init__(self, failure_threshold: int = 5, recovery_seconds: float = 30.0, name: str = "circuit",
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_seconds = recovery_seconds
+        self.name = name
+        self._clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.transitions: Dict[str, int] = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+
+    def _set_state(self, state: str) -> None:
+        previous, self._state = self._state, state
+        if previous != state:
+            self.transitions[state] += 1
+            logger.warning(f"Circuit {self.name}: {previous} -> {state}")
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and self._clock() - self._opened_at >= self.recovery_seconds:
+                self._set_state(HALF_OPEN)
+            return self._state
+
+    def is_open(self) -> bool:
+        """True while calls are being refused (open, or half-open with the probe already out)"""
+        state = self.state
+        return state == OPEN or (state == HALF_OPEN and self._probe_in_flight)
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now; a True in the half-open state is the single probe,
+        which must be followed by record_success, record_failure or release"""
+        state = self.state
+        with self._lock:
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def release(self) -> None:
+        """An allowed call was not made after all (e.g. refused by a rate limiter)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+                self._set_state(OPEN)
+
+    def stats(self) -> Dict[str, object]:
+        state = self.state
+        return {
+            "state": state,
+            "consecutive_failures": self._failures,
+            "retry_in_seconds": round(max(0.0, self.recovery_seconds - (self._clock() - self._opened_at)), 1) if state == OPEN else None,
+            "transitions": dict(self.transitions),
+        }
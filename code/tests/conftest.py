@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The app's modules live side by side in code/ and import each other by bare name
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(autouse=True)
+def answer_cache_in_tmp_path(tmp_path, monkeypatch):
+    """When the answer cache is enabled, tests get a fresh one in tmp_path instead of code/answer_cache.sqlite3"""
+    app2 = sys.modules.get("app2")
+    if app2 is None or app2.answer_cache is None:
+        return
+    cache = app2.SemanticAnswerCache(str(tmp_path / "answers.sqlite3"), app2.ANSWER_CACHE_SIMILARITY, app2.ANSWER_CACHE_TTL_SECONDS,
+                                     app2.ANSWER_CACHE_MAX_ENTRIES, app2.ANSWER_CACHE_MAX_ENTRIES_PER_PARAMS)
+    for module in ("app2", "asgi_app"):
+        if module in sys.modules:
+            monkeypatch.setattr(sys.modules[module], "answer_cache", cache)
@@ -0,0 +1,119 @@
+import math
+import os
+
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+
+import pytest
+
+import app2
+from app2 import SemanticAnswerCache
+
+
+def unit(angle):
+    """A 2-d query vector; two of them have cosine similarity cos(angle difference)"""
+    return [math.cos(angle), math.sin(angle)]
+
+
+def params(collections=("c",)):
+    return SemanticAnswerCache.params_key(list(collections), 0.7, 5, 0.0)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SemanticAnswerCache(str(tmp_path / "answers.sqlite3"), similarity_cutoff=0.95, ttl_seconds=3600, max_entries=100)
+
+
+def test_the_database_is_created_on_first_use(tmp_path):
+    path = tmp_path / "answers.sqlite3"
+    cache = SemanticAnswerCache(str(path), similarity_cutoff=0.95, ttl_seconds=3600, max_entries=100)
+    assert not path.exists()
+    cache.store("q", unit(0.0), params(), ["c"], {"response": "stored"})
+    assert path.exists()
+
+
+def test_hit_at_or_above_the_similarity_cutoff(cache):
+    cache.store("q", unit(0.0), params(), ["c"], {"response": "stored"})
+    response, similarity = cache.lookup(unit(math.acos(0.96)), params())
+    assert response == {"response": "stored"}
+    assert similarity == pytest.approx(0.96, abs=1e-4)
+
+
+def test_miss_below_the_similarity_cutoff(cache):
+    cache.store("q", unit(0.0), params(), ["c"], {"response": "stored"})
+    assert cache.lookup(unit(math.acos(0.94)), params()) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_nearest_answer_wins(cache):
+    cache.store("far", unit(0.3), params(), ["c"], {"response": "far"})
+    cache.store("near", unit(0.01), params(), ["c"], {"response": "near"})
+    assert cache.lookup(unit(0.0), params())[0] == {"response": "near"}
+
+
+def test_answers_only_match_the_same_parameters(cache):
+    cache.store("q", unit(0.0), params(["c"]), ["c"], {"response": "stored"})
+    assert cache.lookup(unit(0.0), params(["c", "d"])) is None
+
+
+def test_expired_answers_miss(tmp_path):
+    cache = SemanticAnswerCache(str(tmp_path / "answers.sqlite3"), similarity_cutoff=0.95, ttl_seconds=-1, max_entries=100)
+    cache.store("q", unit(0.0), params(), ["c"], {"response": "stored"})
+    assert cache.lookup(unit(0.0), params()) is None
+
+
+def test_invalidating_a_collection_drops_only_its_answers(cache):
+    cache.store("q", unit(0.0), params(["c"]), ["c"], {"response": "c"})
+    cache.store("q", unit(0.0), params(["d"]), ["d"], {"response": "d"})
+    # Load both in-memory indexes before invalidating
+    assert cache.lookup(unit(0.0), params(["c"])) is not None
+    assert cache.lookup(unit(0.0), params(["d"])) is not None
+
+    assert cache.invalidate_collections(["c"]) == 1
+    assert cache.lookup(unit(0.0), params(["c"])) is None
+    assert cache.lookup(unit(0.0), params(["d"]))[0] == {"response": "d"}
+
+    assert cache.invalidate_collections() == 1
+    assert cache.lookup(unit(0.0), params(["d"])) is None
+
+
+def test_each_parameter_set_is_capped(tmp_path):
+    cache = SemanticAnswerCache(str(tmp_path / "answers.sqlite3"), similarity_cutoff=0.95, ttl_seconds=3600,
+                                max_entries=100, max_entries_per_params=2)
+    for angle in (0.0, 1.0, 2.0):
+        cache.store("q", unit(angle), params(), ["c"], {"response": angle})
+    cache.store("q", unit(0.0), params(["d"]), ["d"], {"response": "d"})
+    assert cache.stats()["size"] == 3
+    # The least recently used answer of the capped parameter set went first
+    assert cache.lookup(unit(0.0), params()) is None
+    assert cache.lookup(unit(2.0), params())[0] == {"response": 2.0}
+
+
+def test_answers_evicted_after_the_index_loaded_are_not_returned(cache):
+    cache.store("q", unit(0.0), params(["c"]), ["c"], {"response": "c"})
+    assert cache.lookup(unit(0.0), params(["c"])) is not None
+    cache._conn.execute("DELETE FROM answers")
+    assert cache.lookup(unit(0.0), params(["c"])) is None
+
+
+def test_invalidation_is_refused_to_remote_clients(monkeypatch):
+    monkeypatch.setattr(app2, "CACHE_ADMIN_TOKEN", "")
+    client = app2.app.test_client()
+    assert client.post("/api/cache/invalidate", json={}, environ_base={"REMOTE_ADDR": "203.0.113.7"}).status_code == 403
+    assert client.post("/api/cache/invalidate", json={}, environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code == 200
+
+
+def test_invalidation_requires_the_admin_token_when_one_is_set(monkeypatch):
+    monkeypatch.setattr(app2, "CACHE_ADMIN_TOKEN", "s3cret")
+    client = app2.app.test_client()
+    local = {"REMOTE_ADDR": "127.0.0.1"}
+    assert client.post("/api/cache/invalidate", json={}, environ_base=local).status_code == 403
+    assert client.post("/api/cache/invalidate", json={}, environ_base=local, headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert client.post("/api/cache/invalidate", json={}, environ_base={"REMOTE_ADDR": "203.0.113.7"},
+                       headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_answers_a_token_budget_cut_short_are_not_cached():
+    answered = {"response": "r", "critique_assessment": "POOR_NEEDS_MORE_CONTEXT", "answer_source": "gemini"}
+    assert app2.is_cacheable_response(dict(answered, retry_stopped_by="max_iterations"))
+    assert not app2.is_cacheable_response(dict(answered, retry_stopped_by="token_budget"))
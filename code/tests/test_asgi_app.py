@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import threading
+
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+
+import app2
+import asgi_app
+
+
+def call(method, path, payload):
+    """Run one request through the ASGI app; returns (status, content type, body)"""
+    messages = [{"type": "http.request", "body": json.dumps(payload).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [(b"content-type", b"application/json")], "query_string": b""}
+    asyncio.run(asgi_app.app(scope, receive, send))
+    headers = dict(sent[0].get("headers", []))
+    return sent[0]["status"], headers.get(b"content-type"), b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def test_unhandled_errors_become_a_json_500(monkeypatch):
+    async def fail(graph_input, use_answer_cache):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(asgi_app, "validate_graph_input", lambda graph_input: None)
+    monkeypatch.setattr(asgi_app, "run_query_async", fail)
+    status, content_type, body = call("POST", "/api/query", {"query": "equal rights", "collections": ["c"]})
+    assert status == 500
+    assert content_type == b"application/json"
+    assert json.loads(body) == {"error": "Internal server error"}
+
+
+def test_batch_streams_lines_from_its_own_pool(monkeypatch):
+    threads = []
+
+    def lines(items, use_answer_cache):
+        threads.append(threading.current_thread().name)
+        for index, item in enumerate(items):
+            yield json.dumps({"index": index, "query": item["query"]}) + "\n"
+
+    monkeypatch.setattr(asgi_app, "batch_response_lines", lines)
+    status, content_type, body = call("POST", "/api/query/batch", {"queries": ["a", {"query": "b"}], "collections": ["c"]})
+    assert status == 200
+    assert content_type == b"application/x-ndjson"
+    assert [json.loads(line)["query"] for line in body.decode().splitlines()] == ["a", "b"]
+    assert threads[0].startswith("async-batch")
+
+
+def test_batch_validation_matches_flask():
+    status, _, body = call("POST", "/api/query/batch", {"queries": []})
+    assert status == 400
+    assert json.loads(body) == {"error": app2.batch_request_error({"queries": []})}
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+def streamed_answer():
+    chunks = [{"text": "The amendment failed.", "collection": "c", "metadata": {"book_title": "Report"}}]
+    return app2.StreamedAnswer("What happened to the ERA?", chunks)
+
+
+def test_streamed_answer_falls_back_when_nothing_was_streamed():
+    answer = streamed_answer()
+    fallback = answer.fail(app2.APIError("unavailable"))
+    assert fallback.startswith("Based on the available information:")
+    result = answer.result()
+    assert result["text"] == fallback
+    assert result["gemini_usage"] is None
+
+
+def test_streamed_answer_keeps_the_pieces_of_an_interrupted_stream():
+    answer = streamed_answer()
+    assert answer.add(Chunk("It was ")) == "It was "
+    assert answer.fail(app2.APIError("reset")) is None
+    result = answer.result()
+    assert result["text"] == "It was "
+    assert result["gemini_usage"]["estimated"] == 1
+
+
+class FakeStreamingClient:
+    """genai client whose first generate_content_stream call fails, then streams two chunks"""
+    def __init__(self):
+        self.aio = self
+        self.models = self
+        self.calls = 0
+
+    async def generate_content_stream(self, model, contents, config):
+        self.calls += 1
+        if self.calls == 1:
+            raise app2.APIError("Empty response from Gemini API")
+
+        async def chunks():
+            yield Chunk("It was ")
+            yield Chunk("never ratified.")
+        return chunks()
+
+
+def test_stream_retries_hold_no_gemini_slot_during_backoff(monkeypatch):
+    client = FakeStreamingClient()
+    monkeypatch.setattr(asgi_app, "genai_client_instance", app2.LazyResource("fake_genai", lambda: client))
+    monkeypatch.setattr(asgi_app, "gemini_semaphore", asyncio.Semaphore(1))
+    slot_taken_during_backoff = []
+
+    def no_wait(retry_state):
+        slot_taken_during_backoff.append(asgi_app.gemini_semaphore.locked())
+        return 0
+
+    async def stream():
+        first_chunk, chunks = await asgi_app.open_gemini_stream_async.retry_with(wait=no_wait)("model", "prompt", None)
+        held = asgi_app.gemini_semaphore.locked()
+        asgi_app.gemini_semaphore.release()
+        return first_chunk.text, held
+
+    assert asyncio.run(stream()) == ("It was ", True)
+    assert client.calls == 2
+    assert slot_taken_during_backoff == [False]
+
+
+def test_streamed_answers_give_their_gemini_slot_back(monkeypatch):
+    monkeypatch.setattr(asgi_app, "gemini_semaphore", asyncio.Semaphore(1))
+
+    async def opened(model, prompt, config, deadline=None):
+        await asgi_app.gemini_semaphore.acquire()
+        return Chunk("It was "), stream_rest()
+
+    async def stream_rest():
+        assert asgi_app.gemini_semaphore.locked()
+        yield Chunk("never ratified.")
+
+    monkeypatch.setattr(asgi_app, "open_gemini_stream_async", opened)
+    monkeypatch.setattr(asgi_app, "instruction_cache", None)
+    chunks = [{"text": "The amendment failed.", "collection": "c", "metadata": {"book_title": "Report"}}]
+
+    async def collect():
+        return [item async for item in asgi_app.stream_gemini_response_async("What happened to the ERA?", chunks)]
+
+    items = asyncio.run(collect())
+    assert items[:2] == ["It was ", "never ratified."]
+    assert items[-1]["text"] == "It was never ratified."
+    assert not asgi_app.gemini_semaphore.locked()
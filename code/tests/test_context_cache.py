@@ -0,0 +1,118 @@
+from context_cache import CachedInstruction, InMemoryCacheClient
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingClient(InMemoryCacheClient):
+    def __init__(self, clock):
+        super().__init__(clock)
+        self.calls = []
+
+    def create(self, *args, **kwargs):
+        self.calls.append("create")
+        return super().create(*args, **kwargs)
+
+    def renew(self, *args, **kwargs):
+        self.calls.append("renew")
+        return super().renew(*args, **kwargs)
+
+
+def make_cache(clock, client=None, **kwargs):
+    client = client or CountingClient(clock)
+    cache = CachedInstruction(client, "model", "instruction", ttl_seconds=100, renew_margin_seconds=10,
+                              retry_after_seconds=60, clock=clock, refresh_in_background=False, **kwargs)
+    return cache, client
+
+
+def test_handle_is_inline_until_refreshed_and_never_calls_the_client():
+    clock = FakeClock()
+    cache, client = make_cache(clock)
+    assert cache.handle() is None
+    assert client.calls == []
+
+    handle = cache.refresh()
+    assert cache.handle() == handle.name
+    assert client.calls == ["create"]
+    assert cache.counts["inline_uses"] == 1 and cache.counts["cached_uses"] == 1
+
+
+def test_refresh_renews_only_inside_the_margin():
+    clock = FakeClock()
+    cache, client = make_cache(clock)
+    handle = cache.refresh()
+    assert cache.next_refresh_in() == 90
+
+    clock.now += 80  # 20s left, outside the 10s margin
+    cache.refresh()
+    assert client.calls == ["create"]
+
+    clock.now += 15  # 5s left
+    renewed = cache.refresh()
+    assert client.calls == ["create", "renew"]
+    assert renewed.name == handle.name and renewed.expires_at == clock.now + 100
+    assert cache.counts["renewed"] == 1
+
+
+def test_failed_renewal_keeps_the_handle_until_it_expires():
+    clock = FakeClock()
+    cache, client = make_cache(clock)
+    handle = cache.refresh()
+    clock.now += 95
+    client.entries.clear()  # the server forgot the cache: renew raises
+    cache.refresh()
+    assert cache.counts["renew_failures"] == 1
+    assert cache.handle() == handle.name
+
+    clock.now += 5
+    assert cache.handle() is None
+
+
+def test_failed_create_falls_back_to_inline_and_backs_off():
+    clock = FakeClock()
+    cache, client = make_cache(clock)
+    client.fail_creates = 1
+
+    assert cache.refresh() is None
+    assert cache.handle() is None
+    assert cache.counts["create_failures"] == 1
+    assert cache.next_refresh_in() == 60
+
+    clock.now += 30
+    assert cache.refresh() is None
+    assert client.calls == ["create"]  # still backing off
+
+    clock.now += 30
+    assert cache.refresh() is not None
+    assert cache.handle() is not None
+
+
+def test_invalidate_drops_only_the_rejected_handle():
+    clock = FakeClock()
+    cache, client = make_cache(clock)
+    handle = cache.refresh()
+
+    cache.invalidate("cachedContents/some-other-name")
+    assert cache.handle() == handle.name
+
+    cache.invalidate(handle.name, "403 CachedContent not found")
+    assert cache.handle() is None
+    assert cache.counts["invalidated"] == 1
+
+    replacement = cache.refresh()
+    assert replacement.name != handle.name
+    assert cache.handle() == replacement.name
+
+
+def test_close_deletes_the_cached_content():
+    clock = FakeClock()
+    cache, client = make_cache(clock)
+    handle = cache.refresh()
+    cache.close()
+    assert handle.name not in client.entries
+    assert cache.handle() is None
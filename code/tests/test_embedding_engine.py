@@ -0,0 +1,71 @@
+"""ONNX vs torch parity on fixed sentences.  Needs the optional ONNX dependencies
+(requirements-onnx.txt) and the model: EMBEDDING_PARITY_MODEL (default all-MiniLM-L6-v2)
+is exported to a temporary directory unless EMBEDDING_ONNX_DIR already holds an export of it."""
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("tokenizers")
+pytest.importorskip("sentence_transformers")
+
+from embedding_engine import CONFIG_FILE, DEFAULT_MODEL_NAME, OnnxEmbeddingEngine, TorchEmbeddingEngine, export_onnx
+
+MODEL_NAME = os.getenv("EMBEDDING_PARITY_MODEL", DEFAULT_MODEL_NAME)
+
+SENTENCES = [
+    "What did Phyllis Schlafly say about the Equal Rights Amendment?",
+    "STOP ERA",
+    "The Phyllis Schlafly Report, 1972",
+    "A Choice Not an Echo was published in 1964 and sold millions of copies.",
+    "She argued that the amendment would take away rights that women already had, including the "
+    "right to be supported by their husbands and exemption from the military draft.",
+    "national defense and the strategic balance with the Soviet Union",
+    "",
+]
+
+FP32_MIN_COSINE = 0.999
+INT8_MIN_COSINE = 0.98
+
+
+@pytest.fixture(scope="module")
+def torch_engine():
+    try:
+        return TorchEmbeddingEngine(MODEL_NAME)
+    except Exception as e:
+        pytest.skip(f"Cannot load {MODEL_NAME}: {e}")
+
+
+@pytest.fixture(scope="module")
+def onnx_dir(torch_engine, tmp_path_factory):
+    existing = Path(os.getenv("EMBEDDING_ONNX_DIR", "")) if os.getenv("EMBEDDING_ONNX_DIR") else None
+    if existing is not None and (existing / CONFIG_FILE).exists():
+        if json.loads((existing / CONFIG_FILE).read_text(encoding="utf-8"))["source_model"] == MODEL_NAME:
+            return existing
+    pytest.importorskip("onnx")
+    return export_onnx(tmp_path_factory.mktemp("onnx"), MODEL_NAME)
+
+
+def cosines(reference, candidate):
+    ref = np.asarray(reference.encode(SENTENCES), dtype=np.float32)
+    cand = np.asarray(candidate.encode(SENTENCES), dtype=np.float32)
+    return (ref * cand).sum(axis=1) / (np.linalg.norm(ref, axis=1) * np.linalg.norm(cand, axis=1) + 1e-12)
+
+
+def test_fp32_export_matches_torch(torch_engine, onnx_dir):
+    engine = OnnxEmbeddingEngine(onnx_dir, quantized=False)
+    assert engine.get_sentence_embedding_dimension() == torch_engine.get_sentence_embedding_dimension()
+    assert cosines(torch_engine, engine).min() > FP32_MIN_COSINE
+
+
+def test_int8_export_stays_close_to_torch(torch_engine, onnx_dir):
+    assert cosines(torch_engine, OnnxEmbeddingEngine(onnx_dir, quantized=True)).min() > INT8_MIN_COSINE
+
+
+def test_single_text_matches_its_batch_row(onnx_dir):
+    engine = OnnxEmbeddingEngine(onnx_dir, quantized=False)
+    batch = engine.encode(SENTENCES)
+    assert np.allclose(engine.encode(SENTENCES[0]), batch[0], atol=1e-5)
@@ -0,0 +1,41 @@
+import logging
+import os
+
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+
+import app2
+
+
+CHUNKS = [
+    {"id": "1", "collection": "c", "text": "The amendment was never ratified.", "metadata": {"book_title": "Report", "source_file": "a.json"}},
+    {"id": "2", "collection": "c", "text": "Schlafly founded STOP ERA in 1972.", "metadata": {"book_title": "Feminist Fantasies", "source_file": "b.json"}},
+]
+
+
+def test_prompt_separates_entries_with_real_blank_lines():
+    prompt, context = app2.build_generation_prompt("What happened to the ERA?", CHUNKS)
+    assert "\\n" not in prompt
+    assert prompt.startswith("Context:\nSource [")
+    assert context.count("\n\nSource [") == 1
+    assert "\n\nQuestion: What happened to the ERA?\n\n" in prompt
+
+
+def test_packing_estimate_counts_the_separator_it_is_joined_with():
+    packed = app2.pack_context_chunks(CHUNKS)
+    _, context = app2.build_generation_prompt("q", CHUNKS)
+    entries = [f"Source [{app2.format_source_info(chunk)}]: {chunk['text']}" for chunk in packed]
+    assert context == app2.CONTEXT_SEPARATOR.join(entries)
+
+
+def test_deadline_fallbacks_are_logged_at_info(caplog):
+    caplog.set_level(logging.INFO, logger="app2")
+    result = app2.generation_fallback_result("q", CHUNKS, "", app2.RequestDeadlineError("Request deadline leaves no time for a Gemini call", 504))
+    assert result["time_limited"]
+    assert [record.levelno for record in caplog.records if "Gemini" in record.getMessage()] == [logging.INFO]
+
+
+def test_gemini_failures_are_logged_as_errors(caplog):
+    caplog.set_level(logging.INFO, logger="app2")
+    app2.generation_fallback_result("q", CHUNKS, "", app2.APIError("Empty response from Gemini API"))
+    assert [record.levelno for record in caplog.records if "Gemini" in record.getMessage()] == [logging.ERROR]
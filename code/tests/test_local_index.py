@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+
+import app2
+import local_index
+from local_index import LexicalIndex
+
+
+def write_export(index_dir, name, point_id):
+    point = {"id": point_id, "vector": [1.0, 0.0], "payload": {"text": "the equal rights amendment", "book_title": "Ratification"}}
+    (index_dir / f"{name}.jsonl").write_text(json.dumps(point) + "\n", encoding="utf-8")
+
+
+def write_chunk_dir(index_dir, name):
+    (index_dir / name).mkdir()
+    chunks = [{"text": "the equal rights amendment", "metadata": {"book_title": "Ratification"}}]
+    (index_dir / name / "chunks.json").write_text(json.dumps(chunks), encoding="utf-8")
+
+
+def test_exported_collections_keep_the_qdrant_point_ids(tmp_path):
+    write_export(tmp_path, "exported", "6f1c2b1e-0000-4000-8000-000000000001")
+    write_chunk_dir(tmp_path, "folder")
+    index = LexicalIndex(tmp_path)
+
+    assert index.has_point_ids("exported")
+    assert not index.has_point_ids("folder")
+    assert [hit.id for hit in index.search("exported", "equal rights", 5)] == ["6f1c2b1e-0000-4000-8000-000000000001"]
+
+
+def test_building_one_collection_does_not_block_another(tmp_path, monkeypatch):
+    write_export(tmp_path, "slow", "1")
+    write_export(tmp_path, "fast", "2")
+    building, release = threading.Event(), threading.Event()
+    load = local_index.load_collection_records
+
+    def load_slowly(index_dir, collection_name):
+        if collection_name == "slow":
+            building.set()
+            release.wait(5)
+        return load(index_dir, collection_name)
+
+    monkeypatch.setattr(local_index, "load_collection_records", load_slowly)
+    index = LexicalIndex(tmp_path)
+    slow = threading.Thread(target=index.get_collection, args=("slow",))
+    slow.start()
+    try:
+        assert building.wait(5)
+        assert index.get_collection("fast") is not None
+        assert slow.is_alive()
+    finally:
+        release.set()
+        slow.join(5)
+    assert index.get_collection("slow") is not None
+
+
+def test_qdrant_backend_skips_collections_without_point_ids(tmp_path, monkeypatch):
+    write_export(tmp_path, "exported", "1")
+    write_chunk_dir(tmp_path, "folder")
+    monkeypatch.setattr(app2, "lexical_index", LexicalIndex(tmp_path))
+
+    monkeypatch.setattr(app2, "SEARCH_BACKEND", "qdrant")
+    assert app2.lexical_collections(["exported", "folder"]) == ["exported"]
+    assert [r["collection"] for r in app2.lexical_search_internal("equal rights", ["exported", "folder"])] == ["exported"]
+
+    monkeypatch.setattr(app2, "SEARCH_BACKEND", "local")
+    assert app2.lexical_collections(["exported", "folder"]) == ["exported", "folder"]
+
+
+def test_loading_one_vector_collection_does_not_block_another(tmp_path):
+    write_chunk_dir(tmp_path, "slow")
+    write_export(tmp_path, "fast", "2")
+    embedding, release = threading.Event(), threading.Event()
+
+    def encode_slowly(texts):
+        embedding.set()
+        release.wait(5)
+        return [[1.0, 0.0] for _ in texts]
+
+    store = local_index.LocalVectorStore(tmp_path, encode_fn=encode_slowly)
+    slow = threading.Thread(target=store.get_collection, args=("slow",))
+    slow.start()
+    try:
+        assert embedding.wait(5)
+        assert [hit.id for hit in store.search("fast", [1.0, 0.0], 5)] == ["2"]
+        assert slow.is_alive()
+    finally:
+        release.set()
+        slow.join(5)
+    assert len(store.get_collection("slow")) == 1
+
+
+def test_large_collections_use_the_ann_index_and_agree_with_flat_search():
+    pytest.importorskip("hnswlib")
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 8)).astype(np.float32)
+    records = [{"id": str(row), "payload": {"text": f"chunk {row}"}} for row in range(len(vectors))]
+    queries = rng.normal(size=(5, 8))
+
+    ann = local_index.LocalCollection("c", records, vectors, ann_threshold=100)
+    flat = local_index.LocalCollection("c", records, vectors, ann_threshold=1000)
+    assert ann.ann_index is not None and flat.ann_index is None
+    for ann_hits, flat_hits in zip(ann.search_batch(queries, 10), flat.search_batch(queries, 10)):
+        assert [hit.id for hit in ann_hits] == [hit.id for hit in flat_hits]
+        assert [hit.score for hit in ann_hits] == pytest.approx([hit.score for hit in flat_hits], abs=1e-5)
+    assert all(hit.score >= 0.5 for hit in ann.search(queries[0], 10, score_threshold=0.5))
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+
+import pytest
+
+import app2
+import asgi_app
+
+BAD_INPUTS = [
+    {"deadline_seconds": -5},
+    {"deadline_seconds": 0},
+    {"deadline_seconds": "abc"},
+    {"deadline_seconds": "nan"},
+    {"token_budget": -1},
+    {"token_budget": 0},
+    {"token_budget": "lots"},
+    {"chunk_limit": "five"},
+    {"temperature": [0.7]},
+]
+
+
+@pytest.mark.parametrize("fields", BAD_INPUTS)
+def test_build_graph_input_rejects_bad_numbers(fields):
+    with pytest.raises(app2.InvalidRequestError):
+        app2.build_graph_input(dict({"query": "q", "collections": ["c"]}, **fields))
+
+
+def test_request_deadline_is_capped_and_never_removed(monkeypatch):
+    monkeypatch.setattr(app2, "REQUEST_DEADLINE_SECONDS", 30.0)
+    monkeypatch.setattr(app2, "REQUEST_DEADLINE_MAX_SECONDS", 120.0)
+    now = time.time()
+    assert app2.request_deadline(None) == pytest.approx(now + 30, abs=1)
+    assert app2.request_deadline("10") == pytest.approx(now + 10, abs=1)
+    assert app2.request_deadline(10_000) == pytest.approx(now + 120, abs=1)
+
+
+def test_request_token_budget_can_only_lower_the_server_budget(monkeypatch):
+    monkeypatch.setattr(app2, "TOKEN_BUDGET_PER_REQUEST", 5000)
+    assert app2.request_token_budget(None) == 5000
+    assert app2.request_token_budget("1000") == 1000
+    assert app2.request_token_budget(9000) == 5000
+    monkeypatch.setattr(app2, "TOKEN_BUDGET_PER_REQUEST", 0)
+    assert app2.request_token_budget(None) == 0
+    assert app2.request_token_budget(9000) == 9000
+
+
+@pytest.mark.parametrize("path", ["/api/query", "/api/query/stream"])
+@pytest.mark.parametrize("fields", BAD_INPUTS)
+def test_flask_routes_answer_bad_numbers_with_400(path, fields):
+    response = app2.app.test_client().post(path, json=dict({"query": "q", "collections": ["c"]}, **fields))
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_batch_reports_bad_numbers_per_query():
+    response = app2.app.test_client().post("/api/query/batch", json={
+        "collections": ["c"], "queries": [{"query": "q", "deadline_seconds": "abc"}]
+    })
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0]["index"] == 0 and "deadline_seconds" in lines[0]["error"]
+    assert lines[-1]["summary"]["errors"] == 1
+
+
+async def call_asgi(path, body):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": [(b"content-type", b"application/json")], "query_string": b""}
+    await asgi_app.app(scope, receive, send)
+    return sent[0]["status"], json.loads(b"".join(m.get("body", b"") for m in sent[1:]))
+
+
+@pytest.mark.parametrize("path", ["/api/query", "/api/query/stream"])
+@pytest.mark.parametrize("fields", [{"deadline_seconds": "abc"}, {"token_budget": -3}])
+def test_asgi_routes_answer_bad_numbers_with_400(path, fields):
+    status, body = asyncio.run(call_asgi(path, dict({"query": "q", "collections": ["c"]}, **fields)))
+    assert status == 400 and "error" in body
@@ -0,0 +1,73 @@
+import os
+
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+
+import app2
+
+
+def chunk(chunk_id, score, collection="c"):
+    return {"id": chunk_id, "collection": collection, "score": score, "text": chunk_id, "metadata": {}}
+
+
+def test_speculative_fusion_keeps_the_refined_ranking_order():
+    # The refined ranking (e.g. hybrid RRF output) deliberately disagrees with raw scores
+    refined = [chunk("a", 0.1), chunk("b", 0.2)]
+    speculative = [chunk("c", 0.9)]
+    fused = app2.fuse_speculative_results(refined, speculative, limit=3)
+    assert [result["id"] for result in fused] == ["a", "c", "b"]
+    assert all("fusion_score" in result for result in fused)
+
+
+def test_speculative_fusion_rewards_chunks_found_by_both_searches():
+    refined = [chunk("a", 0.5), chunk("b", 0.4)]
+    speculative = [chunk("b", 0.4), chunk("c", 0.3)]
+    fused = app2.fuse_speculative_results(refined, speculative, limit=2)
+    assert [result["id"] for result in fused] == ["b", "a"]
+
+
+def test_speculative_fusion_without_speculative_results_only_truncates():
+    refined = [chunk("a", 0.1), chunk("b", 0.9)]
+    assert app2.fuse_speculative_results(refined, [], limit=1) == refined[:1]
+
+
+class FakeLexicalIndex:
+    """Every phrase finds the same two chunks, with BM25 scores far above any cosine similarity"""
+
+    def search(self, collection_name, query, limit, phrase=None):
+        return [ScoredHit("x", 14.2), ScoredHit("y", 9.7)][:limit]
+
+    def title_matches(self, collection_name, query, limit):
+        return [ScoredHit("t", 1.0)][:limit]
+
+
+class ScoredHit:
+    def __init__(self, point_id, score):
+        self.id, self.score, self.payload = point_id, score, {"text": point_id, "metadata": {}}
+
+
+def test_lexical_hits_keep_bm25_out_of_the_cosine_score(monkeypatch):
+    monkeypatch.setattr(app2, "lexical_index", FakeLexicalIndex())
+    results = app2.lexical_search_internal("q", ["c"], limit=5)
+    assert [(r["id"], r["score"], r["bm25_score"]) for r in results] == [("x", None, 14.2), ("y", None, 9.7)]
+
+    titles = app2.lexical_fast_path_internal("Gasoline Rationing", ["c"], limit=5)
+    assert titles[0]["score"] is None and titles[0]["bm25_score"] is None and titles[0]["title_match"]
+
+
+def test_quoted_phrases_do_not_repeat_chunks(monkeypatch):
+    monkeypatch.setattr(app2, "lexical_index", FakeLexicalIndex())
+    monkeypatch.setattr(app2, "LEXICAL_FAST_PATH_ENABLED", True)
+    results = app2.lexical_fast_path_internal('"first phrase" and "second phrase"', ["c"], limit=5)
+    assert [r["id"] for r in results] == ["x", "y"]
+
+
+def test_collections_are_interleaved_by_rank():
+    rankings = [[chunk("a1", None, "a"), chunk("a2", None, "a")], [chunk("b1", None, "b")]]
+    assert [r["id"] for r in app2.interleave_rankings(rankings, limit=3)] == ["a1", "b1", "a2"]
+
+
+def test_sufficiency_ignores_chunks_without_a_cosine_score():
+    chunks = [dict(chunk("x", None), bm25_score=14.2), chunk("y", 0.42)]
+    assert app2.estimate_answer_sufficiency("", chunks)["top_score"] == 0.42
+    assert app2.estimate_answer_sufficiency("", chunks[:1])["top_score"] == 0.0